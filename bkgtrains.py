@@ -0,0 +1,244 @@
+"""
+bkgtrains.py
+
+Shared pre-generated background input instead of one NetStim per target cell
+
+A NetStim stim source (e.g. 'bkg': {'type': 'NetStim', 'rate': 10, 'noise': 0.5})
+creates a NetStim, a Random and a NetCon on every target cell, and every spike is
+drawn when the NetStim fires. Here the spike trains of all the targets on a node are
+generated up front with NumPy, and delivered by a single PatternStim per population,
+which fans the events out by gid: every target gets a virtual source gid, connected to
+its synMech with pc.gid_connect() like any other presynaptic cell.
+
+The trains follow NetStim's model: the first spike at start + noise*interval*E, and then
+intervals of (1-noise)*interval + noise*interval*E, with E ~ exponential(1), up to
+number spikes. Random numbers come from a counter-based generator (splitmix64) keyed by
+seeds['stim'] (or the stim 'seed'), the stim target label and the gid, so every train
+is reproducible and does not depend on the number of MPI ranks. The streams differ from
+the ones of NetStim (Random123), so the spikes are not the same, but follow the same
+distribution.
+
+Stim targets with a variable rate, lists of sections, or synsPerConn > 1 are created
+by NetPyNE as usual. Background spikes are not recorded in simData['stims'];
+the trains are in sim.bkgTrains.
+
+Usage:
+  simConfig.sharedBkg = True  # or a list of stim source labels; used by simtools.create()
+
+"""
+
+import zlib
+
+import numpy as np
+from netpyne import sim
+from netpyne.specs import Dict
+from neuron import h
+
+# golden ratio increment and multipliers of splitmix64
+_golden = np.uint64(0x9E3779B97F4A7C15)
+_mult1 = np.uint64(0xBF58476D1CE4E5B9)
+_mult2 = np.uint64(0x94D049BB133111EB)
+
+# max number of spike intervals drawn at once
+blockSize = 2**22
+
+
+###############################################################################
+#
+# SPIKE TRAINS
+#
+###############################################################################
+
+def _mix(z):
+    """splitmix64 output function (uint64 arrays; overflow wraps around)"""
+    with np.errstate(over='ignore'):
+        z = (z ^ (z >> np.uint64(30))) * _mult1
+        z = (z ^ (z >> np.uint64(27))) * _mult2
+    return z ^ (z >> np.uint64(31))
+
+
+def streamKey(label, seed):
+    """Key of the random streams of a stim target"""
+    return np.uint64((int(seed) << 32) | zlib.crc32(label.encode()))
+
+
+def exponentials(key, gids, start, count):
+    """
+    Exponential(1) draws start..start+count-1 of the stream of each gid: array of shape (len(gids), count)
+
+    Draw k of gid is a function of (key, gid, k) only, so a train can be generated in pieces,
+    on any node.
+
+    """
+    with np.errstate(over='ignore'):
+        seeds = _mix(key ^ _mix(np.asarray(gids, dtype=np.uint64) * _golden))
+        counters = np.arange(start + 1, start + count + 1, dtype=np.uint64) * _golden
+        bits = _mix(seeds[:, None] + counters[None, :])
+    uniform = ((bits >> np.uint64(11)) + np.uint64(1)).astype(float) * 2.0**-53  # (0, 1]
+    return -np.log(uniform)
+
+
+def netStimTrains(key, gids, rate, noise, start, number, duration):
+    """
+    Spike times of a NetStim with these params on each gid (list of arrays), as NetStim generates them
+
+    First spike at start + noise*interval*E, then intervals of (1-noise)*interval + noise*interval*E;
+    at most number spikes, before duration.
+
+    """
+    interval = 1000.0 / rate
+    noise = min(max(noise, 0.0), 1.0)
+    number = int(min(number, 1e9))
+    if not len(gids) or number <= 0 or start < 0 or start >= duration:
+        return [np.zeros(0) for _ in gids]
+
+    expected = (duration - start) / interval + 1
+    count = int(min(number, expected + 5 * np.sqrt(expected) + 10))  # enough for almost every train at once
+    trains = [[] for _ in gids]
+    last = np.full(len(gids), np.nan)
+    numSpikes = np.zeros(len(gids), dtype=int)
+    pending = np.arange(len(gids))
+    drawn = 0
+    while len(pending):
+        rows = max(1, blockSize // count)
+        for i in range(0, len(pending), rows):
+            idx = pending[i:i + rows]
+            isis = interval * ((1 - noise) + noise * exponentials(key, np.asarray(gids)[idx], drawn, count))
+            if drawn == 0:
+                isis[:, 0] -= interval * (1 - noise)  # first spike at start + noise*interval*E
+                times = start + np.cumsum(isis, axis=1)
+            else:
+                times = last[idx, None] + np.cumsum(isis, axis=1)
+            for row, j in enumerate(idx):
+                keep = times[row][times[row] < duration][:number - numSpikes[j]]
+                trains[j].append(keep)
+                numSpikes[j] += len(keep)
+            last[idx] = times[:, -1]
+        drawn += count
+        pending = pending[(last[pending] < duration) & (numSpikes[pending] < number)]
+    return [np.concatenate(train) for train in trains]
+
+
+###############################################################################
+#
+# DELIVERY
+#
+###############################################################################
+
+def _targetSec(cell, sec):
+    """Section a stim goes to, as CompartCell.addStim resolves it"""
+    if sec in cell.secs:
+        return sec
+    return 'soma' if 'soma' in cell.secs else next(iter(cell.secs), None)
+
+
+class SharedBackground(object):
+    """
+    Context manager around sim.net.addStims() (or netcache.restore()) that collects NetStim stims
+
+    While active, CompartCell.addStim() keeps the params of the NetStim stims it can handle
+    instead of creating them; on exit their trains are generated and delivered (see module doc).
+    Use it outside netcache.StimRecorder, so cached stims are replayed through it too.
+
+    """
+
+    def __init__(self, sources=True):
+        self.sources = sources  # True = all NetStim sources, or list of source labels
+        self.stims = []
+
+    def handles(self, cell, params):
+        if params.get('type') != 'NetStim' or (self.sources is not True and params.get('source') not in self.sources):
+            return False
+        if isinstance(params.get('rate'), str) or isinstance(params.get('sec'), list) or params.get('sec') in cell.secLists:
+            return False
+        return params.get('synsPerConn', 1) in (1, None)
+
+    def __enter__(self):
+        self.addStim = sim.CompartCell.addStim
+        background = self
+
+        def addStim(cell, params):
+            if background.handles(cell, params):
+                background.stims.append((cell, dict(params)))
+                return
+            return background.addStim(cell, params)
+
+        sim.CompartCell.addStim = addStim
+        return self
+
+    def __exit__(self, *args):
+        sim.CompartCell.addStim = self.addStim
+        if args[0] is None:
+            self.create()
+
+    def create(self):
+        """Generate the trains of the collected stims and connect them to their targets"""
+        sim.timing('start', 'bkgTime')
+        numCells = sim.net.lastGid
+        targetLabels = list(sim.net.params.stimTargetParams.keys())
+        duration = sim.cfg.duration
+
+        # a stim target adds one NetStim per synMech: slot = (target, synMech index) has its own source gids
+        maxSynMechs = max([len(target['synMech']) if isinstance(target.get('synMech'), list) else 1
+                           for target in sim.net.params.stimTargetParams.values()] or [1])
+
+        # group stims by slot and NetStim params, to draw their trains together
+        groups = {}
+        numAdded = {}
+        for cell, params in self.stims:
+            index = numAdded.get((params['label'], cell.gid), 0)
+            numAdded[(params['label'], cell.gid)] = index + 1
+            slot = targetLabels.index(params['label']) * maxSynMechs + index
+            rate = params['rate'] if 'rate' in params else 1000.0 / params['interval']
+            group = (slot, params.get('seed', sim.cfg.seeds['stim']), rate, params.get('noise', 0.0),
+                     params.get('start', 0), params.get('number', 1e9))
+            groups.setdefault(group, []).append((cell, params))
+
+        sim.bkgTrains = {}  # pop -> (spike times, source gids) delivered by its PatternStim
+        popEvents = {}
+        numConns = 0
+        for (slot, seed, rate, noise, start, number), stims in groups.items():
+            gids = [cell.gid for cell, _ in stims]
+            label = '%s:%d' % (stims[0][1]['label'], slot % maxSynMechs)
+            trains = netStimTrains(streamKey(label, seed), gids, rate, noise, start, number, duration)
+            sourceBase = numCells * (1 + slot)  # virtual source gids after the cells
+            for (cell, params), train in zip(stims, trains):
+                sourceGid = sourceBase + cell.gid
+                numConns += self.connect(cell, params, sourceGid)
+                events = popEvents.setdefault(cell.tags['pop'], ([], []))
+                events[0].append(train)
+                events[1].append(np.full(len(train), sourceGid, dtype=float))
+
+        sim.bkgStims = []
+        for pop, (times, sources) in popEvents.items():
+            times, sources = np.concatenate(times), np.concatenate(sources)
+            order = np.argsort(times, kind='stable')
+            tvec, gidvec = h.Vector(times[order]), h.Vector(sources[order])
+            patternStim = h.PatternStim()
+            patternStim.fake_output = 0  # deliver to the NetCons of the source gids on this node only
+            patternStim.play(tvec, gidvec)
+            sim.bkgStims.append((patternStim, tvec, gidvec))
+            sim.bkgTrains[pop] = (times[order], sources[order].astype(np.int64))
+        print('  Number of background trains on node %i: %i (%i spikes, %i PatternStims)'
+              % (sim.rank, numConns, sum(len(t) for t, _ in sim.bkgTrains.values()), len(sim.bkgStims)))
+        sim.timing('stop', 'bkgTime')
+
+    def connect(self, cell, params, sourceGid):
+        """Connect a virtual source gid to the synMech of a stim, as the NetStim conn NetPyNE creates"""
+        secLabel = _targetSec(cell, params.get('sec'))
+        loc = params.get('loc') if params.get('loc') is not None else 0.5
+        synMechLabel = params.get('synMech') or next(iter(sim.net.params.synMechParams))
+        weight = params.get('weight')
+        delay = params.get('delay')
+        conn = Dict({'preGid': 'NetStim', 'preLabel': params['source'], 'sec': secLabel, 'loc': loc,
+                     'synMech': synMechLabel, 'weight': sim.net.params.defaultWeight if weight is None else weight,
+                     'delay': sim.net.params.defaultDelay if delay is None else delay,
+                     'synsPerConn': 1, 'label': params['label'], 'preSourceGid': sourceGid})
+        synMech = cell.addSynMech(synMechLabel, secLabel, loc)
+        if sim.cfg.createNEURONObj and synMech:
+            netcon = sim.pc.gid_connect(sourceGid, synMech['hObj'])
+            netcon.weight[0] = conn['weight']
+            netcon.delay = conn['delay']
+            conn['hObj'] = netcon
+        cell.conns.append(conn)
+        return 1
@@ -8,6 +8,7 @@ simConfig is a dict containing a set of simulation configurations using a standa
 Contributors: salvadordura@gmail.com
 """
 
+import simtools  # first: netpyne's analysis then loads only when an analysis runs
 from netpyne import specs, sim
 
 netParams = specs.NetParams()   # object of class NetParams to store the network parameters
@@ -25,7 +26,8 @@ simConfig = specs.SimConfig()   # object of class SimConfig to store the simulat
 
 # Population parameters
 netParams.popParams['PYR_HH'] = {'cellModel': 'HH', 'cellType': 'PYR', 'numCells': 50} # add dict with params for this pop 
-netParams.popParams['PYR_Izhi'] = {'cellModel': 'Izhi', 'cellType': 'PYR', 'numCells': 50} # add dict with params for this pop 
+izhiModel = 'Izhi'  # 'Izhi' (Izhi2007b on a dummy soma) or 'Izhi2007bArt' (section-free ARTIFICIAL_CELL; 2.4x slower for this script, see izhi2007bArt.mod)
+netParams.popParams['PYR_Izhi'] = {'cellModel': izhiModel, 'cellType': 'PYR', 'numCells': 50} # add dict with params for this pop 
 
 
 # Cell parameters list
@@ -52,6 +54,12 @@ cellRule['secs']['soma']['pointps']['Izhi'] = {'mod':'Izhi2007b',
     'C':1, 'k':0.7, 'vr':-60, 'vt':-40, 'vpeak':35, 'a':0.03, 'b':-2, 'c':-50, 'd':100, 'celltype':1}
 netParams.cellParams['PYR_Izhi'] = cellRule  # add dict to list of cell properties
 
+## PYR cell properties (Izhi, section-free ARTIFICIAL_CELL; built-in synapse matches AMPA below)
+## point cells take their params from the pop, not from a cell rule
+if izhiModel == 'Izhi2007bArt':
+    netParams.popParams['PYR_Izhi']['params'] = {'C':1, 'k':0.7, 'vr':-60, 'vt':-40, 'vpeak':35, 'a':0.03, 'b':-2, 'c':-50, 'd':100, 'celltype':1, 
+        'Cm': 0.1, 'tauSyn': 0.1, 'eSyn': 0}
+
 
 # Synaptic mechanism parameters
 netParams.synMechParams['AMPA'] = {'mod': 'ExpSyn', 'tau': 0.1, 'e': 0}
@@ -59,10 +67,15 @@ netParams.synMechParams['AMPA'] = {'mod': 'ExpSyn', 'tau': 0.1, 'e': 0}
 
 # Stimulation parameters
 netParams.stimSourceParams['bkg'] = {'type': 'NetStim', 'rate': 10, 'noise': 0.5}
-netParams.stimTargetParams['bg->PYR_Izhi'] = {'source': 'bkg', 'conds': {'cellType': 'PYR', 'cellModel': 'Izhi'}, 
+netParams.stimTargetParams['bg->PYR_Izhi'] = {'source': 'bkg', 'conds': {'cellType': 'PYR', 'cellModel': izhiModel}, 
                                             'weight': 1, 'delay': 'uniform(1,5)', 'synMech': 'AMPA'}  
 netParams.stimTargetParams['bg->PYR_HH'] = {'source': 'bkg', 'conds': {'cellType': 'PYR', 'cellModel': 'HH'}, 
                                             'weight': 1, 'synMech': 'AMPA', 'sec': 'dend', 'loc': 1.0, 'delay': 'uniform(1,5)'}
+if izhiModel == 'Izhi2007bArt':  # NetPyNE does not add stims to point cells, so drive them from a NetStim pop instead
+    numIzhi = netParams.popParams['PYR_Izhi']['numCells']
+    netParams.popParams['bkg_Izhi'] = {'cellModel': 'NetStim', 'numCells': numIzhi, 'rate': 10, 'noise': 0.5}
+    netParams.connParams['bg->PYR_Izhi'] = {'preConds': {'pop': 'bkg_Izhi'}, 'postConds': {'pop': 'PYR_Izhi'}, 
+                                            'connList': [[i, i] for i in range(numIzhi)], 'weight': 1, 'delay': 'uniform(1,5)'}
 
 
 # Connectivity parameters
@@ -84,6 +97,7 @@ netParams.connParams['PYR->PYR'] = {
 # Simulation parameters
 simConfig.duration = 1*1e3 # Duration of the simulation, in ms
 simConfig.dt = 0.025 # Internal integration timestep to use
+simConfig.localDt = False # Use CVODE with local variable time step (if all populations support it)
 simConfig.seeds = {'conn': 1, 'stim': 1, 'loc': 1} # Seeds for randomizers (connectivity, input stimulation and cell locations)
 simConfig.createNEURONObj = True  # create HOC objects when instantiating network
 simConfig.createPyStruct = True  # create Python structure (simulator-independent) when instantiating network
@@ -117,4 +131,4 @@ simConfig.analysis['plotTraces'] = {'include': [1,51]} # plot recorded traces fo
 simConfig.analysis['plotRatePSD'] = {'include': ['allCells', 'PYR_HH', 'PYR_Izhi'], 'smooth': 10} # plot recorded traces for this list of cells
 
 # Run simulation
-sim.createSimulateAnalyze(netParams=netParams, simConfig=simConfig)  # create and simulate network
\ No newline at end of file
+simtools.createSimulateAnalyze(netParams=netParams, simConfig=simConfig)  # create and simulate network
\ No newline at end of file
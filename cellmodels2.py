@@ -8,6 +8,7 @@ simConfig is a dict containing a set of simulation configurations using a standa
 Contributors: salvadordura@gmail.com
 """
 
+import simtools  # first: netpyne's analysis then loads only when an analysis runs
 from netpyne import specs, sim
 
 netParams = specs.NetParams()   # object of class NetParams to store the network parameters
@@ -25,6 +26,7 @@ simConfig = specs.SimConfig()   # object of class SimConfig to store the simulat
 
 
 which = 'h-h'
+backend = 'neuron'  # 'neuron' or 'numpy' (vectorized Izhi2007b engine in izhipop.py; only for which = 'izhi')
 
 # Population parameters
 if which == 'izhi':
@@ -97,6 +99,7 @@ netParams.connParams['PYR->PYR'] = {
 # Simulation parameters
 simConfig.duration = 5*1e3 # Duration of the simulation, in ms
 simConfig.dt = 0.025 # Internal integration timestep to use
+simConfig.localDt = False # Use CVODE with local variable time step (if all populations support it)
 simConfig.seeds = {'conn': 1, 'stim': 1, 'loc': 1} # Seeds for randomizers (connectivity, input stimulation and cell locations)
 simConfig.createNEURONObj = True  # create HOC objects when instantiating network
 simConfig.createPyStruct = True  # create Python structure (simulator-independent) when instantiating network
@@ -130,4 +133,8 @@ simConfig.analysis['plotTraces'] = {'include': [1,51]} # plot recorded traces fo
 simConfig.analysis['plotRatePSD'] = {'include': ['allCells', 'PYR'], 'smooth': 10} # plot recorded traces for this list of cells
 
 # Run simulation
-sim.createSimulateAnalyze(netParams=netParams, simConfig=simConfig)  # create and simulate network
\ No newline at end of file
+if backend == 'numpy':
+    import izhipop
+    izhipop.createSimulateAnalyze(netParams=netParams, simConfig=simConfig)  # create and simulate network with NumPy arrays
+else:
+    simtools.createSimulateAnalyze(netParams=netParams, simConfig=simConfig)  # create and simulate network
\ No newline at end of file
@@ -0,0 +1,342 @@
+"""
+checkpoint.py
+
+Checkpoints of the dynamic state of a simulation: save, resume and fork
+
+A checkpoint holds, per MPI rank, NEURON's SaveState (membrane potentials, STATE
+variables of every mechanism, and the event queue with the NetCon events in flight)
+plus what SaveState leaves out:
+  - variables changed at run time that are not STATEs (extraVars: Izhi2007b derivtype
+    and, for TC/RTN cells, b; the internal state of Izhi2007bArt)
+  - the position of the Random123 stream of every NetStim
+  - the number of spikes each shared background PatternStim (bkgtrains.py) has sent:
+    it sends them ahead of their times, in groups, so the events in flight are in the
+    saved queue; tasks() records the sends through the NetCons of its source gids
+  - the data recorded so far (spikes, traces, stims), and the spike statistics (spikestats.py)
+Restoring it right after initialization continues the run from the checkpoint time,
+with the same results as a run that never stopped. The network has to be built the
+same way (same netParams structure and number of ranks); parameters that are not state
+(weights, delays, stim rates, mechanism params) can differ, to fork runs from an
+equilibrated state; NetCon weights and point process params (which SaveState also
+restores) are always those of the current netParams, except the b switched at run
+time by TC/RTN Izhi cells.
+
+Checkpoints are directories with state_<rank>_<nhosts>.dat and meta_<rank>_<nhosts>.pkl
+and a 'complete' marker written once all ranks have saved:
+  <checkpointDir>/<filename>_t<time>  - at simConfig.checkpointTimes
+  <checkpointDir>/<run key>/t<time>   - every checkpointInterval ms; only the latest is
+                                        kept, and a rerun of the same run (same netParams
+                                        and simConfig except duration) resumes from it.
+                                        Removed when the run completes.
+With streamed traces or envelope traces (tracestore.py, recplan.py) only the spikes
+recorded before the checkpoint are restored; traces start at the checkpoint time.
+
+Usage:
+  simConfig.checkpointTimes = [500]  # ms; used by simtools
+  simConfig.checkpointInterval = 1000  # ms; periodic checkpoints to resume killed runs
+  simConfig.checkpointDir = 'checkpoints'
+  simConfig.restoreCheckpoint = 'checkpoints/networkgeom_t500'  # start from a checkpoint
+  simConfig.restoreData = True  # resume with the data recorded before it; False = fork (data from the checkpoint on)
+
+"""
+
+import glob
+import json
+import os
+import pickle
+import shutil
+import time
+
+from netpyne import sim
+from neuron import h
+
+import jsonkey
+
+checkpointDir = 'checkpoints'
+
+# variables that change during the run but are not STATEs, so SaveState does not save them
+extraVars = {'Izhi2007b': ['derivtype', 'b'],
+             'Izhi2007bArt': ['V', 'u', 'g', 'gNext', 'derivtype', 'above', 'below', 'tlast', 'idle', 'b']}
+bSwitched = (6, 7)  # celltypes (TC, RTN) whose b is switched at run time; elsewhere b is a param, left as set
+
+# simConfig options that do not change the state of a run (left out of the run key)
+runKeyIgnore = ['duration', 'tstop', 'checkpointTimes', 'checkpointInterval', 'checkpointDir', 'restoreCheckpoint',
+                'restoreData', 'monitors', 'monitorStep', 'analysis', 'verbose', 'timing', 'profile', 'filename',
+                'saveFolder']
+
+
+###############################################################################
+#
+# FILES
+#
+###############################################################################
+
+def _files(path):
+    suffix = '%d_%d' % (sim.rank, sim.nhosts)
+    return os.path.join(path, 'state_%s.dat' % suffix), os.path.join(path, 'meta_%s.pkl' % suffix)
+
+
+def isComplete(path):
+    return os.path.exists(os.path.join(path, 'complete'))
+
+
+def runKey():
+    """Hash of the netParams and simConfig of the current run, except options that do not change its state"""
+    cfg = {key: value for key, value in sim.cfg.__dict__.items() if key not in runKeyIgnore}
+    content = {'netParams': sim.net.params.todict(), 'cfg': cfg, 'nhosts': sim.nhosts}
+    return jsonkey.hashKey(content)
+
+
+def runDir():
+    """Directory of the periodic checkpoints of the current run"""
+    return os.path.join(getattr(sim.cfg, 'checkpointDir', checkpointDir), runKey())
+
+
+def latest(directory):
+    """Latest complete checkpoint in a directory of periodic checkpoints, or None"""
+    paths = [path for path in glob.glob(os.path.join(directory, 't*')) if isComplete(path)]
+    return max(paths, key=lambda path: float(os.path.basename(path)[1:])) if paths else None
+
+
+###############################################################################
+#
+# SAVE
+#
+###############################################################################
+
+def _recordedVectors():
+    """(key path, h.Vector) of every vector of sim.simData (spikes, t, traces, stims)"""
+    def walk(path, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                for result in walk(path + (key,), item):
+                    yield result
+        elif hasattr(value, 'as_numpy'):
+            yield path, value
+    return list(walk((), sim.simData))
+
+
+def _structure():
+    """Counts that have to match for SaveState to restore a checkpoint on this rank"""
+    counts = {'segments': sum(sec.nseg for sec in h.allsec())}
+    synMods = [params.get('mod') for params in sim.net.params.synMechParams.values()]
+    for name in ['NetCon', 'NetStim', 'PatternStim'] + list(extraVars) + sorted(set(synMods) - {None}):
+        if hasattr(h, name):
+            counts[name] = len(h.List(name))
+    return counts
+
+
+def _partialTraces():
+    """Whether trace vectors only hold the data since the last flush (streamed or envelope traces)"""
+    plan = getattr(sim, 'recordPlan', None)
+    return bool(getattr(sim, 'traceStore', None) or (plan and plan.envelopes))
+
+
+def save(path):
+    """Save the state of every rank at the current time to the checkpoint directory path (all ranks)"""
+    sim.timing('start', 'checkpointTime')
+    os.makedirs(path, exist_ok=True)
+    stateFile, metaFile = _files(path)
+    state = h.SaveState()
+    state.save()
+    stateFile_ = h.File()
+    stateFile_.wopen(stateFile + '.tmp')
+    state.fwrite(stateFile_)  # closes the file
+
+    partial = _partialTraces()
+    data = {key: vec.as_numpy().copy() for key, vec in _recordedVectors()
+            if not partial or key[0] in ('spkt', 'spkid')}
+    meta = {'t': h.t, 'nhosts': sim.nhosts, 'structure': _structure(),
+            'mechs': {mech: [[getattr(obj, name) for name in names] for obj in h.List(mech)]
+                      for mech, names in extraVars.items() if hasattr(h, mech)},
+            'netStims': [netStim.ranvar.get_seq() for netStim in h.List('NetStim')],
+            'bkgSent': _sentCounts(),
+            'data': data, 'spikeStats': getattr(sim, 'spikeStats', None),
+            'numSpikesDropped': getattr(sim, 'numSpikesDropped', 0)}
+    with open(metaFile + '.tmp', 'wb') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(stateFile + '.tmp', stateFile)
+    os.replace(metaFile + '.tmp', metaFile)
+
+    sim.pc.barrier()
+    if sim.rank == 0:
+        with open(os.path.join(path, 'complete'), 'w') as f:
+            json.dump({'t': h.t, 'nhosts': sim.nhosts, 'date': time.strftime('%Y-%m-%d %H:%M:%S')}, f)
+        print('  Checkpoint at t = %g ms saved to %s' % (h.t, path))
+    sim.pc.barrier()
+    sim.timing('stop', 'checkpointTime')
+
+
+def savePeriodic(simTime=None):
+    """Save a periodic checkpoint of the current run and remove the previous one"""
+    directory = runDir()
+    previous = glob.glob(os.path.join(directory, 't*'))
+    save(os.path.join(directory, 't%g' % round(h.t, 6)))
+    if sim.rank == 0:
+        for path in previous:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def saveNamed(simTime=None):
+    """Save a checkpoint at one of simConfig.checkpointTimes"""
+    name = '%s_t%g' % (os.path.basename(sim.cfg.filename), round(h.t, 6))
+    save(os.path.join(getattr(sim.cfg, 'checkpointDir', checkpointDir), name))
+
+
+def tasks():
+    """Tasks of runloop.runSim() that save the checkpoints requested in sim.cfg (call once per run, before it)"""
+    tasks = []
+    times = sorted(getattr(sim.cfg, 'checkpointTimes', None) or [])
+    if times:
+        tasks.append((iter(times), saveNamed, False))
+    interval = getattr(sim.cfg, 'checkpointInterval', None)
+    if interval:
+        import runloop
+        tasks.append((runloop.every(interval), savePeriodic, False))
+    sim.bkgSent = _recordSent() if tasks else None
+    return tasks
+
+
+def _recordSent():
+    """
+    Record the spikes sent by each shared background PatternStim: [[vector, offset]] per sim.bkgStims
+
+    NetCon.record() on a source gid records each of its spikes when the PatternStim sends
+    it (ahead of its time); the PatternStim has sent offset + vector.size() spikes of its
+    trains (offset: the spikes skipped by a restore).
+
+    """
+    netCons = {}
+    for cell in sim.net.cells:
+        for conn in cell.conns:
+            if 'preSourceGid' in conn and conn.get('hObj') is not None:
+                netCons.setdefault(conn['preSourceGid'], conn['hObj'])
+    sent = []
+    for patternStim, tvec, gidvec in getattr(sim, 'bkgStims', None) or []:
+        vec = h.Vector()
+        for gid in set(int(gid) for gid in gidvec):
+            if gid in netCons:
+                netCons[gid].record(vec)  # one per source gid: the record vector is the one of its PreSyn
+        sent.append([vec, 0])
+    return sent
+
+
+def _sentCounts():
+    """Number of spikes each shared background PatternStim has sent so far"""
+    stims = getattr(sim, 'bkgStims', None) or []
+    sent = getattr(sim, 'bkgSent', None)
+    if stims and (sent is None or len(sent) != len(stims)):
+        raise ValueError('The spikes sent by the background PatternStims are not recorded (see checkpoint.tasks())')
+    return [offset + int(vec.size()) for vec, offset in sent or []]
+
+
+###############################################################################
+#
+# RESTORE
+#
+###############################################################################
+
+def _pointParams():
+    """PARAMETER values of every point process ([(object, {name: value})]), which SaveState also restores"""
+    values = []
+    mechs, mech = h.MechanismType(1), h.ref('')
+    for i in range(int(mechs.count())):
+        mechs.select(i)
+        mechs.selected(mech)
+        objs = list(h.List(mech[0]))
+        if not objs:
+            continue
+        standard, name = h.MechanismStandard(mech[0], 1), h.ref('')
+        names = [name[0] for j in range(int(standard.count())) if standard.name(name, j) == 1]  # scalars only
+        values += [(obj, {name: getattr(obj, name) for name in names}) for obj in objs]
+    return values
+
+
+def restore(path, data=True):
+    """
+    Set the state of every rank to the checkpoint at path (all ranks; call right after initialization)
+
+    data: also restore the data recorded before the checkpoint (resume); otherwise the
+    recorded data start at the checkpoint time (fork).
+
+    """
+    if not isComplete(path):
+        raise IOError('%s is not a complete checkpoint' % path)
+    stateFile, metaFile = _files(path)
+    if not os.path.exists(metaFile):
+        raise IOError('%s was not saved with %d ranks' % (path, sim.nhosts))
+    with open(metaFile, 'rb') as f:
+        meta = pickle.load(f)
+    if meta['structure'] != _structure():
+        raise ValueError('%s was saved from a network with a different structure (%s, here %s)'
+                         % (path, meta['structure'], _structure()))
+
+    netCons = list(h.List('NetCon'))
+    weights = [netCon.weight[0] for netCon in netCons]
+    params = _pointParams()
+    state = h.SaveState()
+    stateFile_ = h.File()
+    stateFile_.ropen(stateFile)
+    state.fread(stateFile_)  # closes the file
+    state.restore()  # also sets h.t
+    for netCon, weight in zip(netCons, weights):
+        netCon.weight[0] = weight  # SaveState also restores weights; keep those of the current netParams
+    for obj, values in params:
+        for name, value in values.items():
+            setattr(obj, name, value)  # and point process params (NetStim interval, synMech tau, Izhi a/b...)
+
+    for mech, values in meta['mechs'].items():
+        names = extraVars[mech]
+        for obj, objValues in zip(h.List(mech), values):
+            for name, value in zip(names, objValues):
+                if name != 'b' or obj.celltype in bSwitched:
+                    setattr(obj, name, value)
+    for netStim, seq in zip(h.List('NetStim'), meta['netStims']):
+        netStim.ranvar.set_seq(seq)
+
+    # shared background trains (bkgtrains.py): the PatternStims go on from the first spike they had not sent
+    sent = getattr(sim, 'bkgSent', None)
+    for i, (patternStim, tvec, gidvec) in enumerate(getattr(sim, 'bkgStims', None) or []):
+        first = meta['bkgSent'][i]
+        tvec, gidvec = h.Vector(tvec.as_numpy()[first:]), h.Vector(gidvec.as_numpy()[first:])
+        patternStim.play(tvec, gidvec)
+        patternStim.initps()  # play() keeps the index of the old vectors
+        sim.bkgStims[i] = (patternStim, tvec, gidvec)
+        if sent:
+            sent[i][0].resize(0)  # sent at initialization, replaced by the restored queue
+            sent[i][1] = first
+
+    if getattr(sim, 'spikeStats', None):  # spikestats.py
+        if data and meta.get('spikeStats'):
+            sim.spikeStats, sim.numSpikesDropped = meta['spikeStats'], meta['numSpikesDropped']
+        else:
+            import spikestats
+            sim.spikeStats, sim.numSpikesDropped = spikestats.SpikeStats(sim.spikeStats.binSize, start=h.t), 0
+    for key, vec in _recordedVectors():
+        if data and key in meta['data']:
+            vec.from_python(meta['data'][key])
+        else:
+            vec.resize(0)  # drop the sample recorded at initialization
+    if sim.rank == 0:
+        print('  Restored checkpoint %s at t = %g ms%s' % (path, h.t, '' if data else ' (recorded data start here)'))
+
+
+def restoreFunc():
+    """Function that restores the checkpoint sim.cfg asks for (restoreCheckpoint, or the latest periodic one), or None"""
+    path = getattr(sim.cfg, 'restoreCheckpoint', None)
+    data = getattr(sim.cfg, 'restoreData', True)
+    if not path and getattr(sim.cfg, 'checkpointInterval', None):
+        path = latest(runDir()) if sim.rank == 0 else None
+        path = sim.pc.py_broadcast(path, 0)
+        data = True
+    if not path:
+        return None
+    return lambda: restore(path, data)
+
+
+def finish():
+    """Remove the periodic checkpoints of a run that completed (or was stopped by a monitor)"""
+    if getattr(sim.cfg, 'checkpointInterval', None):
+        sim.pc.barrier()
+        if sim.rank == 0:
+            shutil.rmtree(runDir(), ignore_errors=True)
@@ -0,0 +1,341 @@
+"""
+colstore.py
+
+Columnar binary output: spikes, traces, cells and connections as raw arrays on disk
+
+NetPyNE's save formats (savePickle, saveJson, saveMat, saveTxt, saveDpk) serialize the
+nested dicts of the output, with a Python object per spike, sample and connection:
+slow to write, several times larger than the data, and loaded whole. Here each field
+is a column of one dtype in its own raw file, in a directory <filename>_data.col:
+  header.json        - netParams, simConfig, pops, the small simData entries (popRates,
+                       avgRate, spikeStats...), the labels of coded columns and the
+                       dtype and length of every column
+  spkt.bin, spkid.bin                        - float64, int32
+  <trace>.bin                                - float32 blocks of recorded rows x samples: a row
+                                               per cell, or per synapse for traces recorded
+                                               per synapse (their keys in the header)
+  stim_t, stim_gid, stim_label               - spikes of the cell stims (recordStim)
+  cell_gid, cell_pop, cell_x, cell_y, cell_z - int32, int16 (code), float32
+  conn_post, conn_pre, conn_weight, conn_delay, conn_loc, conn_sec, conn_synMech,
+  conn_label                                 - int32 (pre -1: stims), float64, float32, int16 codes
+Columns are appended in chunks (Writer.append; traces as blocks of up to saveFileStep ms
+of all recorded cells, Writer.appendBlock), and read as np.memmap views without loading
+the rest of the file. The header is rewritten by Writer.flush() and on close.
+Cell sections and stim params are not saved; they follow from netParams.
+
+Usage:
+  simConfig.saveColumnar = True  # used by simtools, in addition to the other save options
+
+  import colstore
+  data = colstore.load('networkgeom_data.col')
+  spkt, spkid = data.spikes()  # memory-mapped
+  v = data.trace('V', gid=1)
+  conns = data.conns()  # {'post': ..., 'pre': ..., 'weight': ..., 'synMech': codes}; data.labels('conn_synMech')
+
+"""
+
+import json
+import os
+
+import numpy as np
+from netpyne import sim
+
+import jsonkey
+
+version = 1
+traceDtype = np.float32
+codeDtype = np.int16
+
+
+def filePath(simConfig=None):
+    """Directory of the columnar output of the current simulation (next to the other saved files)"""
+    cfg = simConfig or sim.cfg
+    path = cfg.filename + '_data'
+    if getattr(cfg, 'saveFolder', None):
+        path = os.path.join(cfg.saveFolder, (getattr(cfg, 'simLabel', None) or cfg.filename) + '_data')
+    return path + '.col'
+
+
+def _codes(values):
+    """(int16 codes, labels) of a sequence of labels"""
+    labels = sorted(set(values), key=str)
+    index = {label: i for i, label in enumerate(labels)}
+    return np.array([index[value] for value in values], dtype=codeDtype), labels
+
+
+###############################################################################
+#
+# WRITING
+#
+###############################################################################
+
+class Writer(object):
+    """
+    Writer of a columnar directory; columns are created by their first append
+
+    mode 'w' starts a new directory (removing the columns of an earlier one), 'a' appends to
+    an existing one. Use as a context manager, or call close().
+
+    """
+
+    def __init__(self, path, meta=None, mode='w'):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.header = {'format': 'colstore', 'version': version, 'meta': {}, 'columns': {}}
+        if mode == 'a' and os.path.exists(os.path.join(path, 'header.json')):
+            with open(os.path.join(path, 'header.json')) as f:
+                self.header = json.load(f)
+        else:
+            for name in os.listdir(path):
+                if name.endswith('.bin'):
+                    os.remove(os.path.join(path, name))
+        self.header['meta'].update(meta or {})
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+    def _write(self, name, values):
+        with open(self._file(name), 'ab') as f:
+            f.write(np.ascontiguousarray(values).tobytes())
+
+    def append(self, name, values, dtype=None):
+        """Append values to the 1D column name (dtype: that of the column, or of the first values)"""
+        column = self.header['columns'].setdefault(name, {'kind': 'rows', 'length': 0,
+                                                          'dtype': np.dtype(dtype or np.asarray(values).dtype).str})
+        values = np.asarray(values, dtype=column['dtype']).ravel()
+        self._write(name, values)
+        column['length'] += len(values)
+
+    def appendBlock(self, name, block, dtype=traceDtype):
+        """Append a block (rows x samples) to the block column name; every block has the same rows"""
+        block = np.asarray(block)
+        column = self.header['columns'].setdefault(name, {'kind': 'blocks', 'width': block.shape[0], 'blocks': [],
+                                                          'dtype': np.dtype(dtype).str})
+        if block.shape[0] != column['width']:
+            raise ValueError('Block of %d rows appended to column %s of %d rows' % (block.shape[0], name, column['width']))
+        self._write(name, block.astype(column['dtype'], copy=False))
+        column['blocks'].append(block.shape[1])
+
+    def flush(self):
+        """Write the header (data appended before it are then readable)"""
+        headerFile = os.path.join(self.path, 'header.json')
+        with open(headerFile + '.tmp', 'w') as f:
+            json.dump(self.header, f, default=jsonkey.jsonDefault)
+        os.replace(headerFile + '.tmp', headerFile)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _traceRows(cells):
+    """(gids, keys, arrays) of the rows of a trace: one per cell, or one per synapse (key) for traces that are dicts"""
+    gids, keys, arrays = [], [], []
+    for gid in sorted(cells):
+        values = cells[gid]
+        for key, array in (sorted(values.items(), key=lambda item: str(item[0])) if isinstance(values, dict)
+                           else [(None, values)]):
+            gids.append(gid)
+            keys.append(key)
+            arrays.append(np.asarray(array))
+    return gids, keys, arrays
+
+
+def _connFields(conn):
+    """Conn dict of a gathered cell (also in compactConnFormat)"""
+    if isinstance(conn, dict):
+        return conn
+    return dict(zip(sim.cfg.compactConnFormat, conn))
+
+
+def save(path=None, blockSize=None, traceDtype=traceDtype):
+    """
+    Save the gathered output (sim.allSimData, sim.net.allCells) of rank 0 to the directory path
+
+    blockSize: samples per trace block (default: saveFileStep ms of samples), to keep the
+    copy of streamed traces to float32 bounded. traceDtype: np.float64 keeps the traces
+    at the precision NEURON records them.
+
+    """
+    if sim.rank != 0:
+        return
+    path = path or filePath()
+    print('Saving output as %s ... ' % path)
+    simData = sim.allSimData
+    traces = [trace for trace in sim.cfg.recordTraces if trace in simData]
+    plan = getattr(sim, 'recordPlan', None)
+    skip = set(['spkt', 'spkid', 'stims', 't'] + traces)
+    meta = {'netpyne_version': sim.version(show=False),
+            'netParams': sim.net.params.todict(),
+            'simConfig': {key: value for key, value in sim.cfg.__dict__.items() if key not in ['_runner']},
+            'pops': {label: pop.get('tags', {}) for label, pop in getattr(sim.net, 'allPops', {}).items()},
+            'simData': {key: value for key, value in simData.items() if key not in skip},
+            'traces': {}, 'labels': {}}
+    blockSize = blockSize or max(int(round(sim.cfg.saveFileStep / sim.cfg.recordStep)), 1)
+
+    with Writer(path, meta) as writer:
+        writer.append('spkt', simData.get('spkt', []), np.float64)
+        writer.append('spkid', simData.get('spkid', []), np.int32)
+
+        for trace in traces:
+            cells = {int(key[len('cell_'):]): values for key, values in simData[trace].items() if key.startswith('cell_')}
+            gids, keys, arrays = _traceRows(cells)
+            if not gids:  # no recorded cell has it (e.g. u of HH cells)
+                continue
+            numSamples = max(len(array) for array in arrays)
+            meta['traces'][trace] = {'gids': gids, 'numSamples': numSamples, 'recordStep': sim.cfg.recordStep,
+                                     'reduction': plan.reduction[trace] if plan and trace in plan.reduction else None}
+            if any(key is not None for key in keys):
+                meta['traces'][trace]['keys'] = keys
+            for start in range(0, numSamples, blockSize):
+                block = np.zeros((len(arrays), min(blockSize, numSamples - start)), dtype=traceDtype)
+                for row, array in enumerate(arrays):
+                    values = array[start:start + block.shape[1]]
+                    block[row, :len(values)] = values
+                writer.appendBlock(trace, block, traceDtype)
+
+        stimT, stimGid, stimLabel = [], [], []
+        for key, stims in simData.get('stims', {}).items():
+            for label, times in stims.items():
+                stimT.append(np.asarray(times, dtype=np.float64))
+                stimGid += [int(key[len('cell_'):])] * len(times)
+                stimLabel += [label] * len(times)
+        codes, meta['labels']['stim_label'] = _codes(stimLabel)
+        writer.append('stim_t', np.concatenate(stimT) if stimT else [], np.float64)
+        writer.append('stim_gid', stimGid, np.int32)
+        writer.append('stim_label', codes, codeDtype)
+
+        cells = getattr(sim.net, 'allCells', [])
+        writer.append('cell_gid', [cell['gid'] for cell in cells], np.int32)
+        codes, meta['labels']['cell_pop'] = _codes([cell['tags'].get('pop') for cell in cells])
+        writer.append('cell_pop', codes, codeDtype)
+        for coord in ['x', 'y', 'z']:
+            writer.append('cell_' + coord, [cell['tags'].get(coord, np.nan) for cell in cells], np.float32)
+
+        conns = [(cell['gid'], _connFields(conn)) for cell in cells for conn in cell.get('conns', [])]
+        writer.append('conn_post', [post for post, _ in conns], np.int32)
+        writer.append('conn_pre', [conn.get('preGid') if isinstance(conn.get('preGid'), (int, np.integer)) else -1
+                                   for _, conn in conns], np.int32)
+        for name, dtype in [('weight', np.float64), ('delay', np.float64), ('loc', np.float32)]:
+            values = [conn.get(name, np.nan) for _, conn in conns]
+            writer.append('conn_' + name, [value if np.isscalar(value) else np.nan for value in values], dtype)
+        for name in ['sec', 'synMech', 'label']:
+            codes, meta['labels']['conn_' + name] = _codes([conn.get(name, conn.get('preLabel')) if name == 'label'
+                                                            else conn.get(name) for _, conn in conns])
+            writer.append('conn_' + name, codes, codeDtype)
+    print('Finished saving!')
+
+
+###############################################################################
+#
+# READING
+#
+###############################################################################
+
+class ColStore(object):
+    """
+    Columnar output read lazily from disk
+
+    Attributes
+    ----------
+    header : dict
+        Columns and metadata (header['meta']: netParams, simConfig, pops, simData, traces, labels).
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'header.json')) as f:
+            self.header = json.load(f)
+        self.meta = self.header['meta']
+
+    @property
+    def netParams(self):
+        return self.meta.get('netParams')
+
+    @property
+    def simConfig(self):
+        return self.meta.get('simConfig')
+
+    def _map(self, name, offset, shape):
+        dtype = np.dtype(self.header['columns'][name]['dtype'])
+        if not np.prod(shape):
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name + '.bin'), dtype=dtype, mode='r', offset=offset, shape=shape)
+
+    def column(self, name):
+        """np.memmap of a 1D column"""
+        return self._map(name, 0, (self.header['columns'][name]['length'],))
+
+    def blocks(self, name):
+        """np.memmap views of the blocks (rows x samples) of a block column"""
+        column = self.header['columns'][name]
+        itemsize = np.dtype(column['dtype']).itemsize
+        views, offset = [], 0
+        for numSamples in column['blocks']:
+            views.append(self._map(name, offset, (column['width'], numSamples)))
+            offset += column['width'] * numSamples * itemsize
+        return views
+
+    def labels(self, name):
+        """Labels of the codes of a coded column (cell_pop, conn_synMech...)"""
+        return self.meta['labels'][name]
+
+    def spikes(self):
+        """(spkt, spkid) memory-mapped"""
+        return self.column('spkt'), self.column('spkid')
+
+    @property
+    def traces(self):
+        return list(self.meta['traces'])
+
+    def _row(self, trace, row):
+        blocks = [block[row] for block in self.blocks(trace)]
+        if len(blocks) == 1:
+            return blocks[0]
+        return np.concatenate(blocks) if blocks else np.zeros(0, dtype=traceDtype)
+
+    def trace(self, trace, gid):
+        """Samples of a trace of a cell, or {synapse key: samples} if recorded per synapse; views if written in one block"""
+        info = self.meta['traces'][trace]
+        rows = [row for row, rowGid in enumerate(info['gids']) if rowGid == gid]
+        if not rows:
+            raise ValueError('Trace %s of cell %d was not saved' % (trace, gid))
+        keys = info.get('keys')
+        if keys is None or keys[rows[0]] is None:
+            return self._row(trace, rows[0])
+        return {keys[row]: self._row(trace, row) for row in rows}
+
+    def cells(self):
+        return {name[len('cell_'):]: self.column(name) for name in self.header['columns'] if name.startswith('cell_')}
+
+    def conns(self):
+        return {name[len('conn_'):]: self.column(name) for name in self.header['columns'] if name.startswith('conn_')}
+
+    def toSimData(self):
+        """Dict in the layout of sim.allSimData (spikes memory-mapped, traces per cell, stims, small entries)"""
+        spkt, spkid = self.spikes()
+        simData = dict(self.meta['simData'])
+        simData.update({'spkt': spkt, 'spkid': spkid})
+        for trace, info in self.meta['traces'].items():
+            simData[trace] = {'cell_%d' % gid: self.trace(trace, gid) for gid in sorted(set(info['gids']))}
+        if self.meta['traces']:
+            info = list(self.meta['traces'].values())[0]
+            simData['t'] = np.arange(info['numSamples']) * info['recordStep']
+        stims = {}
+        labels = self.labels('stim_label')
+        stimT, stimGid, stimLabel = self.column('stim_t'), self.column('stim_gid'), self.column('stim_label')
+        for t, gid, code in zip(stimT, stimGid, stimLabel):
+            stims.setdefault('cell_%d' % gid, {}).setdefault(labels[code], []).append(float(t))
+        simData['stims'] = stims
+        return simData
+
+
+def load(path):
+    """Columnar output saved by save() or a Writer"""
+    return ColStore(path)
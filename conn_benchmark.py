@@ -0,0 +1,110 @@
+"""
+conn_benchmark.py
+
+Benchmark of connectivity building: NetPyNE's connectCells() vs connbuild
+
+Builds the PYR->PYR rule of cellmodels.py (convergence 'uniform(0,5)', delay
+'0.2+normal(13.0,1.4)') and the S->M rule of tut3.py (probability 0.5) at increasing
+numCells, and reports for each:
+  netpyne - sim.net.connectCells() (current path)
+  vector  - connbuild.connectCells() (bulk tables + cell.addConn)
+  table   - connbuild.buildRule() alone (generation of the CSR table)
+  speedup - netpyne / vector: what replacing sim.net.connectCells() gains
+Cells are created without NEURON objects (createNEURONObj = False), so the times only
+cover building the connections, which is the part that differs between the two paths.
+The table time leaves out cell.addConn(), where most of the vector time goes, so it
+is not a speedup of the connectivity step, only of generating the conns; above
+maxNumCellsNetPyNE only the table is built (from generated cell tags).
+
+Usage: python conn_benchmark.py [maxNumCells]
+"""
+
+import sys
+import time
+
+import numpy as np
+from netpyne import specs, sim
+
+import connbuild
+
+numCellsList = [250, 500, 1000, 2000, 4000, 10000, 30000, 100000]  # cells per population
+maxNumCellsNetPyNE = 2000  # larger sizes take minutes with the current path
+maxConns = 5e7  # skip table sizes expected to need more memory than this many connections
+
+# rules and their populations (label: (pops, connParam, expected conns per cell))
+rules = {
+    'PYR->PYR': (['PYR'], {
+        'preConds': {'cellType': 'PYR'}, 'postConds': {'cellType': 'PYR'},
+        'weight': 0.2, 'delay': '0.2+normal(13.0,1.4)', 'convergence': 'uniform(0,5)', 'synMech': 'AMPA'}, 2.5),
+    'S->M': (['S', 'M'], {
+        'preConds': {'pop': 'S'}, 'postConds': {'pop': 'M'},
+        'probability': 0.5, 'weight': 0.01, 'delay': 5, 'sec': 'dend', 'loc': 1.0, 'synMech': 'AMPA'}, None)}
+
+
+def makeNet(pops, connLabel, connParam, numCells):
+    netParams = specs.NetParams()
+    for pop in pops:
+        netParams.popParams[pop] = {'cellType': 'PYR', 'cellModel': 'HH', 'numCells': numCells}
+    cellRule = {'conds': {'cellType': 'PYR'}, 'secs': {}}
+    cellRule['secs']['soma'] = {'geom': {'diam': 18.8, 'L': 18.8, 'Ra': 123.0}, 'mechs': {'hh': {}}}
+    cellRule['secs']['dend'] = {'geom': {'diam': 5.0, 'L': 150.0, 'Ra': 150.0, 'cm': 1},
+                                'topol': {'parentSec': 'soma', 'parentX': 1.0, 'childX': 0}, 'mechs': {'pas': {}}}
+    netParams.cellParams['PYRrule'] = cellRule
+    netParams.synMechParams['AMPA'] = {'mod': 'ExpSyn', 'tau': 0.1, 'e': 0}
+    netParams.connParams[connLabel] = dict(connParam)
+
+    simConfig = specs.SimConfig()
+    simConfig.createNEURONObj = False
+    simConfig.verbose = False
+    simConfig.timing = False
+    simConfig.progressBar = 0
+    simConfig.seeds['conn'] = 1
+    return netParams, simConfig
+
+
+def timeConnect(connect, pops, connLabel, connParam, numCells):
+    """Create the cells of a network with a single rule, then time connect(); return (seconds, number of conns)"""
+    netParams, simConfig = makeNet(pops, connLabel, connParam, numCells)
+    sim.initialize(netParams, simConfig)
+    sim.net.createPops()
+    sim.net.createCells()
+    start = time.time()
+    connect()
+    return time.time() - start, sum(len(cell.conns) for cell in sim.net.cells)
+
+
+def timeTable(pops, connLabel, connParam, numCells):
+    """Time buildRule() on generated cell tags; return (seconds, number of conns)"""
+    rng = np.random.default_rng(0)
+    cellsTags = {}
+    for pop in pops:
+        for i in range(numCells):
+            x, y, z = rng.random(3) * 100
+            cellsTags[len(cellsTags)] = {'pop': pop, 'cellType': 'PYR', 'x': x, 'y': y, 'z': z,
+                                         'xnorm': x/100, 'ynorm': y/100, 'znorm': z/100}
+    connParam = dict(connParam, label=connLabel)
+    preCellsTags, postCellsTags = [{gid: tags for gid, tags in cellsTags.items()
+                                    if all(tags.get(k) == v for k, v in conds.items())}
+                                   for conds in (connParam['preConds'], connParam['postConds'])]
+    start = time.time()
+    table = connbuild.buildRule(connParam, preCellsTags, postCellsTags, connbuild.ruleRng(connLabel, 1))
+    return time.time() - start, len(table)
+
+
+if __name__ == '__main__':
+    maxNumCells = int(sys.argv[1]) if len(sys.argv) > 1 else numCellsList[-1]
+    print('%-9s %8s %10s %12s %10s %10s %8s' % ('rule', 'numCells', 'conns', 'netpyne (s)', 'vector (s)',
+                                                 'table (s)', 'speedup'))
+    for connLabel, (pops, connParam, connsPerCell) in rules.items():
+        for numCells in [n for n in numCellsList if n <= maxNumCells]:
+            expected = numCells * (connsPerCell or numCells * connParam.get('probability', 1))
+            if expected > maxConns:
+                continue
+            tNetPyNE = tVector = None
+            if numCells <= maxNumCellsNetPyNE:
+                tNetPyNE, numConns = timeConnect(lambda: sim.net.connectCells(), pops, connLabel, connParam, numCells)
+                tVector, numConns = timeConnect(connbuild.connectCells, pops, connLabel, connParam, numCells)
+            tTable, numConns = timeTable(pops, connLabel, connParam, numCells)
+            fmt = lambda t: '%.3f' % t if t is not None else '-'
+            print('%-9s %8d %10d %12s %10s %10s %8s' % (connLabel, numCells, numConns, fmt(tNetPyNE), fmt(tVector),
+                  fmt(tTable), '%.1fx' % (tNetPyNE / tVector) if tNetPyNE else '-'))
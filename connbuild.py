@@ -0,0 +1,531 @@
+"""
+connbuild.py
+
+Vectorized builder for the connectivity rules in netParams.connParams
+
+NetPyNE evaluates the string expressions of a rule (e.g. 'delay': '0.2+normal(13.0,1.4)'
+or 'convergence': 'uniform(0,5)') separately for every candidate pre/post pair, and
+creates each connection as soon as it is drawn. Here each expression is compiled once
+into a function of NumPy arrays, and all the connections of a rule are generated in
+bulk into a ConnTable: a CSR-style table ordered by postsynaptic cell, where the
+connections onto postGids[i] are preGids[indptr[i]:indptr[i+1]], with their weights
+and delays.
+
+Random numbers come from a NumPy generator seeded with seeds['conn'] and the rule
+label, so a network is reproducible for a given seed and does not depend on the number
+of MPI ranks (every rank builds the same table and keeps its own postsynaptic cells).
+The random streams differ from NetPyNE's, so the connections are not the same ones
+NetPyNE would create, but they follow the same rules and distributions. Distributions
+use NEURON's Random semantics, as in NetPyNE string functions, e.g. normal(mean, variance).
+
+Rules with features not handled here (connFunc, synsPerConn, per-synMech lists or
+factors, disynapticBias, dist_3D_border, ...) are created by NetPyNE as usual.
+
+Usage:
+  simConfig.vectorConns = True  # used by simtools.create()
+
+  import connbuild
+  table = connbuild.buildRule(connParam, preCellsTags, postCellsTags, connbuild.ruleRng('PYR->PYR', seed=1))
+
+"""
+
+import ast
+import zlib
+from numbers import Number
+
+import numpy as np
+
+# coordinates available to string functions as pre_<coord>, post_<coord> and dist_<coord>
+coords = ['x', 'y', 'z', 'xnorm', 'ynorm', 'znorm']
+pairVarNames = (['pre_' + c for c in coords] + ['post_' + c for c in coords] + ['dist_' + c for c in coords] +
+                ['dist_3D', 'dist_2D', 'dist_norm3D', 'dist_norm2D'])
+
+# params evaluated once per connection (as netpyne's connStringFuncParams)
+connValueParams = ['weight', 'delay', 'loc']
+
+# keys passed on unchanged to cell.addConn()
+connPassParams = ['shape', 'plast', 'weightIndex']
+
+# keys (or values) that require NetPyNE's own conn functions
+unsupportedParams = ['connFunc', 'disynapticBias', 'synsPerConn', 'gapJunction', 'preSec', 'preLoc',
+                     'synMechWeightFactor', 'synMechDelayFactor', 'synMechLocFactor',
+                     'distributeSynsUniformly', 'connRandomSecFromList']
+
+# max number of candidate pairs evaluated at once for string-based probabilities
+blockSize = 2**20
+
+
+###############################################################################
+#
+# STRING FUNCTIONS
+#
+###############################################################################
+
+def _lognormal(rng, n, mean, variance):
+    """NEURON's Random.lognormal(mean, variance): mean and variance of the distribution itself"""
+    sigma2 = np.log(1 + np.asarray(variance, dtype=float) / np.square(mean))
+    return rng.lognormal(np.log(mean) - sigma2/2, np.sqrt(sigma2), n)
+
+
+# distributions available in string functions, as f(rng, n, *args) (NEURON Random semantics)
+stringDists = {
+    'uniform': lambda rng, n, low, high: rng.uniform(low, high, n),
+    'normal': lambda rng, n, mean, variance: rng.normal(mean, np.sqrt(variance), n),
+    'lognormal': _lognormal,
+    'negexp': lambda rng, n, mean: rng.exponential(mean, n),
+    'poisson': lambda rng, n, mean: rng.poisson(mean, n),
+    'binomial': lambda rng, n, N, p: rng.binomial(N, p, n),
+    'geometric': lambda rng, n, p: rng.geometric(p, n) - 1,
+    'discunif': lambda rng, n, low, high: rng.integers(low, high, n, endpoint=True),
+    'weibull': lambda rng, n, alpha, beta: beta * rng.weibull(alpha, n)}
+
+# other names available in string functions (those NetPyNE evaluates them with)
+stringNames = {'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'exp': np.exp, 'log': np.log, 'log10': np.log10,
+               'sqrt': np.sqrt, 'arctan2': np.arctan2, 'remainder': np.remainder, 'ceil': np.ceil,
+               'abs': np.abs, 'min': np.minimum, 'max': np.maximum, 'round': np.round, 'pi': np.pi, 'inf': np.inf}
+
+
+class _Vectorize(ast.NodeTransformer):
+    """Rewrite distribution calls as calls to the samplers in stringDists, drawing one value per element"""
+
+    def __init__(self, names):
+        self.names = names
+        self.used = set()
+
+    def visit_Call(self, node):
+        node.args = [self.visit(arg) for arg in node.args]
+        if node.keywords:
+            raise ValueError('keyword arguments are not supported in string functions')
+        func = node.func
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == 'rand':
+            name = func.attr
+        elif isinstance(func, ast.Name):
+            name = func.id
+        else:
+            raise ValueError('unsupported call in string function')
+        if name in stringDists:
+            node.func = ast.Name(id='_dist_' + name, ctx=ast.Load())
+            node.args = [ast.Name(id='_rng', ctx=ast.Load()), ast.Name(id='_n', ctx=ast.Load())] + node.args
+        elif name not in stringNames:
+            raise ValueError('unsupported function in string function: %s' % name)
+        return node
+
+    def visit_Name(self, node):
+        if node.id.startswith('_dist_') or node.id in ('_rng', '_n') or node.id in stringNames:
+            return node
+        if node.id not in self.names:
+            raise ValueError('unknown variable in string function: %s' % node.id)
+        self.used.add(node.id)
+        return node
+
+    def visit_IfExp(self, node):
+        raise ValueError('conditional expressions are not supported in vectorized string functions')
+
+
+class StringFunc(object):
+    """
+    String function compiled once into a function of NumPy arrays
+
+    Parameters
+    ----------
+    expr : str
+        Expression, as in a NetPyNE connParams string function (e.g. ``'0.2+normal(13.0,1.4)'``).
+
+    names : list of str
+        Variables the expression may use (pair variables and numeric netParams attributes).
+
+    Attributes
+    ----------
+    vars : set of str
+        Variables actually used by the expression.
+
+    """
+
+    def __init__(self, expr, names):
+        self.expr = expr
+        try:
+            tree = ast.parse(expr.strip(), mode='eval')
+        except SyntaxError:
+            raise ValueError('invalid string function: %s' % expr)
+        vectorize = _Vectorize(names)
+        tree = ast.fix_missing_locations(vectorize.visit(tree))
+        self.vars = vectorize.used
+        self.code = compile(tree, '<%s>' % expr, 'eval')
+        self.namespace = dict(stringNames, **{'_dist_' + name: f for name, f in stringDists.items()})
+
+    def __call__(self, rng, n, variables):
+        """Evaluate for n elements; variables maps the names in self.vars to scalars or arrays of length n"""
+        namespace = dict(self.namespace, _rng=rng, _n=n)
+        namespace.update(variables)
+        value = eval(self.code, namespace)
+        return np.broadcast_to(np.asarray(value, dtype=float), (n,))
+
+
+def _cellCoords(cellsTags, gids):
+    """Arrays with the coordinates of the cells (in gids order)"""
+    return {c: np.array([cellsTags[gid].get(c, 0) for gid in gids], dtype=float) for c in coords}
+
+
+def _pairVars(names, pre, post, preIdx, postIdx):
+    """
+    Values of the pair variables in names for the (preIdx, postIdx) pairs
+
+    pre and post are coordinate arrays from _cellCoords(); preIdx is None when the values
+    only depend on the postsynaptic cell (convergence), postIdx None for divergence.
+
+    """
+    values = {}
+    for name in names:
+        side, _, coord = name.partition('_')
+        if side not in ('pre', 'post', 'dist'):
+            continue
+        if (side != 'post' and preIdx is None) or (side != 'pre' and postIdx is None):
+            raise ValueError('%s cannot be used in this parameter' % name)
+        if side == 'pre':
+            values[name] = pre[coord][preIdx]
+        elif side == 'post':
+            values[name] = post[coord][postIdx]
+        else:
+            diff = lambda c: pre[c][preIdx] - post[c][postIdx]
+            if coord in coords:
+                values[name] = np.abs(diff(coord))
+            elif coord == '3D':
+                values[name] = np.sqrt(diff('x')**2 + diff('y')**2 + diff('z')**2)
+            elif coord == '2D':
+                values[name] = np.sqrt(diff('x')**2 + diff('z')**2)
+            elif coord == 'norm3D':
+                values[name] = np.sqrt(diff('xnorm')**2 + diff('ynorm')**2 + diff('znorm')**2)
+            elif coord == 'norm2D':
+                values[name] = np.sqrt(diff('xnorm')**2 + diff('znorm')**2)
+    return values
+
+
+###############################################################################
+#
+# SAMPLING
+#
+###############################################################################
+
+def ruleRng(label, seed):
+    """Random generator of a conn rule: depends only on seeds['conn'] and the rule label"""
+    return np.random.default_rng([seed, zlib.crc32(label.encode())])
+
+
+def _bernoulli(rng, p, size):
+    """Sorted indices in range(size), each selected independently with probability p (geometric gaps)"""
+    if p <= 0 or size == 0:
+        return np.zeros(0, dtype=np.int64)
+    if p >= 1:
+        return np.arange(size, dtype=np.int64)
+    chunk = min(int(p * size * 1.05) + 1024, 2**24)
+    selected = []
+    last = -1
+    while last < size:
+        idx = last + np.cumsum(rng.geometric(p, chunk), dtype=np.int64)
+        selected.append(idx[idx < size])
+        last = idx[-1]
+    return np.concatenate(selected)
+
+
+def _sampleUnique(rng, counts, numPool, exclude):
+    """
+    For each row i, pick counts[i] distinct indices in range(numPool) other than exclude[i] (-1: none)
+
+    Draws with replacement and redraws duplicates, which gives uniformly random subsets;
+    rows that take more than half of the pool are drawn from random permutations instead.
+    Returns (rows, indices), sorted by row and index.
+
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    exclude = np.asarray(exclude, dtype=np.int64)
+    dense = np.flatnonzero(2*counts > numPool)
+    sparse = counts.copy()
+    sparse[dense] = 0
+
+    keys = np.zeros(0, dtype=np.int64)
+    need = sparse
+    while need.any():
+        rows = np.repeat(np.arange(len(counts)), need)
+        idx = rng.integers(0, numPool, len(rows))
+        ok = idx != exclude[rows]
+        keys = np.union1d(keys, rows[ok]*numPool + idx[ok])
+        need = sparse - np.bincount(keys // numPool, minlength=len(counts))
+
+    denseKeys = []
+    step = max(1, blockSize // max(numPool, 1))
+    for start in range(0, len(dense), step):
+        rows = dense[start:start+step]
+        order = np.argsort(rng.random((len(rows), numPool)), axis=1)
+        for row, perm in zip(rows, order):
+            perm = perm[perm != exclude[row]][:counts[row]]
+            denseKeys.append(row*numPool + np.sort(perm))
+    if denseKeys:
+        keys = np.sort(np.concatenate([keys] + denseKeys))
+    return keys // numPool, keys % numPool
+
+
+###############################################################################
+#
+# CONNECTION TABLES
+#
+###############################################################################
+
+class ConnTable(object):
+    """
+    Connections generated by one conn rule, in CSR format by postsynaptic cell
+
+    The connections onto cell ``postGids[i]`` are ``preGids[indptr[i]:indptr[i+1]]``, with
+    ``weights``, ``delays`` and ``locs`` (``None`` if the rule does not set loc) at the same positions.
+
+    """
+
+    def __init__(self, label, postGids, indptr, preGids, weights, delays, locs=None):
+        self.label = label
+        self.postGids = postGids
+        self.indptr = indptr
+        self.preGids = preGids
+        self.weights = weights
+        self.delays = delays
+        self.locs = locs
+
+    def __len__(self):
+        return len(self.preGids)
+
+    @classmethod
+    def fromPairs(cls, label, postGids, postIdx, preGids, values):
+        """Build from connections sorted by postIdx (index into postGids)"""
+        indptr = np.zeros(len(postGids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(postIdx, minlength=len(postGids)), out=indptr[1:])
+        return cls(label, np.asarray(postGids), indptr, preGids, values['weight'], values['delay'], values.get('loc'))
+
+    def rows(self):
+        """Yield (postGid, slice of the connections onto it) for each postsynaptic cell"""
+        for i, postGid in enumerate(self.postGids):
+            yield int(postGid), slice(self.indptr[i], self.indptr[i+1])
+
+
+def _checkSupported(connParam):
+    for key in unsupportedParams:
+        if key in connParam:
+            raise ValueError('%s is not supported' % key)
+    if 'connList' not in connParam:
+        for param in connValueParams:
+            if isinstance(connParam.get(param), (list, tuple)):
+                raise ValueError('list of %s values is not supported' % param)
+
+
+def buildRule(connParam, preCellsTags, postCellsTags, rng, numericParams=None):
+    """
+    Generate all the connections of a conn rule in bulk
+
+    Parameters
+    ----------
+    connParam : dict
+        Conn rule (an entry of netParams.connParams), with its 'label'.
+
+    preCellsTags, postCellsTags : dict
+        Tags of the presynaptic / postsynaptic cells matching the rule conds, by gid.
+
+    rng : numpy.random.Generator
+        Random generator of the rule (see ``ruleRng``).
+
+    numericParams : dict
+        Numeric netParams attributes, available as variables in string functions.
+        **Default:** ``None``
+
+    Returns
+    -------
+    ConnTable
+        Raises ValueError if the rule uses features not supported here.
+
+    """
+    _checkSupported(connParam)
+    names = pairVarNames + list(numericParams or {})
+    numeric = numericParams or {}
+    preGids = np.array(sorted(preCellsTags), dtype=np.int64)
+    postGids = np.array(sorted(postCellsTags), dtype=np.int64)
+    numPre, numPost = len(preGids), len(postGids)
+    pre, post = _cellCoords(preCellsTags, preGids), _cellCoords(postCellsTags, postGids)
+
+    funcs = {param: StringFunc(connParam[param], names) for param in connParam
+             if param in connValueParams + ['probability', 'convergence', 'divergence'] and isinstance(connParam[param], str)}
+
+    def evalParam(param, preIdx, postIdx, n):
+        """Value of a (numeric or string) param for n pairs"""
+        if param not in funcs:
+            return np.full(n, float(connParam[param]))
+        func = funcs[param]
+        variables = _pairVars(func.vars, pre, post, preIdx, postIdx)
+        variables.update({name: numeric[name] for name in func.vars if name in numeric})
+        return func(rng, n, variables)
+
+    # pre/post pairs, sorted by post
+    if 'probability' in connParam:
+        if isinstance(connParam['probability'], Number):
+            flat = _bernoulli(rng, connParam['probability'], numPost * numPre)
+            postIdx, preIdx = flat // numPre, flat % numPre
+        else:
+            postParts, preParts = [], []
+            step = max(1, blockSize // numPre)
+            for start in range(0, numPost, step):
+                blockPost = np.repeat(np.arange(start, min(start+step, numPost)), numPre)
+                blockPre = np.tile(np.arange(numPre), len(blockPost) // numPre)
+                prob = evalParam('probability', blockPre, blockPost, len(blockPost))
+                selected = rng.random(len(blockPost)) < prob
+                postParts.append(blockPost[selected])
+                preParts.append(blockPre[selected])
+            postIdx, preIdx = np.concatenate(postParts), np.concatenate(preParts)
+
+    elif 'convergence' in connParam:
+        conv = evalParam('convergence', None, np.arange(numPost), numPost)
+        counts = np.clip(np.round(conv).astype(np.int64), 0, numPre - 1)
+        exclude = np.searchsorted(preGids, postGids)
+        exclude[(exclude >= numPre) | (preGids[np.minimum(exclude, numPre-1)] != postGids)] = -1
+        postIdx, preIdx = _sampleUnique(rng, counts, numPre, exclude)
+
+    elif 'divergence' in connParam:
+        div = evalParam('divergence', np.arange(numPre), None, numPre)
+        counts = np.clip(np.round(div).astype(np.int64), 0, numPost - 1)
+        exclude = np.searchsorted(postGids, preGids)
+        exclude[(exclude >= numPost) | (postGids[np.minimum(exclude, numPost-1)] != preGids)] = -1
+        preIdx, postIdx = _sampleUnique(rng, counts, numPost, exclude)
+        order = np.lexsort((preIdx, postIdx))
+        preIdx, postIdx = preIdx[order], postIdx[order]
+
+    elif 'connList' in connParam:
+        connList = np.asarray(connParam['connList'], dtype=np.int64).reshape(-1, 2)
+        if len(connList) and (connList[:, 0].max() >= numPre or connList[:, 1].max() >= numPost):
+            raise ValueError('cell index in connList out of range')
+        order = np.argsort(connList[:, 1], kind='stable')
+        preIdx, postIdx = connList[order, 0], connList[order, 1]
+
+    else:  # full connectivity
+        postIdx, preIdx = np.repeat(np.arange(numPost), numPre), np.tile(np.arange(numPre), numPost)
+
+    # remove self-connections
+    keep = preGids[preIdx] != postGids[postIdx]
+    preIdx, postIdx = preIdx[keep], postIdx[keep]
+
+    # weight, delay and loc of each connection
+    n = len(preIdx)
+    defaults = {'weight': numeric.get('defaultWeight', 1), 'delay': numeric.get('defaultDelay', 1)}
+    values = {}
+    for param in connValueParams:
+        value = connParam.get(param, defaults.get(param))
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):  # one value per connList entry
+            value = np.asarray(value, dtype=float)
+            if len(value) not in (1, len(connList)):
+                raise ValueError("'%s' has to be of the same length as 'connList'" % param)
+            values[param] = value[order][keep] if len(value) > 1 else np.full(n, value[0])
+        elif param in funcs:
+            values[param] = evalParam(param, preIdx, postIdx, n).copy()
+        else:
+            values[param] = np.full(n, float(value))
+
+    return ConnTable.fromPairs(connParam['label'], postGids, postIdx, preGids[preIdx], values)
+
+
+###############################################################################
+#
+# NETWORK CONNECTIONS
+#
+###############################################################################
+
+def addConns(table, connParam):
+    """Create the connections of a ConnTable onto the cells of this node (cell.addConn for each)"""
+    from netpyne import sim
+
+    synMechs = connParam.get('synMech')
+    synMechs = synMechs if isinstance(synMechs, list) else [synMechs]
+    extra = {key: connParam[key] for key in connPassParams if key in connParam}
+    if sim.cfg.includeParamsLabel:
+        extra['label'] = connParam['label']
+
+    for postGid, conns in table.rows():
+        if postGid not in sim.net.gid2lid:
+            continue
+        postCell = sim.net.cells[sim.net.gid2lid[postGid]]
+        preGids = table.preGids[conns].tolist()
+        weights = table.weights[conns].tolist()
+        delays = table.delays[conns].tolist()
+        locs = table.locs[conns].tolist() if table.locs is not None else [None] * len(preGids)
+        for preGid, weight, delay, loc in zip(preGids, weights, delays, locs):
+            for synMech in synMechs:
+                params = {'preGid': preGid, 'sec': connParam.get('sec'), 'loc': loc, 'synMech': synMech,
+                          'weight': weight, 'delay': delay, 'synsPerConn': 1}
+                params.update(extra)
+                postCell.addConn(params=params)
+
+
+def _connectRuleNetPyNE(connParam, preCellsTags, postCellsTags):
+    """Create the connections of a conn rule with NetPyNE's own conn functions (as in net.connectCells)"""
+    from netpyne import sim
+
+    if 'connFunc' not in connParam:
+        for key, connFunc in [('probability', 'probConn'), ('convergence', 'convConn'),
+                              ('divergence', 'divConn'), ('connList', 'fromListConn')]:
+            if key in connParam:
+                connParam['connFunc'] = connFunc
+                break
+        else:
+            connParam['connFunc'] = 'fullConn'
+    sim.net.rand.Random123(sim.hashStr('conn_' + connParam['connFunc']),
+                           sim.hashList(sorted(preCellsTags) + sorted(postCellsTags)), sim.cfg.seeds['conn'])
+    sim.net._connStrToFunc(preCellsTags, postCellsTags, connParam)
+    getattr(sim.net, connParam['connFunc'])(preCellsTags, postCellsTags, connParam)
+
+
+# ------------------------------------------------------------------------------
+# Replacement for sim.net.connectCells()
+# ------------------------------------------------------------------------------
+def connectCells():
+    """
+    Create the connections of all the conn rules, using buildRule() where possible
+
+    Drop-in replacement for sim.net.connectCells(); falls back to it entirely for networks
+    with subConnParams or pointer connections (gap junctions).
+
+    """
+    from netpyne import sim
+
+    net = sim.net
+    if net.params.subConnParams or net.params.synMechParams.hasPointerConns():
+        return net.connectCells()
+
+    sim.timing('start', 'connectTime')
+    if sim.rank == 0:
+        print('Making connections (vectorized)...')
+
+    if sim.nhosts > 1:  # Gather tags from all cells
+        allCellTags = sim._gatherAllCellTags()
+    else:
+        allCellTags = {cell.gid: cell.tags for cell in net.cells}
+    numericParams = {k: v for k, v in net.params.__dict__.items() if isinstance(v, Number)}
+
+    for connParamLabel, connParamTemp in net.params.connParams.items():
+        connParam = connParamTemp.copy()
+        connParam['label'] = connParamLabel
+        preCellsTags, postCellsTags = net._findPrePostCellsCondition(
+            allCellTags, connParam['preConds'], connParam['postConds'])
+        if not preCellsTags or not postCellsTags:
+            continue
+        try:
+            table = buildRule(connParam, preCellsTags, postCellsTags,
+                              ruleRng(connParamLabel, sim.cfg.seeds['conn']), numericParams)
+        except ValueError as e:
+            if sim.rank == 0 and sim.cfg.verbose:
+                print('  Conn rule %s created by NetPyNE (%s)' % (connParamLabel, e))
+            _connectRuleNetPyNE(connParam, preCellsTags, postCellsTags)
+            continue
+        addConns(table, connParam)
+
+    nodeSynapses = sum([len(cell.conns) for cell in net.cells])
+    print('  Number of connections on node %i: %i ' % (sim.rank, nodeSynapses))
+    sim.pc.barrier()
+    sim.timing('stop', 'connectTime')
+    if sim.rank == 0 and sim.cfg.timing:
+        print('  Done; cell connection time = %0.2f s.' % sim.timingData['connectTime'])
+
+    return [cell.conns for cell in net.cells]
@@ -0,0 +1,267 @@
+"""
+intfirepop.py
+
+Event-driven engine for IntFire1 populations
+
+IntFire1 cells only change state when an input arrives: between inputs m decays as
+exp(-(t - t0)/tau), so an input of weight w sets m = m*exp(-(t - t0)/tau) + w, and the
+cell fires when m > 1, then ignores its inputs for refrac ms. Here all the IntFire1
+cells of the network are kept as flat arrays (m, t0, end of the refractory period)
+and updated only at the times of their input events, held in a queue of pending
+events (delivery time, cell, weight).
+
+The rest of the network (HH cells, NetStims...) is still run by NEURON. The two are
+coupled at the exchange boundary of the minimum delay D of the connections of the
+IntFire1 cells: every D ms, the spikes of their NEURON sources are read from the
+recorded spikes, the engine delivers all the events due before t + D (their effects
+cannot reach back before t + D), and its spikes are sent to their NEURON targets with
+NetCon.event(). Within one window a cell's events are processed in time order, and
+the cells are processed together with NumPy, so the cost of the IntFire1 part grows
+with the number of events, not with duration/dt.
+
+The NetCons into the IntFire1 cells are made inactive (the engine delivers their
+events instead), and the engine's spikes are appended to sim.simData['spkt'] /
+['spkid'], so monitors, spike statistics and the analysis see them as usual. The
+engine runs on a single rank, without checkpoints; IntFire2/IntFire4 stay in NEURON.
+
+NEURON's IntFire1 is itself event-driven (no work per time step), so the engine only
+saves NEURON's per-event overhead, while every window costs a stop of pc.psolve() and a
+few NumPy calls. It wins only with many events per window: in intfirepop_benchmark.py it
+is 2-30x slower than NEURON with 100-1000 cells or windows under 2 ms, about even at
+10000 cells and 2 ms, and faster at 10000 cells with 5 ms (1.1x, 1800 events per window)
+and 10 ms windows (1.4x, 3600). With fewer than minCells IntFire1 cells (checked before
+the engine is built), a window under minWindow, or inputs the engine does not take
+(NetStims, delays under dt), setup() leaves them in NEURON.
+
+Usage:
+  simConfig.eventDriven = True  # simtools runs the IntFire1 cells in this engine
+
+"""
+
+import numpy as np
+from netpyne import sim
+from neuron import h
+
+import runloop
+
+cellModels = ('IntFire1',)
+minCells = 10000  # IntFire1 cells below which the engine is slower than NEURON (see intfirepop_benchmark.py)
+minWindow = 5  # ms; exchange windows below which it is slower
+
+
+###############################################################################
+#
+# EVENT-DRIVEN ENGINE
+#
+###############################################################################
+
+def enabled(simConfig):
+    """Whether simConfig asks for the event-driven engine"""
+    return getattr(simConfig, 'eventDriven', False)
+
+
+class _Targets(object):
+    """Targets (cell index, weight, delay) of each source, stored by source (CSR)"""
+
+    def __init__(self, rows, numSources):
+        rows = sorted(rows, key=lambda row: row[0])
+        sources = np.array([row[0] for row in rows], dtype=int)
+        self.post = np.array([row[1] for row in rows], dtype=int)
+        self.weight = np.array([row[2] for row in rows], dtype=float)
+        self.delay = np.array([row[3] for row in rows], dtype=float)
+        self.start = np.searchsorted(sources, np.arange(numSources + 1))
+
+    def events(self, spikeTimes, sources):
+        """(times, cells, weights) of the events of spikes at spikeTimes from sources"""
+        counts = self.start[sources + 1] - self.start[sources]
+        rows = np.repeat(self.start[sources] - np.cumsum(np.r_[0, counts[:-1]]), counts) + np.arange(counts.sum())
+        return np.repeat(spikeTimes, counts) + self.delay[rows], self.post[rows], self.weight[rows]
+
+
+class Engine(object):
+    """
+    The IntFire1 cells of sim.net, run event-driven (built after the network is created)
+
+    Attributes: gids, tau, refrac (per cell), m, t0, until (end of the refractory period,
+    -inf when excitable), window (the exchange interval: the min delay D, in whole
+    steps of dt), numEvents and numSpikes.
+
+    """
+
+    def __init__(self):
+        cells = [cell for cell in sim.net.cells if cell.tags.get('cellModel') in cellModels]
+        self.gids = np.array([cell.gid for cell in cells], dtype=int)
+        index = {gid: i for i, gid in enumerate(self.gids)}
+        self.tau = np.array([cell.hPointp.tau for cell in cells], dtype=float)
+        self.refrac = np.array([cell.hPointp.refrac for cell in cells], dtype=float)
+        self.m = np.zeros(len(cells))
+        self.t0 = np.zeros(len(cells))
+        self.until = np.full(len(cells), -np.inf)
+
+        internal, external = [], []
+        self.inputs = []  # NetCons into the IntFire1 cells, made inactive by attach()
+        for post, cell in enumerate(cells):
+            for conn in cell.conns:
+                netcon = conn.get('hObj')
+                if netcon is None:
+                    continue
+                preGid = conn.get('preGid')
+                if not isinstance(preGid, (int, np.integer)):
+                    raise ValueError('Event-driven IntFire1 cells only take inputs from cells (conn from %s)' % preGid)
+                self.inputs.append(netcon)
+                if preGid in index:
+                    internal.append((index[preGid], post, netcon.weight[0], netcon.delay))
+                else:
+                    external.append((preGid, post, netcon.weight[0], netcon.delay))
+        self.internal = _Targets(internal, len(cells))
+        self.sourceGids = np.unique([row[0] for row in external]).astype(int)  # NEURON cells, read from spkt / spkid
+        sources = np.searchsorted(self.sourceGids, [row[0] for row in external])
+        self.external = _Targets([(source,) + row[1:] for source, row in zip(sources, external)], len(self.sourceGids))
+
+        self.outbound = [[] for _ in cells]  # NetCons from each cell to NEURON targets
+        for cell in sim.net.cells:
+            if cell.gid not in index:
+                for conn in cell.conns:
+                    if conn.get('preGid') in index and conn.get('hObj') is not None:
+                        self.outbound[index[conn['preGid']]].append(conn['hObj'])
+
+        delays = [row[3] for row in internal + external]
+        delays += [netcon.delay for netcons in self.outbound for netcon in netcons]
+        minDelay = min(delays) if delays else sim.cfg.duration
+        if minDelay < sim.cfg.dt:
+            raise ValueError('Event-driven IntFire1 cells need connection delays >= dt (min delay %g ms)' % minDelay)
+        self.window = np.floor(minDelay / sim.cfg.dt + 1e-9) * sim.cfg.dt  # whole steps, where psolve() can stop
+        self._clear()
+
+    def attach(self):
+        """Take over the IntFire1 cells: their input NetCons are made inactive (the engine delivers their events)"""
+        for netcon in self.inputs:
+            netcon.active(False)
+
+    def _clear(self):
+        self.m[:] = 0
+        self.t0[:] = 0
+        self.until[:] = -np.inf
+        self.numRead = 0  # spikes read from the recorded vectors, with those dropped
+        self.pending = [(np.zeros(0), np.zeros(0, dtype=int), np.zeros(0))]
+        self.spikes = [(np.zeros(0), np.zeros(0, dtype=int))]  # not yet in spkt / spkid
+        self.numEvents = 0
+        self.numSpikes = 0
+
+    def _deliver(self, times, cells, weights):
+        """Update the cells at their events (times in order for each cell); returns the (times, cells) of the spikes"""
+        order = np.lexsort((times, cells))
+        times, cells, weights = times[order], cells[order], weights[order]
+        first = np.r_[True, cells[1:] != cells[:-1]]
+        starts = np.flatnonzero(first)
+        rank = np.arange(len(cells)) - np.repeat(starts, np.diff(np.r_[starts, len(cells)]))
+        byRank = np.argsort(rank, kind='stable')
+        bounds = np.r_[0, np.cumsum(np.bincount(rank))]
+        spikeTimes, spikeCells = [], []
+        for k in range(len(bounds) - 1):  # the k-th event of each cell, all cells at once
+            rows = byRank[bounds[k]:bounds[k + 1]]
+            t, c, w = times[rows], cells[rows], weights[rows]
+            ready = t >= self.until[c]  # excitable (refractory periods end before their inputs)
+            t, c, w = t[ready], c[ready], w[ready]
+            ended = np.isfinite(self.until[c])
+            self.m[c[ended]] = 0
+            self.t0[c[ended]] = self.until[c[ended]]
+            self.until[c[ended]] = -np.inf
+            m = self.m[c] * np.exp(-(t - self.t0[c]) / self.tau[c]) + w
+            self.t0[c] = t
+            fire = m > 1
+            m[fire] = 2  # as IntFire1 during the refractory period
+            self.m[c] = m
+            self.until[c[fire]] = t[fire] + self.refrac[c[fire]]
+            spikeTimes.append(t[fire])
+            spikeCells.append(c[fire])
+        return np.concatenate(spikeTimes), np.concatenate(spikeCells)
+
+    def _read(self):
+        """The spikes recorded by NEURON (and the engine) since the last call"""
+        dropped = getattr(sim, 'numSpikesDropped', 0)  # by spikestats.py
+        first = max(self.numRead - dropped, 0)
+        spkt = sim.simData['spkt'].as_numpy()[first:].copy()
+        spkid = sim.simData['spkid'].as_numpy()[first:].astype(int)
+        self.numRead = dropped + first + len(spkt)
+        return spkt, spkid
+
+    def advance(self, until):
+        """Deliver the events before until and send the resulting spikes (at most one window ahead of NEURON)"""
+        spkt, spkid = self._read()
+        sources = np.searchsorted(self.sourceGids, spkid)
+        found = sources < len(self.sourceGids)
+        found[found] = self.sourceGids[sources[found]] == spkid[found]
+        if found.any():
+            self.pending.append(self.external.events(spkt[found], sources[found]))
+        times, cells, weights = [np.concatenate(columns) for columns in zip(*self.pending)]
+        due = times < until
+        self.pending = [(times[~due], cells[~due], weights[~due])]
+        if not due.any():
+            return
+        self.numEvents += int(due.sum())
+        spikeTimes, spikeCells = self._deliver(times[due], cells[due], weights[due])
+        if not len(spikeTimes):
+            return
+        self.numSpikes += len(spikeTimes)
+        self.spikes.append((spikeTimes, spikeCells))
+        self.pending.append(self.internal.events(spikeTimes, spikeCells))  # >= one window later
+        for t, c in zip(spikeTimes.tolist(), spikeCells.tolist()):
+            for netcon in self.outbound[c]:
+                netcon.event(t + netcon.delay)
+
+    def record(self, before):
+        """Append the engine's spikes before time before to sim.simData['spkt'] / ['spkid']"""
+        times, cells = [np.concatenate(columns) for columns in zip(*self.spikes)]
+        done = times < before
+        self.spikes = [(times[~done], cells[~done])]
+        if done.any():
+            order = np.argsort(times[done], kind='stable')
+            sim.simData['spkt'].append(h.Vector(times[done][order]))
+            sim.simData['spkid'].append(h.Vector(self.gids[cells[done][order]].astype(float)))
+
+    def start(self):
+        """Restart at t = 0 (after initialization) and deliver the first window"""
+        self._clear()
+        self.advance(min(self.window, sim.cfg.duration))
+
+    def update(self, simTime):
+        """Task of runloop.runSim(): record the spikes up to simTime and advance one window"""
+        self.record(simTime + sim.cfg.dt / 2)
+        self.advance(min(simTime + self.window, sim.cfg.duration + sim.cfg.dt / 2))
+
+    def task(self):
+        """(times, func, final) for runloop.runSim(), every window; the first window is delivered by start()"""
+        return (runloop.every(self.window), self.update, True)
+
+
+def setup():
+    """Build sim.eventEngine from the created network, if simConfig asks for it"""
+    sim.eventEngine = None
+    if not enabled(sim.cfg):
+        return None
+    if sim.nhosts > 1:
+        if sim.rank == 0:
+            print('  Warning: eventDriven needs a single rank; IntFire1 cells run in NEURON')
+        return None
+    if sim.cfg.recordCellsSpikes != -1:
+        raise ValueError('eventDriven reads the inputs of the IntFire1 cells from the recorded spikes (recordCellsSpikes = -1)')
+    numCells = sum(cell.tags.get('cellModel') in cellModels for cell in sim.net.cells)
+    if numCells < minCells:
+        print('  Event-driven IntFire1 engine not used: %d cells (slower than NEURON below %d); IntFire1 cells run in NEURON'
+              % (numCells, minCells))
+        return None
+    try:
+        engine = Engine()
+    except ValueError as error:  # inputs or delays the engine does not support
+        print('  Event-driven IntFire1 engine not used: %s; IntFire1 cells run in NEURON' % error)
+        return None
+    if engine.window < minWindow:
+        print('  Event-driven IntFire1 engine not used: exchange every %g ms (slower than NEURON below %g ms); '
+              'IntFire1 cells run in NEURON' % (engine.window, minWindow))
+        return None
+    engine.attach()
+    sim.eventEngine = engine
+    if sim.rank == 0:
+        print('  Event-driven IntFire1 engine: %d cells, exchange every %g ms' % (len(engine.gids), engine.window))
+    return engine
@@ -0,0 +1,86 @@
+"""
+intfirepop_benchmark.py
+
+Benchmark of the event-driven IntFire1 engine (intfirepop.py) vs NEURON
+
+A network of numCells IntFire1 cells (tau 10 ms, refrac 5 ms), each driven by its own
+NetStim (identity connList) and receiving convergence recurrent inputs from the other
+IntFire1 cells, all with the same delay, is run for duration ms with simConfig.eventDriven
+off and on. The engine exchanges spikes with NEURON every delay ms, so the delay sets its
+window: each window costs a stop of pc.psolve() and a few NumPy calls whatever the number
+of events, and the engine only wins when a window holds enough events. Reported for each
+size and delay: the run time of both, the events delivered per window, and whether the
+spike counts are the same. intfirepop.minCells and minWindow are set to 0 here, so the
+engine runs even where setup() would leave the cells in NEURON; the 'used' column tells
+whether setup() takes the network with its default thresholds. The ones it takes,
+10000 cells with delays of 5 and 10 ms, are where the engine wins (1.1x and 1.4x, with
+1800 and 3600 events per window).
+
+Usage: python intfirepop_benchmark.py [maxNumCells] [duration (ms)]
+"""
+
+import sys
+
+from netpyne import specs, sim
+
+import intfirepop
+import simtools
+
+numCellsList = [100, 1000, 10000]
+delays = [0.1, 0.5, 2, 5, 10]  # ms
+convergence = 10
+stimRate = 20  # Hz
+stimWeight = 0.6
+weight = 0.15
+
+
+def makeNet(numCells, delay, duration, eventDriven):
+    netParams = specs.NetParams()
+    netParams.popParams['stim'] = {'cellModel': 'NetStim', 'numCells': numCells, 'rate': stimRate, 'noise': 1.0}
+    netParams.popParams['LIF'] = {'cellModel': 'IntFire1', 'cellType': 'LIF', 'numCells': numCells, 'tau': 10, 'refrac': 5}
+    netParams.connParams['stim->LIF'] = {'preConds': {'pop': 'stim'}, 'postConds': {'pop': 'LIF'},
+                                         'connList': [[i, i] for i in range(numCells)], 'weight': stimWeight, 'delay': delay}
+    netParams.connParams['LIF->LIF'] = {'preConds': {'pop': 'LIF'}, 'postConds': {'pop': 'LIF'},
+                                        'convergence': convergence, 'weight': weight, 'delay': delay}
+
+    simConfig = specs.SimConfig()
+    simConfig.duration = duration
+    simConfig.dt = 0.025
+    simConfig.verbose = False
+    simConfig.printRunTime = False
+    simConfig.progressBar = 0
+    simConfig.recordTraces = {}
+    simConfig.analysis = {}
+    simConfig.saveJson = simConfig.savePickle = False
+    simConfig.eventDriven = eventDriven
+    return netParams, simConfig
+
+
+def run(numCells, delay, duration, eventDriven):
+    """(run time (s), spikes, events delivered by the engine) of one network"""
+    netParams, simConfig = makeNet(numCells, delay, duration, eventDriven)
+    simtools.create(netParams, simConfig)
+    simtools.simulate()
+    engine = sim.eventEngine
+    return sim.timingData['runTime'], len(sim.allSimData['spkt']), engine.numEvents if engine else None
+
+
+if __name__ == '__main__':
+    maxNumCells = int(sys.argv[1]) if len(sys.argv) > 1 else numCellsList[-1]
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    minCells, minWindow = intfirepop.minCells, intfirepop.minWindow
+    intfirepop.minCells = intfirepop.minWindow = 0
+    rows = []
+    for numCells in [n for n in numCellsList if n <= maxNumCells]:
+        for delay in delays:
+            tNeuron, spikesNeuron, _ = run(numCells, delay, duration, False)
+            tEngine, spikesEngine, numEvents = run(numCells, delay, duration, True)
+            rows.append((numCells, delay, tNeuron, tEngine, tNeuron / tEngine, numEvents * delay / duration,
+                         'yes' if spikesNeuron == spikesEngine else '%d vs %d' % (spikesNeuron, spikesEngine),
+                         'yes' if numCells >= minCells and delay >= minWindow else 'no'))
+
+    print('\nIntFire1 network, %g ms, convergence %d, inputs %g Hz' % (duration, convergence, stimRate))
+    print('%8s %10s %12s %11s %8s %12s %8s %5s' % ('numCells', 'delay (ms)', 'neuron (s)', 'engine (s)', 'speedup',
+                                                     'events/window', 'same', 'used'))
+    for row in rows:
+        print('%8d %10g %12.3f %11.3f %7.2fx %12.1f %8s %5s' % row)
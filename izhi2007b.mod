@@ -33,7 +33,7 @@ ENDCOMMENT
 : Declare name of object and variables
 NEURON {
   POINT_PROCESS Izhi2007b
-  RANGE C, k, vr, vt, vpeak, u, a, b, c, d, Iin, celltype, alive, cellid, verbose, derivtype, delta, t0
+  RANGE C, k, vr, vt, vpeak, u, a, b, c, d, Iin, celltype, alive, cellid, verbose, derivtype
   NONSPECIFIC_CURRENT i
 }
 
@@ -64,12 +64,13 @@ PARAMETER {
 ASSIGNED {
   v (mV)
   i (nA)
-  u (mV) : Slow current/recovery variable
-  delta
-  t0
   derivtype
 }
 
+STATE {
+  u (mV) : Slow current/recovery variable
+}
+
 : Initial conditions
 INITIAL {
   u = 0.0
@@ -78,52 +79,27 @@ INITIAL {
 }
 
 : Define neuron dynamics
+: u is a STATE so it is integrated by NEURON (cnexp at fixed dt, CVODE when active);
+: celltype-specific switches of b and derivtype are made by the WATCH statements below
+: (set from v at initialization, then on crossings) instead of at every step as in the
+: original explicit Euler version, reference/izhi2007b_euler.mod (compared in izhi_check.py)
 BREAKPOINT {
-  delta = t-t0 : Find time difference
-  if (celltype<5) {
-    u = u + delta*a*(b*(v-vr)-u) : Calculate recovery variable
-  }
-  else {
-     : For FS neurons, include nonlinear U(v): U(v) = 0 when v<vb ; U(v) = 0.025(v-vb) when v>=vb (d=vb=-55)
-     if (celltype==5) {
-       if (v<d) { 
-        u = u + delta*a*(0-u)
-       }
-       else { 
-        u = u + delta*a*((0.025*(v-d)*(v-d)*(v-d))-u)
-       }
-     }
-
-     : For TC neurons, reset b
-     if (celltype==6) {
-       if (v>-65) {b=0}
-       else {b=15}
-       u = u + delta*a*(b*(v-vr)-u) : Calculate recovery variable
-     }
-     
-     : For TRN neurons, reset b
-     if (celltype==7) {
-       if (v>-65) {b=2}
-       else {b=10}
-       u = u + delta*a*(b*(v-vr)-u) : Calculate recovery variable
-     }
-  }
-
-  t0=t : Reset last time so delta can be calculated in the next time step
+  SOLVE states METHOD cnexp
   i = -(k*(v-vr)*(v-vt) - u + Iin)/C/1000
 }
 
-FUNCTION derivfunc () {
-  if (celltype==5 && derivtype==2) { : For FS neurons, include nonlinear U(v): U(v) = 0 when v<vb ; U(v) = 0.025(v-vb) when v>=vb (d=vb=-55)
-    derivfunc = a*(0-u)
-  } else if (celltype==5 && derivtype==1) { : For FS neurons, include nonlinear U(v): U(v) = 0 when v<vb ; U(v) = 0.025(v-vb) when v>=vb (d=vb=-55)
-    derivfunc = a*((0.025*(v-d)*(v-d)*(v-d))-u)
-  } else if (celltype==5) { 
-    VERBATIM
-    hoc_execerror("izhi2007b.mod ERRA: derivtype not set",0);
-    ENDVERBATIM
+DERIVATIVE states {
+  u' = a*(uinf(v)-u) : Calculate recovery variable
+}
+
+: Value u relaxes to at voltage v
+FUNCTION uinf (v (mV)) (mV) {
+  if (celltype==5) { : For FS neurons, include nonlinear U(v): U(v) = 0 when v<vb ; U(v) = 0.025(v-vb) when v>=vb (d=vb=-55)
+    : smooth at v = d, so taken from v directly: derivtype (set by WATCH) would flip on roundoff when v rests at vr = d
+    if (v > d) { uinf = 0.025*(v-d)*(v-d)*(v-d) }
+    else { uinf = 0 }
   } else {
-    derivfunc = a*(b*(v-vr)-u) : Calculate recovery variable
+    uinf = b*(v-vr)
   }
 }
 
@@ -148,6 +124,12 @@ NET_RECEIVE (w) {
       WATCH (v< d) 4  : coming down
     }
     v = vr  : initialization can be done here
+    : b and derivtype as the original per-step reset set them: the WATCH statements only
+    : switch them on crossings, so a v that starts on the other side would keep the defaults
+    if (celltype == 5)        { if (v > d) {derivtype = 1} else {derivtype = 2}
+    } else if (celltype == 6) { if (v > -65) {b = 0} else {b = 15}
+    } else if (celltype == 7) { if (v > -65) {b = 2} else {b = 10}
+    }
   : FLAG 2 Event created by WATCH statement -- threshold crossed for spiking
   } else if (flag == 2) { 
     if (alive) {net_event(t)} : Send spike event if the cell is alive
@@ -0,0 +1,217 @@
+COMMENT
+
+Section-free (ARTIFICIAL_CELL) version of Izhi2007b.
+
+Same parameters, equations and cell types as izhi2007b.mod, but the membrane
+potential V is a variable of the mechanism instead of the v of a dummy soma,
+so no cable-equation node is needed per neuron.
+
+The sectioned version is normally driven by an ExpSyn on its soma; here the
+synapse is built in: each input event adds its weight (uS) to a conductance g
+that decays with time constant tauSyn and reverses at eSyn. With the default
+Cm = 0.1 nF (soma diam = L = 10 um, cm = 31.831 uF/cm2, as in the NetPyNE
+Izhi cell rules) and tauSyn/eSyn matching the ExpSyn, both versions solve the
+same equations.
+
+ARTIFICIAL_CELLs cannot be integrated by NEURON's solver, so the cell advances
+itself with self-events every dtInt ms, using the same step as NEURON's fixed
+dt method applies to the sectioned version. When the cell is at rest (V = vr, u = 0,
+g = 0, Iin = 0 is a fixed point for all cell types) the self-events stop and the
+cell only does work when an input arrives.
+
+A self-event costs more than a fixed step of the dummy soma, so this version is
+only faster for cells that are at rest most of the time (after an input, an RS
+cell takes a few hundred ms to settle within restTol). In izhiart_benchmark.py
+(1000 RS cells, Poisson inputs of 0.05 uS) it is 2.4x faster with 0.1 Hz of input
+per cell (awake 4% of the time), but 1.5-1.8x slower from 1 Hz (awake 33%) up, and
+cellmodels.py (10 Hz background) runs 2.4x slower with it.
+
+Example usage (in Python):
+  from neuron import h
+  izh = h.Izhi2007bArt()
+  izh.celltype = 1
+  nc = h.NetCon(stim, izh)  # input events, weight in uS
+  nc.weight[0] = 1
+
+ENDCOMMENT
+
+: Declare name of object and variables
+NEURON {
+  ARTIFICIAL_CELL Izhi2007bArt
+  RANGE C, k, vr, vt, vpeak, u, a, b, c, d, Iin, celltype, alive, cellid, derivtype
+  RANGE V, g, Cm, tauSyn, eSyn, dtInt, restTol, idle
+  RANGE gNext, above, below, tlast : internal state, RANGE so checkpoint.py can save it
+}
+
+: Specify units that have physiological interpretations (NB: ms is already declared)
+UNITS {
+  (mV) = (millivolt)
+  (nF) = (nanofarad)
+  (uS) = (microsiemens)
+}
+
+: Parameters from Izhikevich 2007, MIT Press for regular spiking pyramidal cell
+PARAMETER {
+  C = 1 : Capacitance
+  k = 0.7
+  vr = -60 (mV) : Resting membrane potential
+  vt = -40 (mV) : Membrane threhsold
+  vpeak = 35 (mV) : Peak voltage
+  a = 0.03
+  b = -2
+  c = -50
+  d = 100
+  Iin = 0
+  celltype = 1 : A flag for indicating what kind of cell it is (see list of cell types in izhi2007b.mod)
+  alive = 1 : A flag for deciding whether or not the cell is alive -- if it's dead, acts normally except it doesn't fire spikes
+  cellid = -1 : A parameter for storing the cell ID, if required (useful for diagnostic information)
+  Cm = 0.1 (nF) : Membrane capacitance of the equivalent dummy soma
+  tauSyn = 0.1 (ms) : Decay time constant of the built-in synapse (ExpSyn tau)
+  eSyn = 0 (mV) : Reversal potential of the built-in synapse (ExpSyn e)
+  dtInt = 0.025 (ms) : Internal integration step
+  restTol = 1e-6 : Distance from the resting state below which the cell stops integrating
+}
+
+: Variables used for internal calculations
+ASSIGNED {
+  V (mV)
+  u (mV) : Slow current/recovery variable
+  g (uS)
+  gNext (uS) : input received in the second half of the current step, added at its end
+  derivtype
+  above : V was above / below vswitch at the last step (WATCH conditions)
+  below
+  tlast (ms)
+  idle
+}
+
+: Initial conditions
+INITIAL {
+  V = vr
+  u = 0.0
+  g = 0
+  gNext = 0
+  derivtype = 2
+  if (celltype == 5)        { if (V > d) {derivtype = 1}
+  } else if (celltype == 6) { if (V > -65) {b = 0} else {b = 15}
+  } else if (celltype == 7) { if (V > -65) {b = 2} else {b = 10}
+  }
+  above = (V > vswitch())
+  below = (V < vswitch())
+  tlast = t
+  idle = 0
+  net_send(dtInt, 1)
+}
+
+: Integrate V, u and g from tlast to t in steps of dtInt, with the same scheme
+: as NEURON's fixed step for the sectioned version: v by backward Euler on the
+: current linearized around v, then u (cnexp) and the synapse at the new v
+PROCEDURE advance() {
+  LOCAL h, iIzhi, gIzhi
+  while (t - tlast > 1e-9) {
+    h = t - tlast
+    if (h > dtInt) { h = dtInt }
+
+    : membrane
+    iIzhi = (k*(V-vr)*(V-vt) - u + Iin)/C/1000 : inward current (nA)
+    gIzhi = -k*(2*V-vr-vt)/C/1000 : d(outward current)/dv (uS)
+    V = V + h*(iIzhi + g*(eSyn-V))/(Cm + h*(gIzhi + g))
+
+    : recovery variable and synapse
+    u = u + (1 - exp(-h*a))*(uinf(V) - u)
+    g = g*exp(-h/tauSyn) + gNext
+    gNext = 0
+
+    : TC/RTN b switching and FS derivtype, on crossings as done by the WATCH statements of izhi2007b.mod
+    if (V > vswitch() && !above) {
+      if (celltype == 5)        { derivtype = 1
+      } else if (celltype == 6) { b = 0
+      } else if (celltype == 7) { b = 2
+      }
+    } else if (V < vswitch() && !below) {
+      if (celltype == 5)        { derivtype = 2
+      } else if (celltype == 6) { b = 15
+      } else if (celltype == 7) { b = 10
+      }
+    }
+    above = (V > vswitch())
+    below = (V < vswitch())
+
+    tlast = tlast + h
+  }
+  tlast = t
+}
+
+: Voltage at which FS (derivtype) and TC/RTN (b) cells switch dynamics
+FUNCTION vswitch () (mV) {
+  if (celltype == 5) { vswitch = d } else { vswitch = -65 }
+}
+
+: Value u relaxes to at voltage v (as in izhi2007b.mod)
+FUNCTION uinf (v (mV)) (mV) {
+  if (celltype==5) { : For FS neurons, include nonlinear U(v): U(v) = 0 when v<vb ; U(v) = 0.025(v-vb) when v>=vb (d=vb=-55)
+    if (v > d) { uinf = 0.025*(v-d)*(v-d)*(v-d) }
+    else { uinf = 0 }
+  } else {
+    uinf = b*(v-vr)
+  }
+}
+
+FUNCTION spikeThreshold() {
+  if (celltype == 4) { : LTS cell
+    spikeThreshold = vpeak-0.1*u
+  } else if (celltype == 6) { : TC cell
+    spikeThreshold = vpeak+0.1*u
+  } else {
+    spikeThreshold = vpeak
+  }
+}
+
+: Input received
+NET_RECEIVE (w) {
+  if (flag == 0) { : synaptic input, applied at the nearest step boundary (as at fixed dt)
+    if (idle) { : wake up on the dtInt grid
+      idle = 0
+      tlast = floor(t/dtInt + 0.5)*dtInt
+      net_send(tlast + dtInt - t, 1)
+    }
+    if (t - tlast > 0.5*dtInt) {
+      gNext = gNext + w
+    } else {
+      g = g + w
+    }
+  } else if (flag == 1) { : self-event: integration step
+    advance()
+    if (V > spikeThreshold()) { : threshold crossed
+      if (alive) {net_event(t)} : Send spike event if the cell is alive
+      : For LTS neurons
+      if (celltype == 4) {
+        V = c+0.04*u : Reset voltage
+        if ((u+d)<670) {u=u+d} : Reset recovery variable
+        else {u=670}
+      }
+      : For FS neurons (only update v)
+      else if (celltype == 5) {
+        V = c : Reset voltage
+      }
+      : For TC neurons (only update v)
+      else if (celltype == 6) {
+        V = c-0.1*u : Reset voltage
+        u = u+d : Reset recovery variable
+      } else { : For RS, IB and CH neurons, and RTN
+        V = c : Reset voltage
+        u = u+d : Reset recovery variable
+      }
+    }
+
+    : keep integrating unless at rest
+    if (Iin == 0 && fabs(V-vr) < restTol && fabs(u) < restTol && g + gNext < restTol) {
+      V = vr
+      u = 0
+      g = 0
+      idle = 1
+    } else {
+      net_send(dtInt, 1)
+    }
+  }
+}
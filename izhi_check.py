@@ -0,0 +1,159 @@
+"""
+izhi_check.py
+
+Check that the Izhi2007b variants produce the same spikes
+
+For each of the seven cell types, a single cell is driven by the same random input
+spike train through an AMPA-like synapse (ExpSyn, tau 0.1, e 0), and its whole spike
+train is compared against a reference: Izhi2007b on a dummy soma at fixed dt.
+
+The art variant uses the same dt as the reference, and must give the same number of
+spikes, each within tolerance. The variable time step variants are compared against a
+reference at refDt, and must give the same number of spikes, each within
+cvodeTolerance. The model is chaotic under strong input, so fixed-step trains converge
+slowly with dt (for some cell types, late spikes at dt = 0.001 and 0.0002 ms still
+differ by tens of ms): the reference needs refDt = 0.00005 ms (about 100 s per cell
+type) and CVODE an absolute tolerance of cvodeAtol. The max and median differences of
+every variant are reported.
+
+Variants compared:
+  art    - Izhi2007bArt (section-free ARTIFICIAL_CELL with built-in synapse)
+  cvode  - Izhi2007b with CVODE (global variable time step)
+  lvardt - Izhi2007b with CVODE local variable time step
+
+Izhi2007b itself is compared at dt against the original explicit Euler version it
+replaces (reference/izhi2007b_euler.mod, loaded as Izhi2007bEuler), with the tolerances
+of eulerTolerances: the two integrate u differently (cnexp with the new v vs Euler with
+the old one), so trains drift by up to a few steps (LTS: 2.2 ms). FS splits at its third
+spike (37.5 vs 48.7 ms; closer at dt = 0.01 ms, apart again at 0.0025), so only its spike
+count is compared (73 vs 70).
+
+Usage: nrnivmodl; python izhi_check.py
+"""
+
+import os
+import sys
+import numpy as np
+from neuron import h
+
+import startup
+
+h.load_file('stdrun.hoc')
+
+# Cell type parameters from Izhikevich 2007 book
+izhiTypes = {
+    'RS':  {'C': 1.0, 'k': 0.7,  'vr': -60, 'vt': -40, 'vpeak': 35, 'a': 0.03,  'b': -2, 'c': -50, 'd': 100, 'celltype': 1},
+    'IB':  {'C': 1.5, 'k': 1.2,  'vr': -75, 'vt': -45, 'vpeak': 50, 'a': 0.01,  'b': 5,  'c': -56, 'd': 130, 'celltype': 2},
+    'CH':  {'C': 0.5, 'k': 1.5,  'vr': -60, 'vt': -40, 'vpeak': 25, 'a': 0.03,  'b': 1,  'c': -40, 'd': 150, 'celltype': 3},
+    'LTS': {'C': 1.0, 'k': 1.0,  'vr': -56, 'vt': -42, 'vpeak': 40, 'a': 0.03,  'b': 8,  'c': -53, 'd': 20,  'celltype': 4},
+    'FS':  {'C': 0.2, 'k': 1.0,  'vr': -55, 'vt': -40, 'vpeak': 25, 'a': 0.2,   'b': -2, 'c': -45, 'd': -55, 'celltype': 5},
+    'TC':  {'C': 2.0, 'k': 1.6,  'vr': -60, 'vt': -50, 'vpeak': 35, 'a': 0.01,  'b': 15, 'c': -60, 'd': 10,  'celltype': 6},
+    'RTN': {'C': 0.4, 'k': 0.25, 'vr': -65, 'vt': -45, 'vpeak': 0,  'a': 0.015, 'b': 10, 'c': -55, 'd': 50,  'celltype': 7}}
+
+duration = 1000  # ms
+dt = 0.025  # ms
+inputRate = 200  # Hz
+inputWeight = 0.5  # uS
+tolerance = 1.0  # ms; max allowed difference between matching spike times (fixed dt)
+refDt = 0.00005  # ms; dt of the reference for the variable time step variants
+cvodeTolerance = 1.5  # ms; max allowed difference between matching spike times (variable time step)
+cvodeAtol = 1e-10  # CVODE absolute tolerance
+# Izhi2007b vs the original explicit Euler version: (max difference of matching spike times (ms), or None
+# to compare counts only; max difference in spike count)
+eulerTolerances = {'RS': (0.05, 0), 'IB': (0.25, 0), 'CH': (0.1, 0), 'LTS': (2.5, 0), 'FS': (None, 4), 'TC': (0.05, 0),
+                   'RTN': (0.5, 0)}
+
+
+def inputTimes(seed=1):
+    rng = np.random.default_rng(seed)
+    times = np.cumsum(rng.exponential(1000.0 / inputRate, size=int(duration * inputRate / 1000 * 2)))
+    return times[times < duration]
+
+
+def makeSectioned(params, mechanism='Izhi2007b'):
+    """Izhi2007b (or another point process with its parameters) on a dummy soma (as in the NetPyNE Izhi cell rules) with an ExpSyn"""
+    soma = h.Section(name='soma')
+    soma.diam, soma.L, soma.cm = 10, 10, 31.831
+    izh = getattr(h, mechanism)(0.5, sec=soma)
+    for name, value in params.items():
+        setattr(izh, name, value)
+    syn = h.ExpSyn(0.5, sec=soma)
+    syn.tau, syn.e = 0.1, 0
+    spikes = h.NetCon(izh, None)  # spikes from net_event() in NET_RECEIVE, as for the ARTIFICIAL_CELL
+    return {'soma': soma, 'izh': izh, 'syn': syn, 'target': syn, 'spikes': spikes}
+
+
+def makeEuler(params):
+    """Original explicit Euler Izhi2007b (reference/izhi2007b_euler.mod) on a dummy soma with an ExpSyn"""
+    return makeSectioned(params, 'Izhi2007bEuler')
+
+
+def makeArt(params):
+    """Section-free Izhi2007bArt"""
+    izh = h.Izhi2007bArt()
+    for name, value in params.items():
+        setattr(izh, name, value)
+    izh.tauSyn, izh.eSyn = 0.1, 0
+    spikes = h.NetCon(izh, None)
+    return {'izh': izh, 'target': izh, 'spikes': spikes}
+
+
+def run(make, params, times, cvode=False, localDt=False, refDt=dt):
+    """Simulate one cell driven by the input spike times; return its spike times"""
+    cell = make(params)
+    nc = h.NetCon(None, cell['target'])
+    nc.weight[0] = inputWeight
+    spkt = h.Vector()
+    cell['spikes'].record(spkt)
+
+    h.cvode_active(int(cvode))
+    h.CVode().use_local_dt(int(localDt))
+    h.dt = refDt
+    h.finitialize(-65)
+    for t in times:
+        nc.event(t)
+    h.continuerun(duration)
+    h.CVode().use_local_dt(0)
+    h.cvode_active(0)
+    return np.array(spkt)
+
+
+def compare(ref, test):
+    """Return (max and median abs difference of matched spike times, difference in spike count) of whole trains"""
+    n = min(len(ref), len(test))
+    diffs = np.abs(ref[:n] - test[:n])
+    return (float(diffs.max()) if n else 0.0), (float(np.median(diffs)) if n else 0.0), len(test) - len(ref)
+
+
+# variant: (reference dt, run() arguments)
+variants = {'art': (dt, dict(make=makeArt)),
+            'cvode': (refDt, dict(make=makeSectioned, cvode=True)),
+            'lvardt': (refDt, dict(make=makeSectioned, cvode=True, localDt=True))}
+
+if __name__ == '__main__':
+    startup.loadMechanisms(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reference'))
+    times = inputTimes()
+    failed = []
+    h.CVode().atol(cvodeAtol)
+    for label, params in izhiTypes.items():
+        refs = {}
+        for variant, (variantDt, kwargs) in variants.items():
+            if variantDt not in refs:
+                refs[variantDt] = run(makeSectioned, params, times, refDt=variantDt)
+            ref = refs[variantDt]
+            test = run(params=params, times=times, **kwargs)
+            maxDiff, medianDiff, countDiff = compare(ref, test)
+            ok = countDiff == 0 and maxDiff <= (tolerance if variantDt == dt else cvodeTolerance)
+            print('%-4s %-6s spikes: %4d vs %4d  max |dt|: %6.3f ms  median: %5.3f ms  %s'
+                  % (label, variant, len(ref), len(test), maxDiff, medianDiff, 'ok' if ok else 'FAIL'))
+            if not ok:
+                failed.append((label, variant))
+        ref = run(makeEuler, params, times)
+        maxDiff, medianDiff, countDiff = compare(ref, refs[dt])
+        maxTolerance, countTolerance = eulerTolerances[label]
+        ok = abs(countDiff) <= countTolerance and (maxTolerance is None or maxDiff <= maxTolerance)
+        print('%-4s %-6s spikes: %4d vs %4d  max |dt|: %6.3f ms  median: %5.3f ms  %s'
+              % (label, 'euler', len(ref), len(refs[dt]), maxDiff, medianDiff, 'ok' if ok else 'FAIL'))
+        if not ok:
+            failed.append((label, 'euler'))
+    sys.exit(1 if failed else 0)
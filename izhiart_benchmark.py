@@ -0,0 +1,98 @@
+"""
+izhiart_benchmark.py
+
+Benchmark of Izhi2007bArt (section-free) vs Izhi2007b on a dummy soma
+
+Izhi2007bArt has no cable-equation node, but advances itself with a self-event every
+dtInt ms while it is away from rest, and an event costs more than a fixed-dt step of a
+one-node section. So it only pays off for cells that are at rest most of the time:
+  rates     - numCells RS cells, each driven by its own Poisson input of rate Hz
+              (weight uS, through an ExpSyn for the sectioned cell), run for duration
+              ms at dt = dtInt; reports the run time of both, the art cells' share of
+              the time away from rest, and their firing rate
+  cellmodels - cellmodels.py with izhiModel = 'Izhi' and 'Izhi2007bArt' (in sweep.py
+              workers): NEURON run time of the whole network (50 HH + 50 Izhi cells)
+
+Usage: nrnivmodl; python izhiart_benchmark.py [numCells] [duration (ms)]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from neuron import h
+
+import izhi_check
+import sweep
+
+h.load_file('stdrun.hoc')
+
+rates = [0.1, 1, 5, 20, 100]  # Hz, input of each cell
+weight = 0.05  # uS
+dt = 0.025  # ms
+
+
+def runRate(make, numCells, rate, duration):
+    """Run numCells cells made by make() with Poisson inputs of rate Hz; return (run time (s), spikes, cells, inputs)"""
+    cells, stims, ncs = [], [], []
+    spkt = h.Vector()
+    for i in range(numCells):
+        cell = make(izhi_check.izhiTypes['RS'])
+        stim = h.NetStim()
+        stim.interval, stim.number, stim.start, stim.noise = 1000.0 / rate, 1e9, 0, 1
+        stim.noiseFromRandom123(i, 0, 0)
+        nc = h.NetCon(stim, cell['target'])
+        nc.weight[0], nc.delay = weight, 1
+        cell['spikes'].record(spkt)
+        cells.append(cell)
+        stims.append(stim)
+        ncs.append(nc)
+    h.dt = dt
+    h.finitialize(-65)
+    start = time.time()
+    h.continuerun(duration)
+    return time.time() - start, len(spkt), cells, (stims, ncs)
+
+
+def compareRates(numCells, duration):
+    print('%8s %14s %10s %10s %8s %12s' % ('rate (Hz)', 'sectioned (s)', 'art (s)', 'speedup', 'awake', 'spikes (Hz)'))
+    for rate in rates:
+        tSectioned = runRate(izhi_check.makeSectioned, numCells, rate, duration)[0]
+        awake = h.Vector()
+        tArt, numSpikes, cells, inputs = runRate(izhi_check.makeArt, numCells, rate, duration)
+        # time away from rest: share of the steps the art cells are not idle, in a second run sampled every step
+        h.finitialize(-65)
+        while h.t < duration - dt / 2:
+            h.fadvance()
+            awake.append(np.mean([1 - cell['izh'].idle for cell in cells]))
+        print('%8g %14.3f %10.3f %9.2fx %7.0f%% %12.2f' % (rate, tSectioned, tArt, tSectioned / tArt,
+                                                           100 * awake.mean(), numSpikes / float(numCells) / duration * 1000))
+
+
+def compareCellmodels(duration):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cellmodels.py')
+    points = [{'izhiModel': model, 'simConfig.duration': duration, 'simConfig.recordTraces': {}}
+              for model in ['Izhi', 'Izhi2007bArt']]
+    cacheDir = tempfile.mkdtemp(prefix='izhiart_benchmark_')  # never reuse a cached result
+    try:
+        results = sweep.run(script, points, cacheDir=cacheDir, workers=1)
+    finally:
+        shutil.rmtree(cacheDir, ignore_errors=True)
+    print('\ncellmodels.py, %g ms' % duration)
+    print('%-14s %10s %18s' % ('izhiModel', 'run (s)', 'PYR_Izhi rate (Hz)'))
+    for point, result in zip(points, results):
+        if result is None:
+            print('%-14s failed' % point['izhiModel'])
+            continue
+        print('%-14s %10.3f %18.2f' % (point['izhiModel'], result['timing']['runTime'], result['popRates']['PYR_Izhi']))
+
+
+if __name__ == '__main__':
+    numCells = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    print('%d RS cells, %g ms, input weight %g uS' % (numCells, duration, weight))
+    compareRates(numCells, duration)
+    compareCellmodels(duration)
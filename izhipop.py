@@ -0,0 +1,475 @@
+"""
+izhipop.py
+
+Vectorized NumPy engine for networks of Izhi2007b cells
+
+Instead of one NEURON Section plus one Izhi2007b point process per cell, a whole
+population is stored as flat arrays (v, u, b, derivtype and per-cell parameters)
+and advanced with one batched step. The update mirrors izhi2007b.mod, including
+the LTS/TC vpeak shifts, the FS cubic U(v) and the TC/RTN b switching, and takes
+NEURON's fixed step: izhipop_check.py checks the spike trains of each cell type
+against NEURON.
+
+The network (cells, conns, stims) is still built by NetPyNE as a Python structure
+(createNEURONObj = False), so connectivity rules and seeds behave exactly as in the
+NEURON backend. Spikes are returned in sim.allSimData['spkt'] / ['spkid'] and
+traces of simConfig.recordTraces in sim.allSimData[traceKey], so the standard
+analysis functions (plotRaster, plotTraces, plotRatePSD, ...) work unchanged.
+
+Usage:
+  import izhipop
+  izhipop.createSimulateAnalyze(netParams, simConfig)  # instead of sim.createSimulateAnalyze
+
+"""
+
+from collections import defaultdict
+
+import numpy as np
+from netpyne import sim
+from netpyne.specs import Dict
+
+# parameter defaults as declared in the PARAMETER block of izhi2007b.mod
+izhiDefaults = {'C': 1, 'k': 0.7, 'vr': -60, 'vt': -40, 'vpeak': 35, 'a': 0.03, 'b': -2, 'c': -50, 'd': 100,
+                'Iin': 0, 'celltype': 1, 'alive': 1}
+
+# b values used by TC (6) and RTN (7) cells above / below -65 mV
+bSwitch = {6: (0, 15), 7: (2, 10)}
+
+
+###############################################################################
+#
+# IZHIKEVICH POPULATION
+#
+###############################################################################
+
+class IzhiPop(object):
+    """
+    Population of Izhi2007b cells stored as flat NumPy arrays
+
+    Parameters
+    ----------
+    params : dict
+        Izhi2007b parameters (see ``izhiDefaults``); each value is a scalar or an array with one entry per cell.
+
+    numCells : int
+        Number of cells in the population.
+
+    cap : float or array
+        Membrane capacitance of each cell in nF (cm * area of the soma the point process would sit on).
+        **Default:** ``0.1`` (diam = L = 10 um, cm = 31.831 uF/cm2).
+
+    synMechs : list of tuple
+        ``(tau, e)`` of each ExpSyn-type synaptic mechanism (conductance in uS, like ExpSyn).
+        **Default:** ``[]``
+
+    """
+
+    def __init__(self, params, numCells, cap=0.1, synMechs=None):
+        self.numCells = numCells
+        for name, default in izhiDefaults.items():
+            value = np.broadcast_to(np.asarray(params.get(name, default), dtype=float), (numCells,))
+            setattr(self, name, value.copy())
+        self.celltype = self.celltype.astype(int)
+        self.alive = self.alive.astype(bool)
+        self.cap = np.broadcast_to(np.asarray(cap, dtype=float), (numCells,)).copy()
+
+        synMechs = synMechs or []
+        self.synTau = np.array([tau for tau, e in synMechs], dtype=float).reshape(-1, 1)
+        self.synE = np.array([e for tau, e in synMechs], dtype=float).reshape(-1, 1)
+
+        # boolean masks for the celltype-specific branches of izhi2007b.mod
+        self.isLTS = self.celltype == 4
+        self.isFS = self.celltype == 5
+        self.isTC = self.celltype == 6
+        self.isRTN = self.celltype == 7
+        self.bHigh = np.where(self.isTC, bSwitch[6][0], bSwitch[7][0]).astype(float)
+        self.bLow = np.where(self.isTC, bSwitch[6][1], bSwitch[7][1]).astype(float)
+        self.bSwitched = self.isTC | self.isRTN
+        self.b0 = self.b.copy()
+        self.vswitch = np.where(self.isFS, self.d, -65.0)
+
+        self.init()
+
+    def init(self):
+        """Reset state variables as in the INITIAL block / first NET_RECEIVE event of izhi2007b.mod"""
+        self.v = self.vr.copy()
+        self.u = np.zeros(self.numCells)
+        self.b = np.where(self.bSwitched, np.where(self.v > -65, self.bHigh, self.bLow), self.b0)
+        self.derivtype = np.where(self.isFS & (self.v > self.d), 1, 2)
+        self.above, self.below = self.v > self.vswitch, self.v < self.vswitch
+        self.g = np.zeros((len(self.synTau), self.numCells))
+
+    def step(self, dt):
+        """
+        Advance all cells by one time step of ``dt`` ms
+
+        Returns
+        -------
+        spiked : array of int
+            Indices of the cells that crossed threshold during this step (only those with ``alive`` set).
+
+        """
+        v, u = self.v, self.u
+
+        # membrane: backward Euler on the current linearized around v, as NEURON's fixed step
+        iIzhi = (self.k * (v - self.vr) * (v - self.vt) - u + self.Iin) / self.C / 1000  # inward, nA
+        gIzhi = -self.k * (2 * v + 0.001 - self.vr - self.vt) / self.C / 1000  # d(outward current)/dv, uS, by NEURON's difference over 0.001 mV
+        if len(self.g):
+            gSum = self.g.sum(axis=0)
+            gE = (self.g * self.synE).sum(axis=0)
+            v = v + dt * (iIzhi + gE - gSum * v) / (self.cap + dt * (gIzhi + gSum))
+            self.g *= np.exp(-dt / self.synTau)
+        else:
+            v = v + dt * iIzhi / (self.cap + dt * gIzhi)
+
+        # recovery variable (cnexp); FS cells use the nonlinear U(v) = 0.025*(v-d)**3 above d (d=vb)
+        uinf = self.b * (v - self.vr)
+        if self.isFS.any():
+            uinf = np.where(self.isFS, np.where(v > self.d, 0.025 * (v - self.d) ** 3, 0.0), uinf)
+        u = u + (1 - np.exp(-dt * self.a)) * (uinf - u)
+
+        # TC/RTN b switching and FS derivtype on crossings of vswitch (WATCH (v > vswitch) / (v < vswitch))
+        up, down = (v > self.vswitch) & ~self.above, (v < self.vswitch) & ~self.below
+        if self.bSwitched.any():
+            self.b = np.where(self.bSwitched & up, self.bHigh, np.where(self.bSwitched & down, self.bLow, self.b))
+        if self.isFS.any():
+            self.derivtype = np.where(self.isFS & up, 1, np.where(self.isFS & down, 2, self.derivtype))
+        self.above, self.below = v > self.vswitch, v < self.vswitch
+
+        # threshold crossing (WATCH statements with celltype-specific vpeak)
+        vthresh = np.where(self.isLTS, self.vpeak - 0.1 * u, np.where(self.isTC, self.vpeak + 0.1 * u, self.vpeak))
+        crossed = np.flatnonzero(v > vthresh)
+        if len(crossed):
+            ct, uc = self.celltype[crossed], u[crossed]
+            c, d = self.c[crossed], self.d[crossed]
+            v[crossed] = np.where(ct == 4, c + 0.04 * uc, np.where(ct == 6, c - 0.1 * uc, c))
+            u[crossed] = np.where(ct == 4, np.minimum(uc + d, 670), np.where(ct == 5, uc, uc + d))
+
+        self.v, self.u = v, u
+        return crossed[self.alive[crossed]]
+
+
+###############################################################################
+#
+# NETWORK SIMULATION
+#
+###############################################################################
+
+def netStimTimes(rng, interval, noise, start, number, tstop):
+    """
+    Generate spike times of a set of NetStims with NEURON's NetStim noise model
+
+    Each interval is ``(1-noise)*interval + noise*interval*exprand(1)``, and the first spike occurs
+    on average at ``start + noise*interval`` (see netstim.mod).
+
+    Parameters
+    ----------
+    rng : numpy.random.Generator
+        Random number generator.
+
+    interval, noise, start, number : array
+        NetStim parameters, one entry per spike train.
+
+    tstop : float
+        Spikes after tstop are discarded.
+
+    Returns
+    -------
+    times : list of array
+        Spike times of each train.
+
+    """
+    interval, noise = np.asarray(interval, dtype=float), np.clip(np.asarray(noise, dtype=float), 0, 1)
+    start, number = np.asarray(start, dtype=float), np.asarray(number, dtype=float)
+    numTrains = len(interval)
+    if numTrains == 0:
+        return []
+    active = (start >= 0) & (number > 0)
+
+    # trains are drawn in chunks until each one passes tstop or has number spikes: with noise
+    # (Poisson at noise = 1), a train can hold many more spikes than tstop / interval
+    chunkSize = int(min(np.ceil(tstop / max(interval.min(), 1e-9) * 1.2) + 10, max(number.max(), 1)))
+    chunks = []
+    last = (start - interval * (1 - noise))[:, None]
+    while True:
+        intervals = (1 - noise[:, None]) * interval[:, None] + noise[:, None] * interval[:, None] * rng.exponential(size=(numTrains, chunkSize))
+        chunks.append(np.cumsum(intervals, axis=1) + last)
+        last = chunks[-1][:, -1:]
+        numSpikes = chunkSize * len(chunks)
+        if not np.any(active & (last[:, 0] <= tstop) & (number > numSpikes)):
+            break
+    times = np.concatenate(chunks, axis=1)
+    times[:, 0] = np.maximum(times[:, 0], 0)
+    valid = (times <= tstop) & (np.arange(numSpikes)[None, :] < number[:, None]) & active[:, None]
+    return [times[i, valid[i]] for i in range(numTrains)]
+
+
+def _izhiPointp(cell):
+    """Return (sec, label, pointp params) of the Izhi2007b point process of a cell in the Python structure"""
+    for secName, sec in cell.secs.items():
+        for label, pointp in sec.get('pointps', {}).items():
+            if pointp.get('mod') == 'Izhi2007b':
+                return secName, label, pointp
+    return None, None, None
+
+
+def traceSamplers(recordTraces, pointpLabels, synMechLabels):
+    """
+    Functions giving the value of each trace of simConfig.recordTraces from the population state
+
+    Supported traces: the soma voltage (``var`` v with no mech), ``u`` and ``i`` of the Izhi2007b
+    point process, and ``g`` and ``i`` of an ExpSyn synMech. The v of a cell that spikes in a step
+    is sampled after its reset (NEURON samples the value that crossed vpeak).
+
+    Returns
+    -------
+    samplers : dict
+        ``{traceKey: function(pop, idx)}`` returning the values of the cells at indices idx.
+
+    """
+    samplers = {}
+    for key, spec in recordTraces.items():
+        var = spec.get('var')
+        if set(spec) - {'sec', 'loc', 'var', 'pointp', 'synMech'}:
+            sampler = None
+        elif 'pointp' in spec:
+            sampler = {'u': lambda pop, idx: pop.u[idx],
+                       'i': lambda pop, idx: -(pop.k[idx] * (pop.v[idx] - pop.vr[idx]) * (pop.v[idx] - pop.vt[idx])
+                                               - pop.u[idx] + pop.Iin[idx]) / pop.C[idx] / 1000}.get(var)
+            sampler = sampler if spec['pointp'] in pointpLabels else None
+        elif 'synMech' in spec:
+            m = synMechLabels.index(spec['synMech']) if spec['synMech'] in synMechLabels else None
+            sampler = None if m is None else {'g': lambda pop, idx, m=m: pop.g[m, idx],
+                                              'i': lambda pop, idx, m=m: pop.g[m, idx] * (pop.v[idx] - pop.synE[m, 0])}.get(var)
+        else:
+            sampler = (lambda pop, idx: pop.v[idx]) if var == 'v' else None
+        if sampler is None:
+            raise ValueError('Cannot record trace %s (%s); izhipop records v, the u and i of Izhi2007b and the g and i '
+                             'of ExpSyn synMechs' % (key, dict(spec)))
+        samplers[key] = sampler
+    return samplers
+
+
+def createNet(netParams, simConfig):
+    """
+    Create the network as a NetPyNE Python structure, without NEURON objects
+
+    Returns
+    -------
+    net : dict
+        ``pop`` (IzhiPop), ``gids`` (array of gids), ``conns`` (preIdx, postIdx, mech, weight, delay arrays),
+        ``stims`` (postIdx, mech, weight, delay, times) ready for ``simulate``, and the ``pointpLabels``
+        and ``synMechLabels`` used by ``traceSamplers``.
+
+    """
+    simConfig.createNEURONObj = False
+    simConfig.createPyStruct = True
+
+    sim.initialize(netParams, simConfig)
+    sim.net.createPops()
+    sim.net.createCells()
+    sim.net.connectCells()
+    sim.net.addStims()
+
+    cells = sim.net.cells
+    gids = np.array([cell.gid for cell in cells], dtype=int)
+    gid2idx = {gid: i for i, gid in enumerate(gids)}
+
+    params = {name: np.zeros(len(cells)) for name in izhiDefaults}
+    cap = np.zeros(len(cells))
+    pointpLabels = set()
+    for i, cell in enumerate(cells):
+        secName, label, pointp = _izhiPointp(cell)
+        if pointp is None:
+            raise ValueError('Cell %d (pop %s) has no Izhi2007b point process; izhipop only simulates Izhi2007b networks'
+                             % (cell.gid, cell.tags['pop']))
+        pointpLabels.add(label)
+        for name, default in izhiDefaults.items():
+            params[name][i] = pointp.get(name, default)
+        geom = cell.secs[secName].get('geom', {})
+        area = np.pi * geom.get('diam', 500 / np.pi) * geom.get('L', 100)  # um2 (NEURON section defaults)
+        cap[i] = geom.get('cm', 1) * area * 1e-5  # uF/cm2 * um2 -> nF
+
+    synMechLabels = list(netParams.synMechParams.keys())
+    synMechs = []
+    for label in synMechLabels:
+        mech = netParams.synMechParams[label]
+        if mech['mod'] != 'ExpSyn':
+            raise ValueError('Synaptic mechanism %s uses %s; izhipop only supports ExpSyn' % (label, mech['mod']))
+        synMechs.append((mech.get('tau', 0.1), mech.get('e', 0)))
+    if not synMechs:
+        synMechs.append((0.1, 0))  # ExpSyn defaults, used when conns leave synMech unset
+    defaultMech = netParams.defaultSynMech if getattr(netParams, 'defaultSynMech', None) in synMechLabels else None
+
+    def mechIndex(conn):
+        label = conn.get('synMech') or defaultMech
+        return synMechLabels.index(label) if label in synMechLabels else 0
+
+    conns = defaultdict(list)
+    stims = defaultdict(list)
+    stimParams = []
+    for i, cell in enumerate(cells):
+        stimSources = {stim['source']: stim for stim in cell.stims if stim.get('type') == 'NetStim'}
+        for conn in cell.conns:
+            if conn['preGid'] == 'NetStim':
+                stim = stimSources[conn['preLabel']]
+                stims['postIdx'].append(i)
+                stims['mech'].append(mechIndex(conn))
+                stims['weight'].append(conn['weight'])
+                stims['delay'].append(conn['delay'])
+                stimParams.append((1000.0 / stim['rate'] if stim.get('rate') else stim.get('interval', 10),
+                                   stim.get('noise', 0), stim.get('start', 0), stim.get('number', 1e9)))
+            elif conn['preGid'] in gid2idx:
+                conns['preIdx'].append(gid2idx[conn['preGid']])
+                conns['postIdx'].append(i)
+                conns['mech'].append(mechIndex(conn))
+                conns['weight'].append(conn['weight'])
+                conns['delay'].append(conn['delay'])
+            elif simConfig.verbose:
+                print('  Warning: skipping conn from unknown presynaptic gid %s to gid %d' % (conn['preGid'], cell.gid))
+
+    rng = np.random.default_rng(simConfig.seeds['stim'])
+    interval, noise, start, number = (np.array(p, dtype=float).reshape(-1) for p in zip(*stimParams)) if stimParams else [np.zeros(0)] * 4
+    stims['times'] = netStimTimes(rng, interval, noise, start, number, simConfig.duration)
+
+    conns = {key: np.array(conns[key], dtype=int if key in ['preIdx', 'postIdx', 'mech'] else float)
+             for key in ['preIdx', 'postIdx', 'mech', 'weight', 'delay']}
+    stims.update({key: np.array(stims[key], dtype=int if key in ['postIdx', 'mech'] else float)
+                  for key in ['postIdx', 'mech', 'weight', 'delay']})
+
+    pop = IzhiPop(params, len(cells), cap=cap, synMechs=synMechs)
+    return {'pop': pop, 'gids': gids, 'conns': conns, 'stims': dict(stims), 'pointpLabels': pointpLabels,
+            'synMechLabels': synMechLabels}
+
+
+def simulate(net, duration, dt, record=None):
+    """
+    Run the network for ``duration`` ms with time step ``dt``
+
+    Synaptic events (recurrent and background) are delivered at the first time step at or after
+    spike time + delay, as with NetCons at fixed dt.
+
+    Parameters
+    ----------
+    record : tuple
+        ``(idx, recordStep, samplers)``: traces (see ``traceSamplers``) of the cells at indices idx
+        to sample every recordStep ms from t = 0 to before duration, as NEURON's Vector.record.
+        **Default:** ``None`` records no traces.
+
+    Returns
+    -------
+    spkt, spkid : array
+        Spike times (ms) and gids, sorted by time.
+
+    traces : dict
+        ``{traceKey: array (cells in idx x samples)}``; empty if record is None.
+
+    """
+    pop, gids, conns, stims = net['pop'], net['gids'], net['conns'], net['stims']
+    numSteps = int(round(duration / dt))
+    numCells = pop.numCells
+    pop.init()
+
+    traces = {}
+    if record:
+        recordIdx, recordStep, samplers = record
+        stepsPerSample = max(int(round(recordStep / dt)), 1)
+        numSamples = (numSteps - 1) // stepsPerSample + 1
+        traces = {key: np.zeros((len(recordIdx), numSamples)) for key in samplers}
+        for key, sampler in samplers.items():
+            traces[key][:, 0] = sampler(pop, recordIdx)
+
+    # event queue: step -> list of (flat index into pop.g, weight)
+    queue = defaultdict(list)
+
+    # background events are known in advance
+    if len(stims['postIdx']):
+        counts = np.array([len(times) for times in stims['times']])
+        stimSteps = np.round((np.concatenate(stims['times']) + np.repeat(stims['delay'], counts)) / dt).astype(int)
+        flat = np.repeat(stims['mech'] * numCells + stims['postIdx'], counts)
+        weight = np.repeat(stims['weight'], counts)
+        order = np.argsort(stimSteps, kind='stable')
+        stimSteps, flat, weight = stimSteps[order], flat[order], weight[order]
+        bounds = np.flatnonzero(np.diff(stimSteps)) + 1
+        for s, f, w in zip(np.split(stimSteps, bounds), np.split(flat, bounds), np.split(weight, bounds)):
+            if s[0] <= numSteps:
+                queue[s[0]].append((f, w))
+
+    # recurrent conns grouped by presynaptic cell (CSR)
+    order = np.argsort(conns['preIdx'], kind='stable')
+    connPtr = np.searchsorted(conns['preIdx'][order], np.arange(numCells + 1))
+    connFlat = (conns['mech'] * numCells + conns['postIdx'])[order]
+    connWeight = conns['weight'][order]
+    connSteps = np.maximum(np.round(conns['delay'] / dt).astype(int), 1)[order]
+
+    spkt, spkid = [], []
+    gFlat = pop.g.reshape(-1)
+    for step in range(numSteps):
+        for f, w in queue.pop(step, []):
+            np.add.at(gFlat, f, w)
+        spiked = pop.step(dt)
+        if record and (step + 1) % stepsPerSample == 0 and step + 1 < numSteps:
+            for key, sampler in samplers.items():
+                traces[key][:, (step + 1) // stepsPerSample] = sampler(pop, recordIdx)
+        if len(spiked):
+            t = (step + 1) * dt
+            spkt.append(np.full(len(spiked), t))
+            spkid.append(gids[spiked])
+            idx = np.concatenate([np.arange(connPtr[i], connPtr[i + 1]) for i in spiked])
+            if len(idx):
+                targetSteps = step + 1 + connSteps[idx]
+                for s in np.unique(targetSteps):
+                    sel = targetSteps == s
+                    queue[s].append((connFlat[idx[sel]], connWeight[idx[sel]]))
+
+    spkt = np.concatenate(spkt) if spkt else np.zeros(0)
+    spkid = np.concatenate(spkid) if spkid else np.zeros(0, dtype=int)
+    return spkt, spkid, traces
+
+
+# ------------------------------------------------------------------------------
+# Wrapper to create, simulate, and analyse network
+# ------------------------------------------------------------------------------
+def createSimulateAnalyze(netParams, simConfig):
+    """
+    Drop-in replacement for sim.createSimulateAnalyze() for networks made only of Izhi2007b cells
+
+    Spikes are recorded, and the traces of simConfig.recordTraces supported by ``traceSamplers``
+    for the cells of simConfig.recordCells and of the plotTraces include, as NetPyNE does;
+    other traces raise a ValueError.
+
+    """
+    net = createNet(netParams, simConfig)
+
+    record = None
+    if sim.cfg.recordTraces:
+        if sim.cfg.recordStep == 'adaptive':
+            raise ValueError('izhipop records traces at a fixed recordStep, not adaptive')
+        samplers = traceSamplers(sim.cfg.recordTraces, net['pointpLabels'], net['synMechLabels'])
+        plotTraces = sim.cfg.analysis.get('plotTraces')
+        include = list(sim.cfg.recordCells) + list(plotTraces.get('include', []) if isinstance(plotTraces, dict) else [])
+        gid2idx = {gid: i for i, gid in enumerate(net['gids'])}
+        recordGids = sorted(set(cell.gid for cell in sim.getCellsList(include)))
+        if recordGids:
+            record = (np.array([gid2idx[gid] for gid in recordGids], dtype=int), sim.cfg.recordStep, samplers)
+
+    sim.simData = Dict()
+    sim.timing('start', 'runTime')
+    if sim.rank == 0:
+        print('\nRunning simulation using izhipop (NumPy) for %s ms...' % sim.cfg.duration)
+    spkt, spkid, traces = simulate(net, sim.cfg.duration, sim.cfg.dt, record=record)
+    sim.timing('stop', 'runTime')
+    if sim.cfg.timing:
+        print('  Done; run time = %0.2f s; real-time ratio: %0.2f.'
+              % (sim.timingData['runTime'], sim.cfg.duration / 1000 / sim.timingData['runTime']))
+
+    sim.simData['spkt'] = list(spkt)
+    sim.simData['spkid'] = list(spkid.astype(float))
+    for key, values in traces.items():
+        sim.simData[key] = Dict({'cell_%d' % gid: list(trace) for gid, trace in zip(recordGids, values)})
+        if sim.cfg.recordTime:
+            sim.simData['t'] = list(np.arange(values.shape[1]) * sim.cfg.recordStep)
+    sim.gatherData()
+
+    sim.saveData()
+    sim.analysis.plotData()
@@ -0,0 +1,55 @@
+"""
+izhipop_check.py
+
+Check that the izhipop engine produces the same spikes as Izhi2007b in NEURON
+
+For each of the seven cell types, a single cell is driven by the same random input
+spike train (izhi_check.inputTimes, on the dt grid so both deliver each event at the
+same step) through an ExpSyn (tau 0.1, e 0), once as Izhi2007b on a dummy soma in NEURON
+and once as a one-cell izhipop network, both at dt. Their whole spike trains must have
+the same number of spikes, each within the tolerance of the cell type. The engine takes
+the same backward Euler step as NEURON (with its di/dv over 0.001 mV), so the trains
+differ only by roundoff: one step at most, except for FS (C = 0.2), which amplifies it
+under strong input to a few late spikes up to 0.45 ms apart (median 0). The max and
+median differences are reported.
+
+Usage: nrnivmodl; python izhipop_check.py
+"""
+
+import sys
+import numpy as np
+
+import izhi_check
+import izhipop
+
+# ms; max allowed difference between matching spike times of each cell type
+tolerances = {'RS': 0.025, 'IB': 0.025, 'CH': 0.025, 'LTS': 0.025, 'FS': 0.5, 'TC': 0.025, 'RTN': 0.025}
+
+
+def runIzhipop(params, times):
+    """Simulate one cell as an izhipop network driven by the input spike times; return its spike times"""
+    cap = 31.831 * np.pi * 10 * 10 * 1e-5  # nF, the soma of izhi_check.makeSectioned
+    pop = izhipop.IzhiPop(params, 1, cap=cap, synMechs=[(0.1, 0)])
+    conns = {key: np.zeros(0, dtype=int if key in ['preIdx', 'postIdx', 'mech'] else float)
+             for key in ['preIdx', 'postIdx', 'mech', 'weight', 'delay']}
+    stims = {'postIdx': np.zeros(1, dtype=int), 'mech': np.zeros(1, dtype=int),
+             'weight': np.array([izhi_check.inputWeight]), 'delay': np.zeros(1), 'times': [times]}
+    net = {'pop': pop, 'gids': np.zeros(1, dtype=int), 'conns': conns, 'stims': stims}
+    spkt, _, _ = izhipop.simulate(net, izhi_check.duration, izhi_check.dt)
+    return spkt
+
+
+if __name__ == '__main__':
+    dt = izhi_check.dt
+    times = np.unique(np.round(izhi_check.inputTimes() / dt)) * dt
+    failed = []
+    for label, params in izhi_check.izhiTypes.items():
+        ref = izhi_check.run(izhi_check.makeSectioned, params, times)
+        test = runIzhipop(params, times)
+        maxDiff, medianDiff, countDiff = izhi_check.compare(ref, test)
+        ok = countDiff == 0 and maxDiff <= tolerances[label]
+        print('%-4s spikes: %4d vs %4d  max |dt|: %6.3f ms  median: %5.3f ms  (tolerance %g ms)  %s'
+              % (label, len(ref), len(test), maxDiff, medianDiff, tolerances[label], 'ok' if ok else 'FAIL'))
+        if not ok:
+            failed.append(label)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,32 @@
+"""
+jsonkey.py
+
+Stable hashes of parameter structures (netParams, simConfig) for cache and run keys
+
+netParams and simConfig hold numpy values, NetPyNE Dicts and sometimes functions, which
+json cannot serialize: jsonDefault() turns them into plain values (functions into their
+repr, which includes their address, so keys of structures with functions never match).
+Used by netcache.py (network keys), checkpoint.py (run keys) and colstore.py (headers).
+
+Usage:
+  import jsonkey
+  key = jsonkey.hashKey({'netParams': netParams.todict(), 'seeds': simConfig.seeds})
+
+"""
+
+import hashlib
+import json
+
+
+def jsonDefault(obj):
+    """json.dump default for numpy values, NetPyNE Dicts and anything else (by repr)"""
+    if hasattr(obj, 'tolist'):  # numpy arrays and scalars
+        return obj.tolist()
+    if hasattr(obj, 'todict'):
+        return obj.todict()
+    return repr(obj)  # functions etc. (repr includes the address, so these never hit)
+
+
+def hashKey(content):
+    """SHA-1 hex digest of content as JSON with sorted keys"""
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=jsonDefault).encode()).hexdigest()
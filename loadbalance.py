@@ -0,0 +1,312 @@
+"""
+loadbalance.py
+
+Cost-aware distribution of cells across MPI ranks
+
+NetPyNE hands out the cells of each population round-robin, which gives every rank the
+same number of cells but not the same work when populations differ in cost (e.g. the
+2-compartment HH cells and the single-node Izhi cells of cellmodels.py). Here the cost
+of a cell of each population is estimated, and cells are assigned greedily, most
+expensive first, to the rank with the least total cost so far. Gids do not change, only
+which rank owns each cell (conn rules with string functions draw their random numbers
+per rank, so with NetPyNE's connectivity the network can differ slightly; with
+simConfig.vectorConns it is the same).
+
+Cost of a cell:
+  'rule'      - from the cell rules: segments x (1 + cost of their mechanisms), point
+                processes, and the expected number of synapses (conn rules and stims)
+  'calibrate' - measured: rank 0 simulates calibrationCells cells of each population
+                alone for calibrationTime ms (without connections or stims), and the
+                costs are broadcast to all ranks
+
+After the run, the computation time of each rank (pc.step_time(), without waiting for
+spike exchange) is reported with the imbalance (max / mean). The imbalance and the max and
+mean computation times are stored in sim.timingData (loadImbalance, maxComputeTime,
+meanComputeTime), and the per-rank lists in sim.loadBalanceReport.
+
+The assignment evens out the estimated cost, which does not make the measured time even:
+with 4 ranks on cellmodels.py the measured imbalance was 1.10 with round-robin, 1.14 with
+'rule' and 1.11 with 'calibrate' (on a single core, so the per-rank times were mostly
+oversubscription noise). For the example networks, whose populations have the same
+number of cells, round-robin already gives every rank the same mix of cells; the
+estimated imbalance only improves when a rank holds few cells (loadbalance_check.py,
+e.g. cellmodels at 16 ranks: 1.153 -> 1.087). Measure both on the target machine
+before relying on it.
+
+Usage:
+  simConfig.loadBalance = 'rule'  # or 'calibrate', or 'roundrobin' (NetPyNE's, only the report); used by simtools
+
+  mpiexec -n 4 nrniv -python -mpi cellmodels.py  # several MPI processes on one machine
+
+"""
+
+import heapq
+import time
+
+import numpy as np
+from netpyne import sim
+from netpyne.network.pop import Pop
+from neuron import h
+
+import connbuild
+
+# relative cost of a segment, of a density mechanism in it (per segment), of a point process and of a synapse
+segCost = 1.0
+mechCosts = {'hh': 3.0, 'pas': 0.5}
+defaultMechCost = 1.0
+pointpCost = 2.0
+synCost = 0.5
+
+# relative cost of point cells (no sections) by cellModel
+pointCellCosts = {'NetStim': 0.1, 'VecStim': 0.1, 'IntFire1': 0.1, 'IntFire2': 0.2, 'IntFire4': 0.3, 'Izhi2007bArt': 1.0}
+defaultPointCellCost = 1.0
+
+# calibration runs
+calibrationCells = 20
+calibrationTime = 50  # ms
+
+
+###############################################################################
+#
+# COST ESTIMATES
+#
+###############################################################################
+
+def condsMet(conds, tags):
+    """Whether pop tags satisfy conds; conds on tags the pop does not have (e.g. ynorm ranges) are taken as met"""
+    for key, value in conds.items():
+        if key not in tags:
+            continue
+        if isinstance(value, list) and tags[key] not in value:
+            return False
+        elif not isinstance(value, list) and tags[key] != value:
+            return False
+    return True
+
+
+def popTags(netParams, popLabel):
+    return dict(netParams.popParams[popLabel], pop=popLabel)
+
+
+def popNumCells(netParams, popLabel):
+    """Number of cells of a population, or None if not given by numCells"""
+    numCells = netParams.popParams[popLabel].get('numCells')
+    return int(netParams.scale * numCells) if numCells is not None else None
+
+
+def _meanValue(value, default=1.0):
+    """Mean of a conn param: numbers as they are, string functions sampled (without variables)"""
+    if isinstance(value, str):
+        try:
+            func = connbuild.StringFunc(value, [])
+            return float(func(np.random.default_rng(0), 1000, {}).mean())
+        except ValueError:
+            return default
+    return float(value) if value is not None else default
+
+
+def synsPerCell(netParams):
+    """Expected number of synapses (incoming conns and stims) of a cell of each population"""
+    numCells = {pop: popNumCells(netParams, pop) or 0 for pop in netParams.popParams}
+    syns = {pop: 0.0 for pop in netParams.popParams}
+    for connParam in netParams.connParams.values():
+        pres = [pop for pop in netParams.popParams if condsMet(connParam.get('preConds', {}), popTags(netParams, pop))]
+        posts = [pop for pop in netParams.popParams if condsMet(connParam.get('postConds', {}), popTags(netParams, pop))]
+        numPre = sum(numCells[pop] for pop in pres)
+        numPost = sum(numCells[pop] for pop in posts) or 1
+        if 'convergence' in connParam:
+            perCell = _meanValue(connParam['convergence'])
+        elif 'divergence' in connParam:
+            perCell = _meanValue(connParam['divergence']) * numPre / numPost
+        elif 'probability' in connParam:
+            perCell = _meanValue(connParam['probability']) * numPre
+        elif 'connList' in connParam:
+            perCell = len(connParam['connList']) / float(numPost)
+        else:
+            perCell = numPre
+        synMechs = connParam.get('synMech')
+        perCell *= len(synMechs) if isinstance(synMechs, list) else 1
+        for pop in posts:
+            syns[pop] += perCell
+    for target in netParams.stimTargetParams.values():
+        for pop in netParams.popParams:
+            if condsMet(target.get('conds', {}), popTags(netParams, pop)):
+                syns[pop] += 1
+    return syns
+
+
+def ruleCosts(netParams):
+    """Estimated relative cost of a cell of each population, from its cell rules and expected synapses"""
+    syns = synsPerCell(netParams)
+    costs = {}
+    for popLabel in netParams.popParams:
+        tags = popTags(netParams, popLabel)
+        cost = 0.0
+        numSecs = 0
+        for ruleLabel, cellRule in netParams.cellParams.items():
+            conds = cellRule.get('conds', {})
+            if not ((conds and condsMet(conds, tags)) or (not conds and tags.get('cellType') == ruleLabel)):
+                continue
+            for sec in cellRule.get('secs', {}).values():
+                nseg = sec.get('geom', {}).get('nseg', 1)
+                cost += nseg * (segCost + sum(mechCosts.get(mech, defaultMechCost) for mech in sec.get('mechs', {})))
+                cost += pointpCost * len(sec.get('pointps', {}))
+                numSecs += 1
+        if not numSecs:  # point cell
+            cost = pointCellCosts.get(tags.get('cellModel'), defaultPointCellCost)
+        costs[popLabel] = cost + synCost * syns[popLabel]
+    return costs
+
+
+def _calibrationTags(pop):
+    """Tags of a calibration cell of a pop: its pop tags, at the center of the network"""
+    tags = pop._createCellTags()
+    params = sim.net.params
+    for axis, size in zip('xyz', [params.sizeX, params.sizeY, params.sizeZ]):
+        tags[axis + 'norm'] = 0.5
+        tags[axis] = 0.5 * size
+    return tags
+
+
+def calibratedCosts(numCells=calibrationCells, duration=calibrationTime):
+    """
+    Measured cost of a cell of each population (s per cell per ms), from short runs on rank 0
+
+    Requires sim.initialize() and sim.net.createPops(), and must be called before createCells():
+    the calibration cells use gids from 0 and are removed with pc.gid_clear().
+
+    """
+    costs = {}
+    if sim.rank == 0:
+        h.dt = sim.cfg.dt
+
+        def runTime():
+            h.finitialize(-65)
+            start = time.time()
+            while h.t < duration:  # fadvance rather than pc.psolve, which all ranks would have to call
+                h.fadvance()
+            return time.time() - start
+
+        baseline = runTime()  # fixed cost of the time steps
+        for popLabel, pop in sim.net.pops.items():
+            n = min(numCells, popNumCells(sim.net.params, popLabel) or numCells)
+            cells = [pop.cellModelClass(gid, _calibrationTags(pop)) for gid in range(n)]
+            costs[popLabel] = max(runTime() - baseline, 1e-9) / n / duration
+            del cells
+            sim.pc.gid_clear()
+            sim.net.gid2lid = {}
+    return sim.pc.py_broadcast(costs, 0)
+
+
+###############################################################################
+#
+# ASSIGNMENT
+#
+###############################################################################
+
+def assign(numCells, costs, nhosts):
+    """
+    Greedy assignment of cells to ranks: most expensive cells first, each to the least loaded rank
+
+    numCells: {pop: number of cells}; costs: {pop: cost of a cell}.
+    Returns ({pop: {rank: [cell indices]}}, [total cost of each rank]); the same on every rank.
+
+    """
+    assignment = {pop: {rank: [] for rank in range(nhosts)} for pop in numCells}
+    loads = [(0.0, rank) for rank in range(nhosts)]
+    for pop in sorted(numCells, key=lambda pop: (-costs[pop], list(numCells).index(pop))):
+        for i in range(numCells[pop]):
+            load, rank = heapq.heappop(loads)
+            assignment[pop][rank].append(i)
+            heapq.heappush(loads, (load + costs[pop], rank))
+    rankCosts = [0.0] * nhosts
+    for load, rank in loads:
+        rankCosts[rank] = load
+    return assignment, rankCosts
+
+
+def roundRobin(numCells, costs, nhosts):
+    """NetPyNE's distribution (cell after cell to the next rank, continuing across populations), as assign() returns it"""
+    assignment = {pop: {rank: [] for rank in range(nhosts)} for pop in numCells}
+    rankCosts = [0.0] * nhosts
+    nextHost = 0
+    for pop in numCells:
+        for i in range(numCells[pop]):
+            assignment[pop][nextHost].append(i)
+            rankCosts[nextHost] += costs[pop]
+            nextHost = (nextHost + 1) % nhosts
+    return assignment, rankCosts
+
+
+def imbalance(rankValues):
+    """max / mean of per-rank costs or times (1 is balanced)"""
+    mean = np.mean(rankValues)
+    return max(rankValues) / mean if mean > 0 else 1.0
+
+
+class LoadBalance(object):
+    """
+    Context manager around sim.net.createCells() that distributes cells with assign()
+
+    Replaces Pop._distributeCells() (NetPyNE's round-robin) for populations with numCells;
+    other populations (density, gridSpacing, cellsList) keep the round-robin distribution.
+
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        netParams = sim.net.params
+        numCells = {pop: popNumCells(netParams, pop) for pop in netParams.popParams}
+        numCells = {pop: n for pop, n in numCells.items() if n is not None}
+        if mode == 'calibrate':
+            self.costs = calibratedCosts()
+        else:
+            self.costs = ruleCosts(netParams)
+        self.assignment, self.rankCosts = assign(numCells, self.costs, sim.nhosts)
+        sim.loadBalance = self
+
+    def __enter__(self):
+        self.distributeCells = Pop._distributeCells
+        balance = self
+
+        def distributeCells(pop, numCellsPop):
+            hostCells = balance.assignment.get(pop.tags['pop'])
+            if hostCells is None or sum(len(cells) for cells in hostCells.values()) != numCellsPop:
+                return balance.distributeCells(pop, numCellsPop)
+            return {rank: list(cells) for rank, cells in hostCells.items()}
+
+        Pop._distributeCells = distributeCells
+        return self
+
+    def __exit__(self, *args):
+        Pop._distributeCells = self.distributeCells
+        if sim.rank == 0 and sim.cfg.verbose:
+            print('  Cell costs (%s): %s' % (self.mode, ', '.join('%s %.3g' % item for item in self.costs.items())))
+
+
+###############################################################################
+#
+# REPORT
+#
+###############################################################################
+
+def report():
+    """Gather the computation time of each rank and print it with the imbalance (max / mean); call after runSim()"""
+    computeTime = sim.pc.step_time()
+    times = sim.pc.py_allgather(computeTime)
+    numCells = sim.pc.py_allgather(len(sim.net.cells))
+    balance = getattr(sim, 'loadBalance', None)
+    if sim.rank == 0:
+        # sim.timingData only holds scalars (NetPyNE sums its values for the total time)
+        sim.timingData['loadImbalance'] = imbalance(times)
+        sim.timingData['maxComputeTime'] = max(times)
+        sim.timingData['meanComputeTime'] = float(np.mean(times))
+        sim.loadBalanceReport = {'mode': balance.mode if balance else 'roundrobin', 'computeTimes': times,
+                                 'cellsPerRank': numCells, 'estimatedCosts': balance.rankCosts if balance else None}
+        print('  Load balance (%s): computation time per rank %s s; imbalance (max/mean) = %.3f'
+              % (balance.mode if balance else 'roundrobin', ' '.join('%.2f' % t for t in times), imbalance(times)))
+        print('    cells per rank: %s' % ' '.join(str(n) for n in numCells))
+        if balance:
+            costs = balance.rankCosts
+            print('    estimated cost per rank: %s; estimated imbalance = %.3f'
+                  % (' '.join('%.3g' % c for c in costs), imbalance(costs)))
@@ -0,0 +1,78 @@
+"""
+loadbalance_check.py
+
+Estimated load imbalance of NetPyNE's round-robin distribution vs loadbalance.assign()
+
+For each example network, the rule-based cost of a cell of each population
+(loadbalance.ruleCosts()) is computed from its netParams, and the cells are assigned to
+nhosts ranks both ways without creating them. The estimated cost per rank of each
+assignment is summed and its imbalance (max / mean, 1 is balanced) reported, so the
+difference shows on any machine and is the same on every run; the measured imbalance
+of an actual MPI run is reported by loadbalance.report() (with several ranks sharing
+one core, its computation times mostly measure the scheduler, not the assignment).
+With populations of equal size, round-robin is already balanced while every rank gets
+the same number of cells of each population; the assignment helps when the cells per
+rank are few (e.g. cellmodels at 16 ranks: 1.153 -> 1.087, tut3 1.318 -> 1.082).
+
+Then cellmodels.py is run with each simConfig.loadBalance mode (in sweep.py workers, one
+rank) through the whole of createSimulateAnalyze(), analyses included, which must
+complete with the report in sim.timingData (analyses such as NetPyNE's plotData() sum
+its values, so it may only hold scalars).
+
+Usage: python loadbalance_check.py [maxHosts]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import loadbalance
+import sweep
+from scaling_benchmark import modelParams
+
+models = {'cellmodels': ('cellmodels.py', {}),
+          'cellmodels2 h-h': ('cellmodels2.py', {'which': 'h-h'}),
+          'cellmodels2 izhi': ('cellmodels2.py', {'which': 'izhi'}),
+          'tut3': ('tut3.py', {}),
+          'tut3_LIF': ('tut3_LIF.py', {})}
+hostsList = [2, 4, 8, 16, 32]
+modes = ['roundrobin', 'rule', 'calibrate']
+runDuration = 200  # ms, of the cellmodels.py runs
+
+
+if __name__ == '__main__':
+    maxHosts = int(sys.argv[1]) if len(sys.argv) > 1 else hostsList[-1]
+    here = os.path.dirname(os.path.abspath(__file__))
+    rows = []
+    for label, (script, variables) in models.items():
+        netParams, _ = modelParams(os.path.join(here, script), variables)
+        numCells = {pop: loadbalance.popNumCells(netParams, pop) for pop in netParams.popParams}
+        numCells = {pop: n for pop, n in numCells.items() if n is not None}
+        costs = loadbalance.ruleCosts(netParams)
+        for nhosts in [n for n in hostsList if n <= maxHosts]:
+            _, roundRobinCosts = loadbalance.roundRobin(numCells, costs, nhosts)
+            _, ruleCosts = loadbalance.assign(numCells, costs, nhosts)
+            rows.append((label, nhosts, sum(numCells.values()), loadbalance.imbalance(roundRobinCosts),
+                         loadbalance.imbalance(ruleCosts)))
+        print('%s: cell costs %s' % (label, ', '.join('%s %.3g' % item for item in costs.items())))
+
+    print()
+    print('%-17s %6s %6s %12s %8s' % ('model', 'nhosts', 'cells', 'roundrobin', 'rule'))
+    for row in rows:
+        print('%-17s %6d %6d %12.3f %8.3f' % row)
+
+    points = [{'simConfig.loadBalance': mode, 'simConfig.duration': runDuration} for mode in modes]
+    cacheDir = tempfile.mkdtemp(prefix='loadbalance_check_')  # never reuse a cached result
+    try:
+        results = sweep.run(os.path.join(here, 'cellmodels.py'), points, cacheDir=cacheDir, workers=1, analyze=True)
+    finally:
+        shutil.rmtree(cacheDir, ignore_errors=True)
+    print('\ncellmodels.py, %g ms, with analyses' % runDuration)
+    failed = []
+    for mode, result in zip(modes, results):
+        ok = result is not None and 'loadImbalance' in result['timing']
+        print('%-12s %s' % (mode, 'ok (imbalance %.3f)' % result['timing']['loadImbalance'] if ok else 'FAIL'))
+        if not ok:
+            failed.append(mode)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,166 @@
+"""
+monitors.py
+
+Early termination of runs that have gone silent or runaway
+
+Every monitorStep ms the spikes fired since the last check are gathered, and each
+monitor is evaluated on the spikes of its population in the last window ms:
+  {'type': 'rateAbove', 'pop': 'PYR', 'rate': 100}       # mean rate per cell (Hz) above rate
+  {'type': 'rateBelow', 'pop': 'PYR', 'rate': 0.5}       # ... below rate
+  {'type': 'silent', 'pop': 'PYR'}                        # no spikes at all
+  {'type': 'synchrony', 'pop': 'PYR', 'threshold': 0.8}  # synchrony index (below) above threshold
+  {'type': 'callback', 'func': f}  # or just f: f(sim, t, spkt, spkid) returns a reason (str) to stop, or None
+with 'window' (ms, default 200), 'start' (ms; first check, default window) and 'label'.
+pop None (default) means all cells. The synchrony index is chi^2 of the spike counts in
+binSize ms bins (default 5): the variance of the population mean over the mean
+variance of the cells, 1 for fully synchronous firing and ~1/numCells for independent.
+
+Monitors are a task of runloop.runSim(). When a monitor fires, the run stops at that
+check: interval functions (streamed traces, envelopes) are flushed, sim.cfg.duration is
+set to the stop time so rates and plots cover the simulated part, and sim.termination
+(also sim.allSimData['termination'] after gathering, so it is saved with the data) holds
+the reason, the time and the original duration. Not used by the izhipop engine.
+
+Usage:
+  simConfig.monitors = [{'type': 'rateAbove', 'rate': 100}, {'type': 'silent', 'window': 500}]  # used by simtools
+  simConfig.monitorStep = 50  # ms
+
+"""
+
+import numpy as np
+from netpyne import sim
+from neuron import h
+
+import runloop
+
+monitorStep = 50  # ms
+defaultWindow = 200  # ms
+defaultBinSize = 5  # ms
+
+
+###############################################################################
+#
+# CRITERIA
+#
+###############################################################################
+
+def popRate(spkt, spkid, gids, start, stop):
+    """Mean rate (Hz) of the cells gids in (start, stop] ms"""
+    if not len(gids) or stop <= start:
+        return 0.0
+    count = np.count_nonzero((spkt > start) & (spkt <= stop) & np.isin(spkid, gids))
+    return count / float(len(gids)) / ((stop - start) / 1000.0)
+
+
+def synchronyIndex(spkt, spkid, gids, start, stop, binSize=defaultBinSize):
+    """chi^2 synchrony of the spike counts of cells gids in bins of binSize ms over (start, stop]"""
+    numBins = int((stop - start) // binSize)
+    if len(gids) < 2 or numBins < 2:
+        return 0.0
+    select = (spkt > start) & (spkt <= start + numBins * binSize) & np.isin(spkid, gids)
+    rows = np.searchsorted(np.sort(gids), spkid[select])
+    bins = np.minimum(((spkt[select] - start) // binSize).astype(int), numBins - 1)
+    counts = np.zeros((len(gids), numBins))
+    np.add.at(counts, (rows, bins), 1)
+    cellVar = counts.var(axis=1).mean()
+    return float(counts.mean(axis=0).var() / cellVar) if cellVar > 0 else 0.0
+
+
+def evaluate(spec, t, spkt, spkid, popGids):
+    """Reason to stop at t according to monitor spec, or None"""
+    if callable(spec):
+        spec = {'type': 'callback', 'func': spec}
+    kind = spec['type']
+    window = spec.get('window', defaultWindow)
+    if t < spec.get('start', window):
+        return None
+    if kind == 'callback':
+        return spec['func'](sim, t, spkt, spkid)
+
+    pop = spec.get('pop')
+    gids = popGids[pop] if pop else np.concatenate(list(popGids.values()))
+    start = t - window
+    label = spec.get('label', '%s %s' % (kind, pop or 'all cells'))
+    if kind in ('rateAbove', 'rateBelow', 'silent'):
+        rate = popRate(spkt, spkid, gids, start, t)
+        if kind == 'rateAbove' and rate > spec['rate']:
+            return '%s: %.2f Hz > %g Hz in %g-%g ms' % (label, rate, spec['rate'], start, t)
+        if kind == 'rateBelow' and rate < spec['rate']:
+            return '%s: %.2f Hz < %g Hz in %g-%g ms' % (label, rate, spec['rate'], start, t)
+        if kind == 'silent' and rate == 0:
+            return '%s: no spikes in %g-%g ms' % (label, start, t)
+        return None
+    if kind == 'synchrony':
+        index = synchronyIndex(spkt, spkid, gids, start, t, spec.get('binSize', defaultBinSize))
+        if index > spec['threshold']:
+            return '%s: synchrony %.3f > %g in %g-%g ms' % (label, index, spec['threshold'], start, t)
+        return None
+    raise ValueError('Unknown monitor type %r' % kind)
+
+
+###############################################################################
+#
+# RUN
+#
+###############################################################################
+
+class Monitors(object):
+    """Monitors of a run: the spikes of the last window ms of all nodes, kept on rank 0"""
+
+    def __init__(self, specs):
+        self.specs = list(specs)
+        self.window = max([spec.get('window', defaultWindow) for spec in self.specs if isinstance(spec, dict)]
+                          + [defaultWindow])
+        localGids = {label: list(pop.cellGids) for label, pop in sim.net.pops.items()}
+        self.popGids = {label: np.array(sorted(gid for nodeGids in sim.pc.py_allgather(localGids) for gid in nodeGids[label]),
+                                        dtype=np.int64) for label in sim.net.pops}
+        self.spkt = np.zeros(0)
+        self.spkid = np.zeros(0, dtype=np.int64)
+        self.numRead = 0  # spikes read from the recorded vectors, with those dropped
+        self.reason = None
+
+    def check(self, t):
+        """Gather the new spikes and evaluate the monitors (all nodes); returns the reason to stop, or None"""
+        t = round(t, 6)  # h.t accumulates dt
+        dropped = getattr(sim, 'numSpikesDropped', 0)  # by spikestats.py
+        first = max(self.numRead - dropped, 0)
+        spkt = sim.simData['spkt'].as_numpy()[first:].copy()
+        spkid = sim.simData['spkid'].as_numpy()[first:].astype(np.int64)
+        self.numRead = dropped + first + len(spkt)
+        newSpikes = sim.pc.py_gather((spkt, spkid), 0)
+        reason = None
+        if sim.rank == 0:
+            keep = self.spkt > t - self.window
+            self.spkt = np.concatenate([self.spkt[keep]] + [s for s, _ in newSpikes])
+            self.spkid = np.concatenate([self.spkid[keep]] + [i for _, i in newSpikes])
+            for spec in self.specs:
+                reason = evaluate(spec, t, self.spkt, self.spkid, self.popGids)
+                if reason:
+                    break
+        self.reason = sim.pc.py_broadcast(reason, 0)
+        return self.reason
+
+
+def enabled(simConfig):
+    return bool(getattr(simConfig, 'monitors', None))
+
+
+def task():
+    """(times, func, final) task of the monitors of sim.cfg.monitors for runloop.runSim()"""
+    monitors = Monitors(sim.cfg.monitors)
+    return runloop.every(getattr(sim.cfg, 'monitorStep', monitorStep)), monitors.check, False
+
+
+def terminate(reason):
+    """Record that the run stopped early at the current time (sets sim.termination and sim.cfg.duration)"""
+    stopTime = round(h.t, 6)  # h.t accumulates dt
+    sim.termination = {'reason': reason, 'time': stopTime, 'duration': sim.cfg.duration}
+    sim.cfg.duration = stopTime  # simulated part, for rates and plots
+    if sim.rank == 0:
+        print('  Terminated at t = %g ms: %s' % (stopTime, reason))
+
+
+def markTermination():
+    """Add sim.termination to sim.allSimData, so it is saved with the data (after gatherData)"""
+    if sim.rank == 0 and getattr(sim, 'termination', None):
+        sim.allSimData['termination'] = sim.termination
@@ -0,0 +1,247 @@
+"""
+netcache.py
+
+On-disk cache of instantiated networks
+
+Runs that only change simConfig (duration, recordTraces, analysis...) build the same
+network every time. The cache stores what the rules generated -- cell gids and tags,
+connections and stim targets -- under a key computed from netParams, the conn/loc/stim
+seeds and the few simConfig options that change the network, and on a hit recreates
+the NEURON objects straight from it, without evaluating cell, conn or stim rules.
+
+Each entry is a directory <cacheDir>/<key> with, per MPI rank, a compact binary table
+of the connections (net_<rank>_<nhosts>.npz: one array per field) and a pickle with
+the cell tags and stim params (meta_<rank>_<nhosts>.pkl). Entries not used for maxAge
+days are removed, and then the least recently used ones until the cache fits in maxSize.
+
+Usage:
+  simConfig.netCache = 'netcache'  # used by simtools.create()
+  simConfig.netCacheMaxSize = 2**30  # bytes
+  simConfig.netCacheMaxAge = 30  # days
+
+"""
+
+import os
+import pickle
+import shutil
+import time
+
+import numpy as np
+from netpyne import sim
+
+import jsonkey
+
+maxSize = 2**30  # bytes
+maxAge = 30  # days
+
+# simConfig options that change the network built from netParams
+cfgKeys = ['vectorConns', 'addSynMechs', 'includeParamsLabel', 'oneSynPerNetcon', 'distributeSynsUniformly',
+           'connRandomSecFromList', 'allowSelfConns', 'allowConnsWithWeight0', 'scale', 'loadBalance']
+
+# conn keys stored as columns of the connection table (other keys go to the extras in meta)
+connColumns = ['preGid', 'sec', 'loc', 'synMech', 'weight', 'delay', 'label']
+
+
+###############################################################################
+#
+# CACHE KEY
+#
+###############################################################################
+
+def netKey(netParams, simConfig):
+    """Stable hash of everything the network instantiated from netParams depends on"""
+    import netpyne
+
+    seeds = getattr(simConfig, 'seeds', {})
+    content = {'netParams': netParams.todict(),
+               'seeds': {k: seeds.get(k) for k in ['conn', 'loc', 'stim']},
+               'cfg': {k: getattr(simConfig, k, None) for k in cfgKeys},
+               'netpyne': netpyne.__version__}
+    return jsonkey.hashKey(content)
+
+
+def entryPath(cacheDir, key):
+    return os.path.join(cacheDir, key)
+
+
+def _files(cacheDir, key):
+    """(net, meta) files of this node in a cache entry (one pair per rank, for the current number of ranks)"""
+    entry = entryPath(cacheDir, key)
+    suffix = '%d_%d' % (sim.rank, sim.nhosts)
+    return os.path.join(entry, 'net_%s.npz' % suffix), os.path.join(entry, 'meta_%s.pkl' % suffix)
+
+
+def isCached(cacheDir, key):
+    """Whether every rank has its files in the entry (collective: call on all ranks, which all get the same answer)"""
+    found = all(os.path.exists(path) for path in _files(cacheDir, key))
+    return bool(sim.pc.allreduce(int(found), 3))  # min: a partial entry (evicted, other nhosts) is a miss everywhere
+
+
+###############################################################################
+#
+# SAVE
+#
+###############################################################################
+
+class StimRecorder(object):
+    """
+    Context manager that records the params of every cell.addStim() call
+
+    Stim params are the result of evaluating the stim rules (conds, string functions),
+    so they are stored as they are passed to addStim(), and replayed on restore.
+
+    """
+
+    def __enter__(self):
+        self.stims = []
+        self.addStim = sim.CompartCell.addStim
+        recorder = self
+
+        def addStim(cell, params):
+            recorder.stims.append((cell.gid, dict(params)))
+            return recorder.addStim(cell, params)
+
+        sim.CompartCell.addStim = addStim
+        return self
+
+    def __exit__(self, *args):
+        sim.CompartCell.addStim = self.addStim
+
+
+def _stringColumn(values):
+    """Encode a list of strings (or None) as (index array, table); None -> -1"""
+    table = sorted(set(v for v in values if v is not None), key=str)
+    index = {v: i for i, v in enumerate(table)}
+    return np.array([index.get(v, -1) if v is not None else -1 for v in values], dtype=np.int32), table
+
+
+def save(cacheDir, key, stims):
+    """Store the cells and connections of this node (sim.net) and the recorded stims in the cache"""
+    entry = entryPath(cacheDir, key)
+    os.makedirs(entry, exist_ok=True)
+
+    cellTags = [(cell.gid, cell.tags) for cell in sim.net.cells]
+    post, conns, extras = [], [], {}
+    for cell in sim.net.cells:
+        for conn in cell.conns:
+            if conn.get('preGid') == 'NetStim':  # created again by the recorded stims
+                continue
+            extra = {k: v for k, v in conn.items() if k not in connColumns and k not in ('hObj', 'hNetcon', 'preLabel')}
+            if extra:
+                extras[len(conns)] = extra
+            post.append(cell.gid)
+            conns.append(conn)
+
+    secs, secTable = _stringColumn([conn.get('sec') for conn in conns])
+    synMechs, synMechTable = _stringColumn([conn.get('synMech') for conn in conns])
+    labels, labelTable = _stringColumn([conn.get('label') for conn in conns])
+    arrays = {'postGid': np.array(post, dtype=np.int64),
+              'preGid': np.array([conn['preGid'] for conn in conns], dtype=np.int64),
+              'weight': np.array([conn.get('weight') for conn in conns], dtype=float),
+              'delay': np.array([conn.get('delay') for conn in conns], dtype=float),
+              'loc': np.array([conn['loc'] if conn.get('loc') is not None else np.nan for conn in conns], dtype=float),
+              'sec': secs, 'synMech': synMechs, 'label': labels}
+    meta = {'cellTags': cellTags, 'stims': stims, 'extras': extras,
+            'secTable': secTable, 'synMechTable': synMechTable, 'labelTable': labelTable}
+
+    # write to temporary files first, so a crash never leaves an entry that looks complete
+    netFile, metaFile = _files(cacheDir, key)
+    with open(netFile + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    with open(metaFile + '.tmp', 'wb') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(netFile + '.tmp', netFile)
+    os.replace(metaFile + '.tmp', metaFile)
+
+
+###############################################################################
+#
+# RESTORE
+#
+###############################################################################
+
+def restore(cacheDir, key):
+    """
+    Create the cells, connections and stims of this node from a cache entry
+
+    Requires sim.initialize() and sim.net.createPops() to have been called.
+    Returns (cells, conns, stims) like the sim.net methods that build them.
+
+    """
+    netFile, metaFile = _files(cacheDir, key)
+    with open(metaFile, 'rb') as f:
+        meta = pickle.load(f)
+    arrays = np.load(netFile)
+    os.utime(entryPath(cacheDir, key))  # mark as recently used
+
+    # cells
+    sim.timing('start', 'createTime')
+    for gid, tags in meta['cellTags']:
+        pop = sim.net.pops[tags['pop']]
+        pop.cellGids.append(gid)
+        sim.net.cells.append(pop.cellModelClass(gid, tags))
+    sim.net.lastGid = sum(pop.tags.get('numCells', len(pop.cellGids)) for pop in sim.net.pops.values())
+    if sim.net.params.defineCellShapes:
+        sim.net.defineCellShapes()
+    print('  Number of cells on node %i: %i (from cache)' % (sim.rank, len(sim.net.cells)))
+    sim.timing('stop', 'createTime')
+
+    # connections
+    sim.timing('start', 'connectTime')
+    secTable, synMechTable, labelTable, extras = meta['secTable'], meta['synMechTable'], meta['labelTable'], meta['extras']
+    columns = [arrays[name].tolist() for name in ['postGid', 'preGid', 'weight', 'delay', 'loc', 'sec', 'synMech', 'label']]
+    for i, (postGid, preGid, weight, delay, loc, sec, synMech, label) in enumerate(zip(*columns)):
+        params = {'preGid': preGid, 'weight': weight, 'delay': delay, 'synsPerConn': 1,
+                  'loc': loc if loc == loc else None,
+                  'sec': secTable[sec] if sec >= 0 else None,
+                  'synMech': synMechTable[synMech] if synMech >= 0 else None}
+        if label >= 0:
+            params['label'] = labelTable[label]
+        if i in extras:
+            params.update(extras[i])
+        sim.net.cells[sim.net.gid2lid[postGid]].addConn(params=params)
+    print('  Number of connections on node %i: %i (from cache)' % (sim.rank, len(columns[0])))
+    sim.timing('stop', 'connectTime')
+
+    # stims
+    sim.timing('start', 'stimsTime')
+    for gid, params in meta['stims']:
+        sim.net.cells[sim.net.gid2lid[gid]].addStim(dict(params))
+    sim.timing('stop', 'stimsTime')
+
+    return sim.net.cells, [cell.conns for cell in sim.net.cells], [cell.stims for cell in sim.net.cells]
+
+
+###############################################################################
+#
+# EVICTION
+#
+###############################################################################
+
+def _entrySize(entry):
+    return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+
+
+def evict(cacheDir, maxSize=maxSize, maxAge=maxAge, keep=None):
+    """Remove entries unused for more than maxAge days, then the least recently used until under maxSize bytes"""
+    if not os.path.isdir(cacheDir):
+        return
+    now = time.time()
+    entries = []
+    for key in os.listdir(cacheDir):
+        entry = entryPath(cacheDir, key)
+        if not os.path.isdir(entry) or key == keep:
+            continue
+        if now - os.path.getmtime(entry) > maxAge * 86400:
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            entries.append((os.path.getmtime(entry), _entrySize(entry), entry))
+
+    total = sum(size for _, size, _ in entries)
+    if keep and os.path.isdir(entryPath(cacheDir, keep)):
+        total += _entrySize(entryPath(cacheDir, keep))
+    for _, size, entry in sorted(entries):
+        if total <= maxSize:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
@@ -0,0 +1,439 @@
+"""
+plotpool.py
+
+Analysis stage: population indexes built once, analyses in parallel, aggregated rendering
+
+sim.analysis.plotData() runs the entries of simConfig.analysis one after another, and each
+one selects its spikes again from the lists in sim.allSimData (plotRatePSD tests every
+spike against a list of gids, for every population it plots). Here, on rank 0 after
+gathering:
+  - spike times and gids become arrays once, sorted by time, with the indexes of the
+    spikes of each population (SpikeIndex, in sim.spikeIndex; read-only arrays)
+  - the analyses run in a pool of simConfig.analysisWorkers processes forked after the
+    index is built, so all of them read it (and the rest of sim) without copies. With
+    MPI, or where fork is not available, they run one after another.
+  - plotRaster, plotSpikeHist, plotRatePSD and plotTraces are replaced by versions that
+    select from the index; other analyses (plot2Dnet...) run NetPyNE's functions. An
+    analysis already replaced (plotRatePSD by spikestats.py) keeps its replacement.
+  - rasters of more than maxPoints spikes are drawn as density images (spikes per time
+    bin and row of cells), and traces of more than maxLinePoints samples as min/max
+    envelopes (recplan.envelope), so drawing time depends on the figure, not on the data.
+Workers save their figures (saveFig); figures with showFig are sent back and shown at the end.
+
+Usage:
+  simConfig.analysisWorkers = 4  # used by simtools; 0 = one per core, None = sim.analysis.plotData()
+  simConfig.maxPlotPoints = 200000  # spikes above which rasters are density images
+
+"""
+
+import multiprocessing
+import os
+import pickle
+import time
+import traceback
+
+import numpy as np
+from netpyne import sim
+
+import recplan
+
+maxPoints = 200000  # spikes drawn as points in a raster; above, a density image
+maxLinePoints = 4000  # samples drawn per trace line; above, min/max envelopes
+rasterBins = (1000, 400)  # at most time bins x rows of cells of a density raster
+
+
+###############################################################################
+#
+# INDEX
+#
+###############################################################################
+
+class SpikeIndex(object):
+    """Spikes of sim.allSimData sorted by time, with the spike indexes of each population (read-only)"""
+
+    def __init__(self, simData=None):
+        simData = sim.allSimData if simData is None else simData
+        spkt = np.asarray(simData.get('spkt', []), dtype=np.float64)
+        spkid = np.asarray(simData.get('spkid', []), dtype=np.float64).astype(np.int64)
+        order = np.argsort(spkt, kind='stable')
+        self.spkt, self.spkid = spkt[order], spkid[order]
+
+        self.pops = {label: np.asarray(pop['cellGids'], dtype=np.int64) for label, pop in sim.net.allPops.items()}
+        numGids = max([len(sim.net.allCells)] + [int(gids.max()) + 1 for gids in self.pops.values() if len(gids)]
+                      + [int(self.spkid.max()) + 1 if len(self.spkid) else 0])
+        self.popOfGid = np.full(numGids, -1, dtype=np.int64)
+        for i, gids in enumerate(self.pops.values()):
+            self.popOfGid[gids] = i
+        codes = self.popOfGid[self.spkid]
+        byPop = np.argsort(codes, kind='stable')  # in time order within each population
+        bounds = np.searchsorted(codes[byPop], np.arange(len(self.pops) + 1))
+        self.popSpikes = {label: byPop[bounds[i]:bounds[i + 1]] for i, label in enumerate(self.pops)}
+        for array in [self.spkt, self.spkid, self.popOfGid] + list(self.popSpikes.values()) + list(self.pops.values()):
+            array.setflags(write=False)
+
+    def numCells(self, include):
+        return len(self.gids(include))
+
+    def gids(self, include):
+        """Sorted gids of an include list of NetPyNE's analyses ('allCells', 'eachPop', pops, gids, (pop, indexes))"""
+        gids = []
+        for condition in include:
+            if isinstance(condition, str) and condition in ('all', 'allCells', 'eachPop'):
+                gids.append(np.flatnonzero(self.popOfGid >= 0))
+            elif isinstance(condition, (int, np.integer)):
+                gids.append(np.array([condition]))
+            elif isinstance(condition, str):
+                gids.append(self.pops.get(condition, np.zeros(0, dtype=np.int64)))
+            elif isinstance(condition, (list, tuple)) and len(condition) == 2 and isinstance(condition[0], str):
+                popGids = self.pops.get(condition[0], np.zeros(0, dtype=np.int64))
+                indexes = np.atleast_1d(condition[1])
+                gids.append(popGids[indexes[indexes < len(popGids)]])
+        return np.unique(np.concatenate(gids)).astype(np.int64) if gids else np.zeros(0, dtype=np.int64)
+
+    def spikes(self, include=('allCells',), timeRange=None):
+        """(times, gids) of the spikes of the cells in include within timeRange, in time order"""
+        if any(isinstance(condition, str) and condition in ('all', 'allCells', 'eachPop') for condition in include):
+            t, ids = self.spkt, self.spkid  # views
+        elif all(isinstance(condition, str) for condition in include):
+            labels = [label for label in include if label in self.popSpikes]
+            indexes = [self.popSpikes[label] for label in labels]
+            index = indexes[0] if len(indexes) == 1 else np.sort(np.concatenate(indexes or [np.zeros(0, dtype=np.int64)]))
+            t, ids = self.spkt[index], self.spkid[index]
+        else:
+            gids = self.gids(include)
+            pops = np.unique(self.popOfGid[gids[gids < len(self.popOfGid)]])
+            index = np.sort(np.concatenate([self.popSpikes[list(self.pops)[i]] for i in pops if i >= 0] or
+                                           [np.zeros(0, dtype=np.int64)]))
+            index = index[np.isin(self.spkid[index], gids)]
+            t, ids = self.spkt[index], self.spkid[index]
+        if timeRange is not None:
+            start, stop = np.searchsorted(t, [timeRange[0], timeRange[1]], side='left')
+            t, ids = t[start:stop], ids[start:stop]
+        return t, ids
+
+
+def _labels(include):
+    """Entries of an include list with 'eachPop' expanded to the populations"""
+    labels = []
+    for condition in include:
+        labels += list(sim.spikeIndex.pops) if condition == 'eachPop' else [condition]
+    return labels
+
+
+def _color(label, i, popColors):
+    import matplotlib.pyplot as plt
+    colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    return (popColors or {}).get(label, colors[i % len(colors)])
+
+
+def _save(fig, saveFig, suffix):
+    if saveFig:
+        fig.savefig(saveFig if isinstance(saveFig, str) else sim.cfg.filename + suffix)
+
+
+###############################################################################
+#
+# ANALYSES
+#
+###############################################################################
+
+def plotRaster(include=['allCells'], timeRange=None, orderBy='gid', orderInverse=False, popRates=True, popColors=None,
+               markerSize=None, figSize=(10, 8), fontSize=12, saveFig=None, showFig=False, **kwargs):
+    """Raster from sim.spikeIndex; above simConfig.maxPlotPoints spikes, a density image per population"""
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Patch
+
+    print('Plotting raster (spike index)...')
+    index = sim.spikeIndex
+    timeRange = timeRange or [0, sim.cfg.duration]
+    t, ids = index.spikes(include, timeRange)
+    gids = index.gids(include)
+    if orderBy != 'gid':
+        tags = {cell['gid']: cell['tags'].get(orderBy, 0) for cell in sim.net.allCells}
+        gids = gids[np.lexsort((gids, [tags.get(gid, 0) for gid in gids]))]
+    if orderInverse:
+        gids = gids[::-1]
+    row = np.zeros(len(index.popOfGid), dtype=np.int64)
+    row[gids] = np.arange(len(gids))
+    y = row[ids]
+    popCodes = index.popOfGid[ids]
+    duration = (timeRange[1] - timeRange[0]) / 1000.0
+
+    fig, ax = plt.subplots(figsize=figSize)
+    plt.rcParams.update({'font.size': fontSize})
+    handles = []
+    density = len(t) > getattr(sim.cfg, 'maxPlotPoints', maxPoints)
+    if density:
+        tEdges = np.linspace(timeRange[0], timeRange[1], min(rasterBins[0], int(np.ceil(duration * 1000))) + 1)
+        yEdges = np.linspace(0, max(len(gids), 1), min(rasterBins[1], max(len(gids), 1)) + 1)
+    for i, label in enumerate(index.pops):
+        selected = popCodes == i
+        if not selected.any():
+            continue
+        numCells = np.count_nonzero(np.isin(index.pops[label], gids))
+        rate = np.count_nonzero(selected) / float(max(numCells, 1)) / duration if duration else 0.0
+        text = '%s (%.3g Hz)' % (label, rate) if popRates else str(label)
+        color = _color(label, i, popColors)
+        if density:
+            counts, _, _ = np.histogram2d(t[selected], y[selected], bins=[tEdges, yEdges])
+            image = np.zeros(counts.T.shape + (4,))
+            image[..., :3] = plt.matplotlib.colors.to_rgb(color)
+            image[..., 3] = np.clip(counts.T / max(np.percentile(counts[counts > 0], 99), 1), 0, 1)
+            ax.imshow(image, extent=[tEdges[0], tEdges[-1], yEdges[0], yEdges[-1]], origin='lower', aspect='auto',
+                      interpolation='nearest')
+            handles.append(Patch(color=color, label=text))
+        else:
+            handles.append(ax.scatter(t[selected], y[selected], s=markerSize or 5, marker='|', color=color, label=text,
+                                      rasterized=True))
+    ax.set_xlim(timeRange)
+    ax.set_ylim(0, max(len(gids), 1))
+    ax.set_xlabel('Time (ms)', fontsize=fontSize)
+    ax.set_ylabel('Cells (ordered by %s)' % orderBy, fontsize=fontSize)
+    ax.set_title('Raster plot of spiking (%d spikes%s)' % (len(t), ', density' if density else ''), fontsize=fontSize)
+    if handles:
+        ax.legend(handles=handles, fontsize=fontSize, loc=1)
+    _save(fig, saveFig, '_raster.png')
+    return fig, {'spkTimes': t, 'spkInds': y, 'gids': gids}
+
+
+def plotSpikeHist(include=['eachPop', 'allCells'], timeRange=None, binSize=5, overlay=True, graphType='line',
+                  measure='rate', norm=False, popColors=None, figSize=(10, 8), fontSize=12, saveFig=None, showFig=False,
+                  **kwargs):
+    """Spike histogram (count or rate) of each entry of include, from sim.spikeIndex"""
+    import matplotlib.pyplot as plt
+
+    print('Plotting spike histogram (spike index)...')
+    index = sim.spikeIndex
+    timeRange = timeRange or [0, sim.cfg.duration]
+    labels = _labels(include)
+    edges = np.arange(timeRange[0], timeRange[1] + binSize, binSize)
+    fig = plt.figure(figsize=figSize)
+    plt.rcParams.update({'font.size': fontSize})
+    histograms = []
+    for i, label in enumerate(labels):
+        counts = np.histogram(index.spikes([label], timeRange)[0], edges)[0].astype(float)
+        if measure == 'rate':
+            counts *= 1000.0 / binSize / max(index.numCells([label]), 1)
+        if norm and counts.max():
+            counts /= counts.max()
+        histograms.append(counts)
+        if not overlay:
+            plt.subplot(len(labels), 1, i + 1)
+            plt.title(str(label), fontsize=fontSize)
+        color = _color(label, i, popColors)
+        if graphType == 'bar':
+            plt.bar(edges[:-1], counts, width=binSize, align='edge', color=color, label=str(label), alpha=0.7)
+        else:
+            plt.plot(edges[:-1] + binSize / 2.0, counts, linewidth=1.0, color=color, label=str(label))
+        plt.xlim(timeRange)
+        plt.xlabel('Time (ms)', fontsize=fontSize)
+        plt.ylabel('Avg cell firing rate (Hz)' if measure == 'rate' else 'Spike count', fontsize=fontSize)
+    if overlay and labels:
+        plt.legend(fontsize=fontSize, loc=1)
+    _save(fig, saveFig, '_spikeHist.png')
+    return fig, {'histoData': histograms, 'histoT': edges[:-1] + binSize / 2.0, 'include': labels}
+
+
+def plotRatePSD(include=['eachPop', 'allCells'], timeRange=None, binSize=5, minFreq=1, maxFreq=100,
+                transformMethod='morlet', stepFreq=1, NFFT=256, noverlap=128, smooth=0, norm=False, overlay=True,
+                popColors=None, yLogScale=True, ylim=None, figSize=(10, 8), fontSize=12, lineWidth=1.5, saveFig=None,
+                showFig=False, **kwargs):
+    """plotRatePSD() of NetPyNE (morlet or fft) on rates binned from sim.spikeIndex; cells only, no NetStim labels"""
+    import matplotlib.pyplot as plt
+    from matplotlib import mlab
+    from netpyne.analysis.utils import _smooth1d
+
+    print('Plotting firing rate power spectral density (PSD) (spike index)...')
+    index = sim.spikeIndex
+    timeRange = timeRange or [0, sim.cfg.duration]
+    labels = _labels(include)
+    fs = 1000.0 / binSize
+    allFreqs, allSignal = [], []
+    for label in labels:
+        counts = np.histogram(index.spikes([label], timeRange)[0], bins=np.arange(timeRange[0], timeRange[1], binSize))[0]
+        rates = counts * (1000.0 / binSize) / max(index.numCells([label]), 1)
+        if transformMethod == 'morlet':
+            from netpyne.support.morlet import MorletSpec
+            spec = MorletSpec(rates, fs, freqmin=minFreq, freqmax=maxFreq, freqstep=stepFreq)
+            freqs, signal = spec.f, np.mean(spec.TFR, 1)
+        else:
+            power, freqs = mlab.psd(rates, Fs=fs, NFFT=NFFT, detrend=mlab.detrend_none, window=mlab.window_hanning,
+                                    noverlap=noverlap, pad_to=None, sides='default', scale_by_freq=True)
+            signal = 10 * np.log10(power) if yLogScale else power
+            if smooth:
+                signal = _smooth1d(signal, smooth)
+        allFreqs.append(np.asarray(freqs))
+        allSignal.append(np.asarray(signal))
+    if norm and allSignal:
+        vmax = np.max(allSignal)
+        allSignal = [signal / vmax for signal in allSignal]
+
+    fig = plt.figure(figsize=figSize)
+    plt.rcParams.update({'font.size': fontSize})
+    for i, (label, freqs, signal) in enumerate(zip(labels, allFreqs, allSignal)):
+        if not overlay:
+            plt.subplot(len(labels), 1, i + 1)
+            plt.title(str(label), fontsize=fontSize)
+        show = (freqs < maxFreq) & (freqs > minFreq)
+        plt.plot(freqs[show], signal[show], linewidth=lineWidth, color=_color(label, i, popColors), label=str(label))
+        plt.xlabel('Frequency (Hz)', fontsize=fontSize)
+        plt.ylabel('Power (dB/Hz)' if transformMethod != 'morlet' and yLogScale else 'Power', fontsize=fontSize)
+        plt.xlim([0, maxFreq])
+        if ylim:
+            plt.ylim(ylim)
+    if overlay and labels:
+        plt.legend(fontsize=fontSize, loc=1)
+    _save(fig, saveFig, '_plot_spikePSD.png')
+    return fig, {'allSignal': allSignal, 'allFreqs': allFreqs}
+
+
+def _traceValues(values, start, stop):
+    """Samples start:stop of a recorded trace (lists, arrays, memmaps, recplan.Resampled; dicts of synapses summed)"""
+    if isinstance(values, dict):
+        return np.sum([np.asarray(v[start:stop], dtype=float) for v in values.values()], axis=0) if values else np.zeros(0)
+    return np.asarray(values[start:stop], dtype=float)
+
+
+def plotTraces(include=None, timeRange=None, oneFigPer='cell', overlay=False, colors=None, ylim=None, figSize=(10, 8),
+               fontSize=12, saveFig=None, showFig=False, **kwargs):
+    """Recorded traces of the cells in include (default: all recorded); long traces drawn as min/max envelopes"""
+    import matplotlib.pyplot as plt
+
+    print('Plotting recorded cell traces (spike index)...')
+    simData = sim.allSimData
+    traces = [trace for trace in sim.cfg.recordTraces if trace in simData]
+    recorded = sorted(set(int(key[len('cell_'):]) for trace in traces for key in simData[trace]
+                          if key.startswith('cell_') and not key.startswith('cell_time_')))
+    included = set(sim.spikeIndex.gids(include)) if include is not None else set(recorded)
+    gids = [gid for gid in recorded if gid in included]
+    recordStep = sim.cfg.recordStep
+    timeRange = timeRange or [0, sim.cfg.duration]
+    start, stop = int(round(timeRange[0] / recordStep)), int(round(timeRange[1] / recordStep)) + 1
+
+    def line(trace, gid):
+        values = _traceValues(simData[trace]['cell_%d' % gid], start, stop)
+        t = (start + np.arange(len(values))) * recordStep
+        if len(values) > maxLinePoints:
+            n = int(np.ceil(len(values) / (maxLinePoints / 2.0)))
+            values = recplan.envelope(values, n)
+            t = np.repeat(t[::n], 2)[:len(values)]
+        return t, values
+
+    plotColors = colors or plt.rcParams['axes.prop_cycle'].by_key()['color']
+    figs = {}
+    groups = [(gid, [(trace, gid) for trace in traces if 'cell_%d' % gid in simData[trace]]) for gid in gids] \
+        if oneFigPer == 'cell' else \
+        [(trace, [(trace, gid) for gid in gids if 'cell_%d' % gid in simData[trace]]) for trace in traces]
+    for key, lines in groups:
+        if not lines:
+            continue
+        fig = plt.figure(figsize=figSize)
+        plt.rcParams.update({'font.size': fontSize})
+        for i, (trace, gid) in enumerate(lines):
+            if not overlay:
+                plt.subplot(len(lines), 1, i + 1)
+            t, values = line(trace, gid)
+            label = trace if oneFigPer == 'cell' else 'cell_%d' % gid
+            plt.plot(t, values, linewidth=1.0, color=plotColors[i % len(plotColors)], label=label)
+            plt.xlim(timeRange)
+            if ylim:
+                plt.ylim(ylim)
+            if not overlay:
+                plt.ylabel(label, fontsize=fontSize)
+        plt.xlabel('Time (ms)', fontsize=fontSize)
+        if overlay:
+            plt.legend(fontsize=fontSize, loc=1)
+        plt.suptitle('cell_%d' % key if oneFigPer == 'cell' else str(key), fontsize=fontSize)
+        name = 'cell_%d' % key if oneFigPer == 'cell' else str(key)
+        if isinstance(saveFig, str) and len(groups) > 1:  # one file per figure
+            root, ext = os.path.splitext(saveFig)
+            _save(fig, '%s_%s%s' % (root, name, ext), None)
+        else:
+            _save(fig, saveFig, '_traces_%s.png' % name)
+        figs[name] = fig
+    return figs, {}
+
+
+fastAnalyses = {'plotRaster': plotRaster, 'plotSpikeHist': plotSpikeHist, 'plotRatePSD': plotRatePSD,
+                'plotTraces': plotTraces}
+
+
+###############################################################################
+#
+# RUN
+#
+###############################################################################
+
+def _function(name):
+    """Analysis function: the index-based version, unless sim.analysis has another replacement"""
+    func = getattr(sim.analysis, name, None)
+    if name in fastAnalyses and (func is None or getattr(func, '__module__', '').startswith('netpyne')):
+        return fastAnalyses[name]
+    return func
+
+
+def _initWorker():
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+
+
+def _runAnalysis(entry):
+    """Run one analysis; returns (name, seconds, error or None, pickled figures to show)"""
+    import matplotlib.pyplot as plt
+
+    name, kwargs = entry
+    show = kwargs.get('showFig', False)
+    kwargs = dict(kwargs, showFig=False)
+    worker = multiprocessing.current_process().name != 'MainProcess'
+    before = set(plt.get_fignums())
+    start = time.time()
+    error = None
+    try:
+        _function(name)(**kwargs)
+    except Exception:
+        error = traceback.format_exc()
+    elapsed = time.time() - start
+    figures = [plt.figure(num) for num in plt.get_fignums() if num not in before]
+    shown = [pickle.dumps(fig) for fig in figures] if show and worker else []
+    for fig in figures:
+        if worker or not show:
+            plt.close(fig)
+    return name, elapsed, error, shown
+
+
+def plotData(workers=None):
+    """
+    Run the analyses of sim.cfg.analysis on rank 0 with a shared sim.spikeIndex
+
+    workers: processes (default: one per core, at most one per analysis); 1 runs them here.
+
+    """
+    from netpyne import __gui__
+    import matplotlib.pyplot as plt
+
+    if sim.rank != 0 or not __gui__:
+        return
+    sim.timing('start', 'plotTime')
+    sim.spikeIndex = SpikeIndex()
+    entries = [(name, {} if kwargs is True else dict(kwargs)) for name, kwargs in sim.cfg.analysis.items()
+               if kwargs is not False]
+    workers = min(workers or os.cpu_count() or 1, len(entries))
+    if workers > 1 and sim.nhosts == 1 and 'fork' in multiprocessing.get_all_start_methods():
+        print('  Running %d analyses in %d processes' % (len(entries), workers))
+        with multiprocessing.get_context('fork').Pool(workers, initializer=_initWorker) as pool:
+            results = pool.map(_runAnalysis, entries, chunksize=1)
+    else:
+        results = [_runAnalysis(entry) for entry in entries]
+
+    for name, elapsed, error, shown in results:
+        if error:
+            print('  %s failed:\n%s' % (name, error))
+        else:
+            print('  %s: %.2f s' % (name, elapsed))
+        for figure in shown:
+            pickle.loads(figure)
+    if any(kwargs.get('showFig') for _, kwargs in entries):
+        plt.show()
+    sim.timing('stop', 'plotTime')
+    if sim.cfg.timing:
+        print('  Done; plotting time = %0.2f s' % sim.timingData['plotTime'])
@@ -0,0 +1,498 @@
+"""
+profiling.py
+
+Nested phase timers, memory and object/event counts of a simulation, saved as JSON
+
+simConfig.timing only gives a few totals (createTime, connectTime, runTime...). With
+profiling on, every phase of building, running and analyzing the network is timed as
+a tree -- e.g. create/connectCells/PYR->PYR/expressions is the time spent evaluating
+the string functions of that conn rule, and analyze/plotRatePSD the time of that plot --
+by wrapping the NetPyNE and repo functions that implement them while the profiler is
+active (of the repo modules, those of the options the run sets, which start() imports
+so simtools finds them patched). Each phase records its inclusive and self time, number
+of calls, and resident memory at start and end and its peak (sampled every sampleInterval
+s by a thread, and from the process high-water mark when it rises during the phase, since
+NEURON keeps the interpreter busy while it integrates).
+
+Also counted: per population, the cells, sections, segments, synMechs, connections and
+stims created, and the spikes fired and the events delivered to it (from presynaptic
+cells and from stims), summed across MPI ranks.
+
+The profile is saved to <filename>_profile.json, with phases as a flat dict keyed by
+path ('create/connectCells') in execution order, so two runs can be compared with
+compare(), or from the command line.
+
+Usage:
+  simConfig.profile = True  # used by simtools
+
+  python profiling.py old_profile.json new_profile.json [threshold]  # list differences; exit status 1 if slower or larger
+
+"""
+
+import contextlib
+import functools
+import importlib
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+
+import numpy as np
+from netpyne import sim
+from neuron import h
+
+sampleInterval = 0.01  # s between memory samples
+
+# conn functions of NetPyNE, timed per conn rule
+connFuncs = ['fullConn', 'probConn', 'convConn', 'divConn', 'fromListConn']
+
+# functions of this repo timed as phases: (module, [class.]function, phase name, simConfig options that use
+# the module); start() imports the modules of the options a run sets, so they are patched before simtools uses them
+runOptions = ['checkpointTimes', 'checkpointInterval', 'restoreCheckpoint', 'monitors', 'spikeStats', 'eventDriven']
+checkpointOptions = ['checkpointTimes', 'checkpointInterval', 'restoreCheckpoint']
+repoFuncs = [('connbuild', 'connectCells', 'connectCells', ['vectorConns']),
+             ('netcache', 'restore', 'restoreCache', ['netCache']),
+             ('runloop', 'runSim', 'runSim', runOptions),
+             ('checkpoint', 'save', 'saveCheckpoint', checkpointOptions),
+             ('checkpoint', 'restore', 'restoreCheckpoint', checkpointOptions),
+             ('bkgtrains', 'SharedBackground.create', 'sharedBackground', ['sharedBkg']),
+             ('tracestore', 'flush', 'flushTraces', ['streamTraces']),
+             ('recplan', 'collect', 'collectEnvelopes', ['planRecording']),
+             ('spikestats', 'update', 'spikeStats', ['spikeStats']),
+             ('intfirepop', 'setup', 'eventEngineSetup', ['eventDriven']),
+             ('intfirepop', 'Engine.update', 'eventEngine', ['eventDriven']),
+             ('colstore', 'save', 'saveColumnar', ['saveColumnar'])]
+
+
+def _rss():
+    """Resident memory of the process (MB)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2.0**20
+    except (OSError, ValueError):
+        return _maxRss()
+
+
+def _maxRss():
+    """High-water mark of the resident memory of the process (MB)"""
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRss / 2.0**20 if sys.platform == 'darwin' else maxRss / 2.0**10
+
+
+###############################################################################
+#
+# PROFILER
+#
+###############################################################################
+
+class Phase(object):
+    """Accumulated time, calls and memory of one phase (a node of the phase tree)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.time = 0.0
+        self.calls = 0
+        self.children = {}
+        self.memStart = None
+        self.memEnd = None
+        self.memPeak = 0.0
+
+    def child(self, name):
+        if name not in self.children:
+            self.children[name] = Phase('%s/%s' % (self.path, name) if self.path else name)
+        return self.children[name]
+
+    def walk(self):
+        yield self
+        for child in self.children.values():
+            for phase in child.walk():
+                yield phase
+
+
+class Profiler(object):
+    """
+    Phase tree of a simulation, with the memory sampler and the wrapped functions
+
+    start() wraps the functions in patches() so their calls are timed as phases of the
+    phase they run in, stop() restores them; simtools opens the top-level phases.
+
+    """
+
+    def __init__(self):
+        self.root = Phase('')
+        self.stack = [self.root]
+        self.patched = []
+        self.counts = {}
+        self.events = {}
+        self.stimSpikes = {}  # (gid, stim label): Vector of the NetStim spikes counted by countEvents()
+        self.spikeExchange = None
+        self._sampling = False
+
+    # ---- phases
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the block as phase name, a child of the current phase"""
+        phase = self.stack[-1].child(name)
+        memStart = _rss()
+        maxRssStart = _maxRss()
+        if phase.memStart is None:
+            phase.memStart = memStart
+        phase.memPeak = max(phase.memPeak, memStart)
+        self.stack.append(phase)
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.time += time.perf_counter() - start
+            phase.calls += 1
+            self.stack.pop()
+            phase.memEnd = _rss()
+            maxRss = _maxRss()
+            phase.memPeak = max(phase.memPeak, phase.memEnd, maxRss if maxRss > maxRssStart else 0.0)
+
+    def add(self, name, elapsed):
+        """Add elapsed s to phase name under the current phase, without memory (for calls in hot loops)"""
+        phase = self.stack[-1].child(name)
+        phase.time += elapsed
+        phase.calls += 1
+
+    def _sample(self):
+        while self._sampling:
+            rss = _rss()
+            for phase in list(self.stack):
+                if rss > phase.memPeak:
+                    phase.memPeak = rss
+            time.sleep(sampleInterval)
+
+    # ---- wrapped functions
+
+    def patches(self, analysis=()):
+        """(owner, attribute, wrapper factory) of every function timed as a phase; analysis: plot functions to time"""
+        from netpyne.network.network import Network
+
+        def timed(name):
+            return lambda func: self._timed(func, name)
+
+        patches = [(Network, name, timed(name)) for name in ['createPops', 'createCells', 'connectCells', 'addStims', 'addRxD']]
+        patches += [(Network, '_connStrToFunc', self._timedConnStrToFunc)]
+        patches += [(Network, name, self._timedConnFunc) for name in connFuncs]
+        patches += [(sim, name, timed(name)) for name in ['setupRecording', 'runSim', 'gatherData', 'saveData']]
+        patches += [(sim, 'runSimWithIntervalFunc', timed('runSim'))]
+        for name in analysis:  # looked up in sim.plotting first, as sim.analysis.plotData() does
+            owner = next((owner for owner in [sim.plotting, sim.analysis] if hasattr(owner, name)), None)
+            if owner:
+                patches.append((owner, name, timed(name)))
+        for moduleName, funcPath, name, _ in repoFuncs:
+            module = sys.modules.get(moduleName)
+            if module:
+                className, _, funcName = funcPath.rpartition('.')
+                patches.append((getattr(module, className) if className else module, funcName, timed(name)))
+        return patches
+
+    def _timed(self, func, name):
+        profiler = self
+
+        @functools.wraps(func)
+        def timedFunc(*args, **kwargs):
+            with profiler.phase(name):
+                return func(*args, **kwargs)
+        return timedFunc
+
+    def _timedConnFunc(self, func):
+        """Conn functions are timed per rule: connectCells/<rule>"""
+        profiler = self
+
+        @functools.wraps(func)
+        def timedFunc(net, preCellsTags, postCellsTags, connParam):
+            with profiler.phase(str(connParam.get('label'))):
+                return func(net, preCellsTags, postCellsTags, connParam)
+        return timedFunc
+
+    def _timedConnStrToFunc(self, func):
+        """String functions of conn rules: compiling them and every call go to connectCells/<rule>/expressions"""
+        profiler = self
+
+        def timedLambda(lambdaFunc):
+            @functools.wraps(lambdaFunc)
+            def timedFunc(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return lambdaFunc(*args, **kwargs)
+                finally:
+                    profiler.add('expressions', time.perf_counter() - start)
+            return timedFunc
+
+        @functools.wraps(func)
+        def timedFunc(net, preCellsTags, postCellsTags, connParam):
+            with profiler.phase(str(connParam.get('label'))), profiler.phase('expressions'):
+                func(net, preCellsTags, postCellsTags, connParam)
+            for key, value in list(connParam.items()):
+                if key.endswith('Func') and callable(value):
+                    connParam[key] = timedLambda(value)
+        return timedFunc
+
+    # ---- start / stop
+
+    def start(self, analysis=()):
+        for owner, name, wrap in self.patches(analysis):
+            original = getattr(owner, name)
+            self.patched.append((owner, name, original))
+            setattr(owner, name, wrap(original))
+        self._sampling = True
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+        self._sampling = False
+
+
+###############################################################################
+#
+# COUNTS
+#
+###############################################################################
+
+def _sumCounts(nodeCounts):
+    """Sum {pop: {key: n}} dicts of all nodes"""
+    total = {}
+    for counts in nodeCounts:
+        for pop, popCounts in counts.items():
+            for key, n in popCounts.items():
+                total.setdefault(pop, {}).setdefault(key, 0)
+                total[pop][key] += n
+    return total
+
+
+def countObjects():
+    """Count the cells, sections, segments, synMechs, conns and stims of each population (after create)"""
+    profiler = active()
+    if not profiler:
+        return
+    counts = {}
+    for cell in sim.net.cells:
+        popCounts = counts.setdefault(cell.tags['pop'], {'cells': 0, 'secs': 0, 'segs': 0, 'synMechs': 0,
+                                                         'conns': 0, 'stims': 0})
+        popCounts['cells'] += 1
+        secs = getattr(cell, 'secs', None)
+        for sec in (secs if isinstance(secs, dict) else {}).values():  # PointCell.__getattr__ answers any name
+            popCounts['secs'] += 1
+            popCounts['segs'] += sec['hObj'].nseg if sec.get('hObj') is not None else sec.get('geom', {}).get('nseg', 1)
+            popCounts['synMechs'] += len(sec.get('synMechs', []))
+        popCounts['conns'] += len(cell.conns)
+        popCounts['stims'] += len(cell.stims)
+    profiler.counts = _sumCounts(sim.pc.py_allgather(counts))
+    profiler.stimSpikes = _recordStims()
+
+
+def _recordStims():
+    """Record the spikes of the NetStim conns not recorded otherwise (recordStim, shared backgrounds): {(gid, label): Vector}"""
+    recorded = sim.simData.get('stims', {})
+    vecs = {}
+    for cell in sim.net.cells:
+        for conn in cell.conns:
+            if (conn.get('preGid') == 'NetStim' and 'preSourceGid' not in conn and conn.get('hObj') is not None
+                    and conn.get('preLabel') not in recorded.get('cell_%d' % cell.gid, {})):
+                vecs[(cell.gid, conn.get('preLabel'))] = vec = h.Vector()
+                conn['hObj'].record(vec)
+    return vecs
+
+
+def countEvents():
+    """
+    Count the spikes of each population and the events delivered to it (after runSim, before gatherData)
+
+    Events from cells are the spikes of the presynaptic gid of each conn. Events from stims
+    are the spikes of the shared background trains, of the NetStims recorded with
+    simConfig.recordStim, and of the other NetStims, recorded by countObjects().
+
+    """
+    profiler = active()
+    if not profiler:
+        return
+    gids, spikeCounts = np.unique(np.array(sim.simData['spkid'], dtype=np.int64), return_counts=True)
+    allSpikes = {}
+    for nodeSpikes in sim.pc.py_allgather(dict(zip(gids.tolist(), spikeCounts.tolist()))):
+        allSpikes.update(nodeSpikes)
+
+    sourceSpikes = {}
+    for _, sources in (getattr(sim, 'bkgTrains', None) or {}).values():
+        sourceGids, sourceCounts = np.unique(sources, return_counts=True)
+        sourceSpikes.update(zip(sourceGids.tolist(), sourceCounts.tolist()))
+    stimSpikes = sim.simData.get('stims', {})
+    ownStimSpikes = profiler.stimSpikes
+
+    events = {}
+    for cell in sim.net.cells:
+        popEvents = events.setdefault(cell.tags['pop'], {'spikes': 0, 'fromCells': 0, 'fromStims': 0})
+        popEvents['spikes'] += allSpikes.get(cell.gid, 0)
+        recordedStims = stimSpikes.get('cell_%d' % cell.gid, {})
+        for conn in cell.conns:
+            if conn.get('preGid') == 'NetStim':
+                if 'preSourceGid' in conn:
+                    popEvents['fromStims'] += sourceSpikes.get(conn['preSourceGid'], 0)
+                elif conn.get('preLabel') in recordedStims:
+                    popEvents['fromStims'] += len(recordedStims[conn['preLabel']])
+                elif (cell.gid, conn.get('preLabel')) in ownStimSpikes:
+                    popEvents['fromStims'] += int(ownStimSpikes[(cell.gid, conn.get('preLabel'))].size())
+            else:
+                popEvents['fromCells'] += allSpikes.get(conn['preGid'], 0)
+    profiler.events = _sumCounts(sim.pc.py_allgather(events))
+    refs = [h.ref(0) for _ in range(4)]
+    sim.pc.spike_statistics(*refs)  # (max sent in an exchange), sent, received, received and used
+    nodeStats = sim.pc.py_allgather([ref[0] for ref in refs[1:]])
+    profiler.spikeExchange = {key: int(n) for key, n in zip(['sent', 'received', 'receivedUseful'], np.sum(nodeStats, axis=0))}
+
+
+###############################################################################
+#
+# START / SAVE
+#
+###############################################################################
+
+def enabled(simConfig):
+    return bool(getattr(simConfig, 'profile', False))
+
+
+def start(simConfig):
+    """Start profiling, with a new profile in sim.profiler (importing the repo modules of the options set, see repoFuncs)"""
+    stop()
+    for moduleName, _, _, options in repoFuncs:
+        if any(getattr(simConfig, option, None) for option in options):
+            importlib.import_module(moduleName)
+    sim.profiler = Profiler()
+    sim.profiler.start(list(simConfig.analysis))
+
+
+def stop():
+    """Restore the wrapped functions; the profile stays in sim.profiler"""
+    if getattr(sim, 'profiler', None):
+        sim.profiler.stop()
+
+
+def active():
+    """The running profiler, or None"""
+    profiler = getattr(sim, 'profiler', None)
+    return profiler if profiler and profiler.patched else None
+
+
+def phase(name):
+    """Time a block as a phase if profiling (no-op otherwise)"""
+    profiler = active()
+    return profiler.phase(name) if profiler else contextlib.nullcontext()
+
+
+def fileName(simConfig=None):
+    cfg = simConfig or sim.cfg
+    base = cfg.filename
+    if getattr(cfg, 'saveFolder', None):
+        base = os.path.join(cfg.saveFolder, os.path.basename(base))
+    return base + '_profile.json'
+
+
+def profileData():
+    """Profile of this node as a JSON-able dict (phases keyed by path)"""
+    profiler = sim.profiler
+    phases = {}
+    for phase in list(profiler.root.walk())[1:]:
+        phases[phase.path] = {'time': phase.time, 'self': phase.time - sum(child.time for child in phase.children.values()),
+                              'calls': phase.calls, 'memStart': phase.memStart, 'memEnd': phase.memEnd,
+                              'memPeak': phase.memPeak}
+    return phases
+
+
+def save():
+    """Gather the phases of all nodes and write the profile JSON (times and memory: max across nodes)"""
+    profiler = active()
+    if not profiler:
+        return
+    nodePhases = sim.pc.py_allgather(profileData())
+    if sim.rank != 0:
+        return
+    phases = {}
+    for path in nodePhases[0]:
+        values = [node[path] for node in nodePhases if path in node]
+        phases[path] = {key: max(v[key] for v in values if v[key] is not None) if any(v[key] is not None for v in values)
+                        else None for key in values[0]}
+        if len(nodePhases) > 1:
+            phases[path]['timeRanks'] = [node[path]['time'] if path in node else 0.0 for node in nodePhases]
+
+    import netpyne
+    import netcache
+    data = {'info': {'network': netcache.netKey(sim.net.params, sim.cfg), 'nhosts': sim.nhosts,
+                     'duration': sim.cfg.duration, 'dt': sim.cfg.dt, 'netpyne': netpyne.__version__,
+                     'neuron': h.nrnversion(), 'python': platform.python_version(), 'host': platform.node(),
+                     'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'units': {'time': 's', 'mem': 'MB'},
+            'phases': phases, 'counts': profiler.counts, 'events': profiler.events,
+            'spikeExchange': profiler.spikeExchange}
+    filename = fileName()
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=1)
+    print('  Profile saved to %s' % filename)
+
+
+###############################################################################
+#
+# COMPARISON
+#
+###############################################################################
+
+def compare(old, new, threshold=0.1, minTime=0.05, minMem=10.0):
+    """
+    Differences between two profiles (dicts or file names) beyond threshold (relative)
+
+    Returns a list of (item, old, new) for phase times above minTime s, peak memory above
+    minMem MB, and object and event counts; phases only in one of the profiles are listed
+    with None on the other side. Different info['network'] means the networks differ.
+
+    """
+    if isinstance(old, str):
+        with open(old) as f:
+            old = json.load(f)
+    if isinstance(new, str):
+        with open(new) as f:
+            new = json.load(f)
+
+    def changed(a, b, minimum=0.0):
+        return max(a, b) >= minimum and abs(b - a) > threshold * max(abs(a), 1e-12)
+
+    diffs = []
+    if old['info']['network'] != new['info']['network']:
+        diffs.append(('info/network', old['info']['network'], new['info']['network']))
+    for path in list(old['phases']) + [path for path in new['phases'] if path not in old['phases']]:
+        a, b = old['phases'].get(path), new['phases'].get(path)
+        if a is None or b is None:
+            diffs.append((path, a and a['time'], b and b['time']))
+            continue
+        if changed(a['time'], b['time'], minTime):
+            diffs.append((path + ' time', a['time'], b['time']))
+        if a['memPeak'] is not None and b['memPeak'] is not None and changed(a['memPeak'], b['memPeak'], minMem):
+            diffs.append((path + ' memPeak', a['memPeak'], b['memPeak']))
+    for section in ['counts', 'events']:
+        for pop in sorted(set(old[section]) | set(new[section])):
+            a, b = old[section].get(pop, {}), new[section].get(pop, {})
+            for key in sorted(set(a) | set(b)):
+                if changed(a.get(key, 0), b.get(key, 0)):
+                    diffs.append(('%s/%s/%s' % (section, pop, key), a.get(key, 0), b.get(key, 0)))
+    return diffs
+
+
+if __name__ == '__main__':
+    threshold = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+    diffs = compare(sys.argv[1], sys.argv[2], threshold)
+    for item, a, b in diffs:
+        ratio = ' (x%.2f)' % (b / a) if isinstance(a, (int, float)) and isinstance(b, (int, float)) and a else ''
+        print('%-60s %12s -> %12s%s' % (item, '%.4g' % a if isinstance(a, (int, float)) else a,
+                                         '%.4g' % b if isinstance(b, (int, float)) else b, ratio))
+    print('%d differences above %.0f%%' % (len(diffs), threshold * 100))
+    regressions = [item for item, a, b in diffs if item.endswith((' time', ' memPeak')) and b > a]
+    sys.exit(1 if regressions else 0)
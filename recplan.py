@@ -0,0 +1,333 @@
+"""
+recplan.py
+
+Recording planner: resolves simConfig.recordTraces against each cell rule once
+
+NetPyNE tries every trace spec on every recorded cell, and silently records nothing
+when the spec does not apply (e.g. the u of an Izhi point process on an HH cell, or a
+synMech no connection uses). The planner resolves each spec once per kind of cell
+(the set of cell rules that built it), reports the specs that cannot apply, and only
+passes the applicable ones to NetPyNE for the other cells of the same kind. Cell
+structure is checked on the first cell of each kind; synMech specs are checked against
+the sections the conn and stim rules using that synMech target.
+
+Trace specs can also reduce the data while recording:
+  'decimate': n  # keep one sample every n recordSteps (recorded by NEURON with Dt = n*recordStep)
+  'envelope': n  # min and max of every n samples (2 values per n recordSteps)
+Envelopes are recorded at recordStep and reduced every saveFileStep ms, so only
+saveFileStep ms of full-resolution data are ever kept. For plotting, reduced traces
+are wrapped in Resampled views that read them on the recordStep time grid.
+
+Usage:
+  simConfig.planRecording = True  # opt-in, used by simtools
+  simConfig.recordTraces['V'] = {'sec': 'soma', 'loc': 0.5, 'var': 'v', 'envelope': 40}
+
+"""
+
+import numpy as np
+from netpyne import sim
+from netpyne.cell.cell import Cell
+from neuron import h
+
+reduceKeys = ['decimate', 'envelope']
+
+
+###############################################################################
+#
+# PLANNING
+#
+###############################################################################
+
+def traceReduction(params):
+    """(mode, n) of a trace spec: ('decimate', n), ('envelope', n) or (None, 1)"""
+    modes = [key for key in reduceKeys if params.get(key) not in (None, 1, False)]
+    if not modes:
+        return None, 1
+    if len(modes) > 1:
+        raise ValueError('Trace spec can use only one of %s' % ', '.join(reduceKeys))
+    mode = modes[0]
+    n = params[mode]
+    if int(n) != n or n < (2 if mode == 'envelope' else 1):
+        raise ValueError('Trace spec %s must be an integer >= %d, not %r' % (mode, 2 if mode == 'envelope' else 1, n))
+    return mode, int(n)
+
+
+def cellKind(cell):
+    """Cells of the same kind are built by the same cell rules, so a trace spec applies to all or none of them"""
+    if isinstance(getattr(cell, 'secs', None), dict):  # PointCell.__getattr__ returns a function for any name
+        return (type(cell).__name__, cell.tags.get('cellModel'), tuple(cell.tags.get('label', [cell.tags.get('pop')])))
+    return (type(cell).__name__, cell.tags.get('cellModel'))
+
+
+def kindLabel(kind):
+    return '%s (%s)' % ('/'.join(map(str, kind[2])), kind[1]) if len(kind) > 2 else str(kind[1])
+
+
+def synMechTargets(netParams):
+    """
+    Sections targeted by each synMech: {synMech: set of sec specs (None = default sec), or None = any section}
+
+    Covers conn rules and stim targets of NetStim/VecStim sources (the ones that use synMechs).
+
+    """
+    defaultSynMech = next(iter(netParams.synMechParams), None)
+    stimSources = {label: source.get('type') for label, source in netParams.stimSourceParams.items()}
+    rules = list(netParams.connParams.values())
+    rules += [target for target in netParams.stimTargetParams.values()
+              if 'synMech' in target or stimSources.get(target.get('source')) in ('NetStim', 'VecStim')]
+    redistributed = set()
+    for subConn in netParams.subConnParams.values():  # subcellular rules move synapses to other sections
+        redistributed.update(subConn.get('groupSynMechs', []) or [None])
+
+    targets = {}
+    for rule in rules:
+        synMechs = rule.get('synMech', defaultSynMech)
+        for synMech in synMechs if isinstance(synMechs, list) else [synMechs]:
+            if synMech in redistributed or None in redistributed or rule.get('connFunc'):
+                targets[synMech] = None
+            elif targets.get(synMech, set()) is not None:
+                secs = rule.get('sec')
+                targets.setdefault(synMech, set()).update(secs if isinstance(secs, list) else [secs])
+    return targets
+
+
+def _cellSecs(cell, secs):
+    """Section names a conn with these sec params goes to, as resolved by CompartCell"""
+    names = []
+    for sec in secs:
+        if sec in cell.secLists:
+            names.extend(cell.secLists[sec])
+        elif sec in cell.secs:
+            names.append(sec)
+        elif cell.secs:
+            names.append('soma' if 'soma' in cell.secs else list(cell.secs.keys())[0])
+    return names
+
+
+def whyNot(params, cell, targets):
+    """Reason why a trace spec cannot be recorded from cells of the same kind as cell, or None if it can"""
+    secs = getattr(cell, 'secs', None)
+    secs = secs if isinstance(secs, dict) else None  # see cellKind()
+    if 'synMech' in params and 'sec' not in params:
+        return None if params['synMech'] in targets else 'no conn or stim uses synMech %s' % params['synMech']
+    if 'sec' not in params:
+        if 'var' not in params:
+            return 'no sec or var'
+        if getattr(cell, 'hPointp', None) is None:
+            return 'not a point process cell'
+        return None if hasattr(cell.hPointp, '_ref_' + params['var']) else 'no variable %s' % params['var']
+
+    if not secs or params['sec'] not in secs:
+        return 'no section %s' % params['sec']
+    sec = secs[params['sec']]
+    if 'mech' in params:
+        if params['mech'] not in sec.get('mechs', {}):
+            return 'no mechanism %s in %s' % (params['mech'], params['sec'])
+    elif 'synMech' in params:
+        if params['synMech'] not in targets:
+            return 'no conn or stim uses synMech %s' % params['synMech']
+        if targets[params['synMech']] is not None and params['sec'] not in _cellSecs(cell, targets[params['synMech']]):
+            return 'no conn or stim uses synMech %s in %s' % (params['synMech'], params['sec'])
+    elif 'pointp' in params:
+        if params['pointp'] not in sec.get('pointps', {}):
+            return 'no point process %s in %s' % (params['pointp'], params['sec'])
+    elif 'stim' not in params and 'var' in params and 'hObj' in sec:
+        if not hasattr(sec['hObj'](params.get('loc', 0.5)), '_ref_' + params['var']):
+            return 'no variable %s in %s' % (params['var'], params['sec'])
+    return None
+
+
+class RecordingPlan(object):
+    """
+    Context manager around sim.setupRecording() that only records applicable trace specs
+
+    Cell.recordTraces() is replaced by a version that resolves the specs once per cell kind
+    and calls the original with the applicable specs, grouped by recording step (decimated
+    traces are recorded with a longer step). The plan stays in sim.recordPlan after setup,
+    to reduce the envelope traces during the run.
+
+    """
+
+    def __init__(self, netParams, simConfig):
+        self.recordTraces = dict(simConfig.recordTraces)
+        self.targets = synMechTargets(netParams)
+        self.plan = {}  # cell kind -> {trace: reason it cannot be recorded, or None}
+        self.kindGids = {}  # cell kind -> gids of the cells recorded
+        self.reduction = {trace: traceReduction(params) for trace, params in self.recordTraces.items()}
+        if (simConfig.recordStep == 'adaptive' or getattr(simConfig, 'use_local_dt', False)) and \
+                any(mode for mode, _ in self.reduction.values()):
+            print('  Warning: decimate and envelope traces not supported with adaptive recordStep or local dt; recording all samples')
+            self.reduction = {trace: (None, 1) for trace in self.recordTraces}
+        self.envelopes = [trace for trace, (mode, _) in self.reduction.items() if mode == 'envelope']
+        self.carry = {}  # (trace, cell, secLoc) -> samples of the last incomplete envelope bin
+        self.chunks = {}  # (trace, cell, secLoc) -> reduced envelope chunks (when not streaming)
+
+    def recordStep(self, trace):
+        """Time between stored samples of a trace (ms)"""
+        mode, n = self.reduction[trace]
+        return sim.cfg.recordStep * (n if mode == 'decimate' else n / 2. if mode == 'envelope' else 1)
+
+    def applicable(self, cell):
+        kind = cellKind(cell)
+        if kind not in self.plan:
+            self.plan[kind] = {trace: whyNot(params, cell, self.targets) for trace, params in self.recordTraces.items()}
+        self.kindGids.setdefault(kind, set()).add(cell.gid)
+        return [trace for trace, reason in self.plan[kind].items() if reason is None]
+
+    def __enter__(self):
+        self.cellRecordTraces = Cell.recordTraces
+        plan = self
+
+        def recordTraces(cell):
+            recordTraces, recordStep = sim.cfg.recordTraces, sim.cfg.recordStep
+            groups = {}
+            for trace in plan.applicable(cell):
+                mode, n = plan.reduction[trace]
+                groups.setdefault(n if mode == 'decimate' else 1, {})[trace] = recordTraces[trace]
+            try:
+                for n, traces in groups.items():
+                    sim.cfg.recordTraces = traces
+                    if recordStep != 'adaptive':
+                        sim.cfg.recordStep = recordStep * n
+                    plan.cellRecordTraces(cell)
+            finally:
+                sim.cfg.recordTraces, sim.cfg.recordStep = recordTraces, recordStep
+
+        Cell.recordTraces = recordTraces
+        sim.recordPlan = self
+        return self
+
+    def __exit__(self, *args):
+        Cell.recordTraces = self.cellRecordTraces
+        self.report()
+
+    def report(self):
+        """Print the specs skipped for each cell kind and the number of recorders created on this node"""
+        for kind, reasons in self.plan.items():
+            for trace, reason in reasons.items():
+                if reason:
+                    print('  Not recording %s from %d %s cells: %s' % (trace, len(self.kindGids[kind]), kindLabel(kind), reason))
+        numRecorders = sum(len(vec) if isinstance(vec, dict) else 1
+                           for trace in self.recordTraces for key, vec in sim.simData.get(trace, {}).items()
+                           if key.startswith('cell_') and not key.startswith('cell_time_'))
+        numSpecs = sum(len(reasons) for reasons in self.plan.values())
+        numApplicable = sum(reason is None for reasons in self.plan.values() for reason in reasons.values())
+        print('  Recording %d traces on node %i (%d of %d trace specs x cell kinds apply)' % (numRecorders, sim.rank, numApplicable, numSpecs))
+
+
+###############################################################################
+#
+# ENVELOPES
+#
+###############################################################################
+
+def envelope(values, n):
+    """Min and max of every n samples, interleaved: [min0, max0, min1, max1, ...]"""
+    numBins = -(-len(values) // n)
+    padded = np.concatenate([values, np.full(numBins * n - len(values), np.nan)]).reshape(numBins, n)
+    reduced = np.empty(2 * numBins)
+    reduced[0::2] = np.nanmin(padded, axis=1)
+    reduced[1::2] = np.nanmax(padded, axis=1)
+    return reduced
+
+
+def reduce(trace, key, values, final=False):
+    """
+    Envelope of the samples recorded since the last call for this trace, cell and synapse
+
+    Samples of an incomplete bin are kept for the next call, or reduced as a shorter bin if final.
+
+    """
+    plan = sim.recordPlan
+    n = plan.reduction[trace][1]
+    values = np.concatenate([plan.carry.pop((trace, key), np.zeros(0)), values])
+    numFull = len(values) // n * n
+    if not final and numFull < len(values):
+        plan.carry[(trace, key)] = values[numFull:]
+        values = values[:numFull]
+    return envelope(values, n)
+
+
+def _vectors(trace):
+    """(key, h.Vector) for every cell (and synapse, for traces with several synMechs) recording a trace"""
+    for cellKey, vec in sim.simData.get(trace, {}).items():
+        if not cellKey.startswith('cell_') or cellKey.startswith('cell_time_'):
+            continue
+        if isinstance(vec, dict):
+            for secLoc, v in vec.items():
+                yield (cellKey, secLoc), v
+        else:
+            yield (cellKey, None), vec
+
+
+def collect(simTime=None, final=False):
+    """Reduce the envelope traces recorded since the last call and empty their vectors (for runSimWithIntervalFunc)"""
+    plan = sim.recordPlan
+    for trace in plan.envelopes:
+        for key, vec in _vectors(trace):
+            plan.chunks.setdefault((trace,) + key, []).append(reduce(trace, key, vec.as_numpy(), final))
+            vec.resize(0)
+
+
+def finish():
+    """Replace the envelope trace vectors by the reduced traces after the run"""
+    plan = sim.recordPlan
+    collect(final=True)
+    for trace in plan.envelopes:
+        for (cellKey, secLoc), vec in list(_vectors(trace)):
+            values = h.Vector(np.concatenate(plan.chunks.pop((trace, cellKey, secLoc))))
+            if secLoc is None:
+                sim.simData[trace][cellKey] = values
+            else:
+                sim.simData[trace][cellKey][secLoc] = values
+
+
+###############################################################################
+#
+# READING
+#
+###############################################################################
+
+class Resampled(object):
+    """
+    Read-only view of a decimated or envelope trace on the recordStep time grid
+
+    Sample i of a decimated trace is stored sample i // n; in each bin of n samples of an
+    envelope trace, the first half reads the min and the second half the max, so plots
+    draw the band between them. Only the slices read are expanded (plotTraces slices by
+    timeRange before converting to an array).
+
+    """
+
+    def __init__(self, data, mode, n):
+        self.data = np.asarray(data)
+        self.mode = mode
+        self.n = n
+
+    def __len__(self):
+        return len(self.data) * self.n if self.mode == 'decimate' else len(self.data) // 2 * self.n
+
+    def _index(self, i):
+        if self.mode == 'decimate':
+            return i // self.n
+        return 2 * (i // self.n) + (i % self.n >= self.n // 2)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.data[self._index(np.arange(*index.indices(len(self))))]
+        return self.data[self._index(index if index >= 0 else len(self) + index)]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+def resampleSimData(simData, reduction):
+    """Wrap the reduced traces in simData (reduction: {trace: (mode, n)}) in Resampled views, for plotting"""
+    for trace, (mode, n) in reduction.items():
+        if not mode:
+            continue
+        for cellKey, values in simData.get(trace, {}).items():
+            if isinstance(values, dict):
+                simData[trace][cellKey] = {secLoc: Resampled(v, mode, n) for secLoc, v in values.items()}
+            elif cellKey.startswith('cell_') and not cellKey.startswith('cell_time_'):
+                simData[trace][cellKey] = Resampled(values, mode, n)
@@ -0,0 +1,70 @@
+"""
+runloop.py
+
+Run loop with tasks at given times: monitors, checkpoints and interval functions
+
+NetPyNE's runSimWithIntervalFunc() calls one function at a fixed interval. Here the run
+advances with pc.psolve() to the next time any task is due, calls the tasks due then,
+and stops early when a task returns a reason to stop (monitors.py). A restore function
+can set the state after initialization, so the run continues from a checkpoint
+(checkpoint.py) instead of t = 0.
+
+Usage (simtools builds the tasks from simConfig):
+  reason = runloop.runSim([(runloop.every(1000), tracestore.flush, True)])
+
+"""
+
+import itertools
+
+from netpyne import sim
+from netpyne.sim.run import postRun, prepareSimWithIntervalFunc
+from neuron import h
+
+
+def every(interval, start=0.0):
+    """Times start + interval, start + 2*interval, ..."""
+    return (start + interval * i for i in itertools.count(1))
+
+
+def _nextTime(times, after):
+    """First of times (an iterator) after after, or infinity"""
+    for t in times:
+        if t > after:
+            return t
+    return float('inf')
+
+
+def runSim(tasks=(), restore=None):
+    """
+    sim.runSim() calling each task func(simTime) at its times, until duration or a func returns a reason to stop
+
+    tasks: (times, func, final) with times an increasing iterable (ms); final tasks are also
+    called when the run stops between two of their times (e.g. to flush recorded data).
+    restore: function called after initialization, that may set the state and h.t.
+    Returns the reason the run stopped early, or None. postRun() is left to the caller.
+
+    """
+    stopTime, _ = prepareSimWithIntervalFunc()
+    if restore:
+        restore()
+    tolerance = sim.cfg.dt / 2
+    times = [iter(taskTimes) for taskTimes, _, _ in tasks]
+    nextTimes = [_nextTime(taskTimes, h.t + tolerance) for taskTimes in times]
+    lastCalls = [h.t] * len(tasks)
+    reason = None
+    while h.t < stopTime - tolerance and not reason:
+        sim.pc.psolve(min([stopTime] + nextTimes))
+        for i, (_, func, _) in enumerate(tasks):
+            if nextTimes[i] <= h.t + tolerance:
+                reason = func(h.t) or reason
+                lastCalls[i] = h.t
+                nextTimes[i] = _nextTime(times[i], h.t + tolerance)
+    for i, (_, func, final) in enumerate(tasks):  # the data since their last call
+        if final and lastCalls[i] < h.t - tolerance:
+            func(h.t)
+    return reason
+
+
+def finish():
+    """End the run as NetPyNE does (timing and report), at the current time"""
+    postRun(sim.cfg.duration)
@@ -0,0 +1,139 @@
+"""
+save_benchmark.py
+
+Benchmark of the save formats: NetPyNE's pickle, JSON, MAT and DPK vs colstore
+
+Runs cellmodels2.py (in a sweep.py worker, recording the traces of numRecorded cells)
+and then, on its output, saves and reads back each format and reports:
+  write - time to save (sim.saveData() with only that format on, or colstore.save())
+  size  - size on disk
+  read  - time to load everything (pickle.load, json.load, scipy.io.loadmat...; for
+          colstore, map the columns and read spikes, traces and conns)
+  trace - time to get the V trace of one cell (the other formats load the whole file)
+NetPyNE's formats keep the traces as float64, colstore as float32 by default (half the
+size of the traces, with 7 significant digits): colstore is also run with float64 traces
+(colstore64), which compares the formats at the same precision.
+saveTxt is not written by this NetPyNE version, so it is left out; formats that fail on the
+output are reported as failed.
+
+Usage: python save_benchmark.py [numRecorded] [duration (ms)]
+"""
+
+import gzip
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import colstore
+import sweep
+
+formats = ['savePickle', 'saveJson', 'saveMat', 'saveDpk']
+extensions = {'savePickle': '.pkl', 'saveJson': '.json', 'saveMat': '.mat', 'saveDpk': '.dpk'}
+
+
+def _size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def _read(fmt, path):
+    if fmt == 'savePickle':
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    if fmt == 'saveJson':
+        with open(path) as f:
+            return json.load(f)
+    if fmt == 'saveMat':
+        from scipy.io import loadmat
+        return loadmat(path)
+    with gzip.open(path, 'rb') as f:
+        return pickle.loads(f.read())
+
+
+def _readColumnar(path):
+    data = colstore.load(path)
+    spkt, spkid = data.spikes()
+    total = float(spkt.sum()) + float(spkid.sum())
+    for trace in data.traces:
+        total += sum(float(block.sum()) for block in data.blocks(trace))
+    total += sum(float(column.sum()) for column in data.conns().values())
+    return total
+
+
+def benchmark(sim):
+    """Result of sweep.run(): {format: {'write', 'size', 'read', 'trace'}} for the output of the run in sim"""
+    results = {}
+    base = sim.cfg.filename + '_data'
+    gid = sorted(int(key[len('cell_'):]) for key in sim.allSimData['V'])[0]
+    for fmt in formats:
+        for other in formats:
+            setattr(sim.cfg, other, other == fmt)
+        path = base + extensions[fmt]
+        try:
+            start = time.time()
+            sim.saveData()
+            write = time.time() - start
+            start = time.time()
+            _read(fmt, path)
+            read = time.time() - start
+            results[fmt] = {'write': write, 'size': _size(path), 'read': read, 'trace': read}
+        except Exception as e:
+            results[fmt] = {'error': '%s: %s' % (type(e).__name__, e)}
+        if os.path.exists(path):
+            os.remove(path)
+
+    path = colstore.filePath()
+    for label, traceDtype in [('colstore', np.float32), ('colstore64', np.float64)]:
+        start = time.time()
+        colstore.save(path, traceDtype=traceDtype)
+        write = time.time() - start
+        start = time.time()
+        _readColumnar(path)
+        read = time.time() - start
+        start = time.time()
+        np.array(colstore.load(path).trace('V', gid))
+        trace = time.time() - start
+        results[label] = {'write': write, 'size': _size(path), 'read': read, 'trace': trace}
+        shutil.rmtree(path)
+
+    results['counts'] = {'spikes': len(sim.allSimData['spkt']), 'conns': sum(len(cell['conns']) for cell in sim.net.allCells),
+                         'samples': sum(len(values) for values in sim.allSimData['V'].values()),
+                         'traces': len([trace for trace in sim.cfg.recordTraces if trace in sim.allSimData])}
+    return results
+
+
+def main(numRecorded=10, duration=5000):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cellmodels2.py')
+    point = {'simConfig.recordCells': list(range(numRecorded)), 'simConfig.duration': duration}
+    cacheDir = tempfile.mkdtemp(prefix='save_benchmark_')  # never reuse a cached result
+    try:
+        result, = sweep.run(script, [point], cacheDir=cacheDir, workers=1, collect=benchmark)
+    finally:
+        shutil.rmtree(cacheDir, ignore_errors=True)
+    if result is None:
+        raise RuntimeError('benchmark run failed')
+
+    counts = result['counts']
+    print('\ncellmodels2.py, %g ms: %d spikes, %d conns, %d recorded cells, %d V samples (x %d traces)'
+          % (duration, counts['spikes'], counts['conns'], numRecorded, counts['samples'],
+             counts['traces']))
+    print('%-12s %10s %12s %10s %10s' % ('format', 'write (s)', 'size (MB)', 'read (s)', 'trace (s)'))
+    for fmt in formats + ['colstore', 'colstore64']:
+        values = result[fmt]
+        if 'error' in values:
+            print('%-12s failed: %s' % (fmt[4:], values['error']))
+            continue
+        print('%-12s %10.3f %12.2f %10.3f %10.4f' % (fmt[4:] if fmt in formats else fmt, values['write'],
+                                                    values['size'] / 2.0**20, values['read'], values['trace']))
+    return result
+
+
+if __name__ == '__main__':
+    main(*[int(float(arg)) for arg in sys.argv[1:3]])
@@ -0,0 +1,377 @@
+"""
+scaling_benchmark.py
+
+Scaling benchmark of the example networks, with a regression report against a baseline
+
+Models: cellmodels.py (mixed HH + Izhi), cellmodels2.py with which = 'h-h' and 'izhi',
+tut3.py and tut3_LIF.py. Around a base point (baseNumCells cells, convergence x1,
+baseDuration ms) each model is scaled along one axis at a time:
+  numCells    - 10^2 to 10^4 cells in total (10^5 with --max-cells 100000), every
+                population scaled in proportion (the inputs per cell stay those of the
+                script: probabilities are divided by the size factor, convergence and
+                divergence are kept)
+  convergence - inputs per cell x2, x4 (probability, convergence and divergence
+                multiplied, weights divided, so the drive stays comparable)
+  duration    - simConfig.duration
+Identity connLists (one NetStim per cell) are resized with their populations. The tut3
+scripts are run with their background at weight 0.05 (tut3Drive), as at their own 0.01 no
+cell fires.
+
+Every point runs in a fresh sweep.py worker with simConfig.profile (see profiling.py),
+through simtools ('sweep.runner' for the tut3 scripts, which call sim's), saving a
+pickle and running the analyses of the script. For each phase -- create, connect,
+stim, run, gather, save, analyze -- the time and peak RSS are recorded, with the
+spikes, the events delivered (from cells and stims, see profiling.countEvents) and both
+per second of run time, spikesPerSecond and eventsPerSecond (from sim.timingData and the
+process peak RSS for izhipop, which is not profiled).
+
+The results are written to scaling_results.json, and compared point by point with a
+baseline (a results file of an earlier run, e.g. saved with --save-baseline): phases
+slower or larger than threshold, and failed points, are reported as regressions (exit
+status 1), faster ones as improvements, and changed spike or event counts as changes of the model.
+scaling_baseline.json is a baseline of the default scope from a single-core VM (one
+worker; see its info): times from another machine are not comparable with it, so save a
+baseline there first.
+Options and backends are given as overrides applied to every point (script variables
+only where the script assigns them), so the report shows their effect on the baseline.
+
+Usage: python scaling_benchmark.py [--models cellmodels,tut3] [--max-cells 10000] [--workers 1]
+         [--baseline scaling_baseline.json] [--save-baseline] [--output scaling_results.json]
+         [--threshold 0.2] [simConfig.vectorConns=True backend=numpy ...]
+"""
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import sweep
+
+# name: (script, script variables, overrides)
+# the tut3 scripts drive their PYR cells at weight 0.01, which the fast Exp2Syn (tau2 0.5 ms) keeps below threshold:
+# they would not fire at all (nor M in tut3_LIF), so the suite drives them at 0.05 (~10 Hz, the rate of bkg)
+tut3Drive = {'netParams.stimTargetParams.bkg->PYR.weight': 0.05}
+models = {'cellmodels': ('cellmodels.py', {}, {}),
+          'cellmodels2-hh': ('cellmodels2.py', {'which': 'h-h'}, {}),
+          'cellmodels2-izhi': ('cellmodels2.py', {'which': 'izhi'}, {}),
+          'tut3': ('tut3.py', {}, tut3Drive),
+          'tut3_LIF': ('tut3_LIF.py', {}, tut3Drive)}
+
+numCellsList = [100, 1000, 10000, 100000]  # cells in total
+maxCells = 10000  # default scope; 100000 (--max-cells 100000) takes hours and several GB per worker
+convergences = [1, 2, 4]  # inputs per cell, relative to the script
+durations = [500, 1000, 2000]  # ms
+baseNumCells = 1000
+baseDuration = 1000
+
+phases = ['create', 'connect', 'stim', 'run', 'gather', 'save', 'analyze']
+profilePhases = {'create': 'create/createCells', 'connect': 'create/connectCells', 'stim': 'create/addStims',
+                 'run': 'simulate/runSim', 'gather': 'simulate/gatherData', 'save': 'analyze/saveData',
+                 'analyze': 'analyze'}
+timingKeys = {'create': 'createTime', 'connect': 'connectTime', 'stim': 'stimsTime', 'run': 'runTime',
+              'gather': 'gatherTime', 'save': 'saveTime', 'analyze': 'plotTime'}
+
+threshold = 0.2  # relative change reported
+minTime = 0.05  # s; shorter phases are not compared
+minMem = 10.0  # MB
+
+
+###############################################################################
+#
+# POINTS
+#
+###############################################################################
+
+class _Captured(Exception):
+    pass
+
+
+def modelParams(script, variables):
+    """(netParams, simConfig) of a script, run up to its createSimulateAnalyze() call"""
+    import importlib
+
+    with open(script) as f:
+        code = sweep.overrideSource(f.read(), variables, script)
+    captured = {}
+
+    def capture(netParams, simConfig):
+        captured.update(netParams=netParams, simConfig=simConfig)
+        raise _Captured()
+
+    saved = []
+    cwd = os.getcwd()
+    try:
+        os.chdir(os.path.dirname(script))
+        for moduleName, funcName in sweep.runFuncs:
+            module = importlib.import_module(moduleName)
+            saved.append((module, funcName, getattr(module, funcName)))
+            setattr(module, funcName, capture)
+        exec(code, {'__name__': '__main__', '__file__': script})
+    except _Captured:
+        pass
+    finally:
+        os.chdir(cwd)
+        for module, funcName, func in saved:
+            setattr(module, funcName, func)
+    if not captured:
+        raise RuntimeError('%s did not call createSimulateAnalyze()' % script)
+    return captured['netParams'], captured['simConfig']
+
+
+def _scaled(value, factor, maximum=None):
+    """value (number or string expression) times factor"""
+    if isinstance(value, str):
+        return '(%s)*%r' % (value, factor)
+    value = value * factor
+    return min(value, maximum) if maximum is not None else value
+
+
+def scaledOverrides(netParams, numCells, convergence):
+    """Overrides of the populations and conn rules of netParams for numCells cells and convergence"""
+    sizes = {label: pop['numCells'] for label, pop in netParams.popParams.items() if isinstance(pop.get('numCells'), int)}
+    stims = [label for label in sizes if netParams.popParams[label].get('cellModel') in ('NetStim', 'VecStim')]
+    factor = float(numCells) / sum(size for label, size in sizes.items() if label not in stims)  # stim pops scale along
+    newSizes = {label: max(1, int(round(size * factor))) for label, size in sizes.items()}
+    overrides = {'netParams.popParams.%s.numCells' % label: size for label, size in newSizes.items()}
+    for label, rule in netParams.connParams.items():
+        path = 'netParams.connParams.%s.' % label
+        if 'connList' in rule:
+            pairs = [list(pair) for pair in rule['connList']]
+            prePop = rule.get('preConds', {}).get('pop')
+            if prePop in newSizes and pairs == [[i, i] for i in range(len(pairs))]:
+                overrides[path + 'connList'] = [[i, i] for i in range(newSizes[prePop])]
+            continue
+        if 'probability' in rule:
+            overrides[path + 'probability'] = _scaled(rule['probability'], convergence / factor, 1.0)
+        for key in ['convergence', 'divergence']:
+            if key in rule and convergence != 1:
+                overrides[path + key] = _scaled(rule[key], convergence)
+        if 'weight' in rule and convergence != 1:
+            overrides[path + 'weight'] = _scaled(rule['weight'], 1.0 / convergence)
+    return overrides
+
+
+def benchmarkPoints(maxCells=maxCells):
+    """(numCells, convergence, duration) of the scans around the base point"""
+    sizes = [n for n in numCellsList if n <= maxCells]
+    base = baseNumCells if baseNumCells in sizes else sizes[-1]
+    points = [(n, 1, baseDuration) for n in sizes]
+    points += [(base, c, baseDuration) for c in convergences if c != 1]
+    points += [(base, 1, d) for d in durations if d != baseDuration]
+    return points
+
+
+###############################################################################
+#
+# WORKER
+#
+###############################################################################
+
+def collect(sim):
+    """Result of sweep.run(): the profile (if profiled), timing, peak RSS and counts of the run in sim"""
+    import profiling
+
+    result = {'timing': {key: float(value) for key, value in sim.timingData.items()},
+              'maxRss': profiling._maxRss(), 'spikes': len(sim.allSimData.get('spkt', [])),
+              'cells': len(sim.net.allCells),
+              'conns': sum(len(cell['conns'] if isinstance(cell, dict) else cell.conns) for cell in sim.net.allCells)}
+    fileName = profiling.fileName()
+    if os.path.exists(fileName):
+        with open(fileName) as f:
+            result['profile'] = json.load(f)
+    return result
+
+
+def metrics(result):
+    """Phase times and peak RSS, spikes and events (per second of run time) of a collect() result"""
+    profile = result.get('profile')
+    values = {'phases': {}, 'cells': result['cells'], 'conns': result['conns'], 'spikes': result['spikes']}
+    for name in phases:
+        if profile:
+            phase = profile['phases'].get(profilePhases[name])
+            time, mem = (phase['time'], phase['memPeak']) if phase else (0.0, None)
+            if name == 'analyze' and 'analyze/saveData' in profile['phases']:
+                time -= profile['phases']['analyze/saveData']['time']
+        else:
+            time, mem = result['timing'].get(timingKeys[name], 0.0), None
+        values['phases'][name] = {'time': time, 'memPeak': mem}
+    mems = [phase['memPeak'] for phase in values['phases'].values() if phase['memPeak'] is not None]
+    values['peakRss'] = max(mems + [result['maxRss']])
+    events = None
+    if profile and profile.get('events'):
+        events = sum(pop['fromCells'] + pop['fromStims'] for pop in profile['events'].values())
+    values['events'] = events
+    runTime = values['phases']['run']['time'] or float('nan')
+    values['spikesPerSecond'] = values['spikes'] / runTime
+    values['eventsPerSecond'] = events / runTime if events is not None else None
+    return values
+
+
+###############################################################################
+#
+# REPORT
+#
+###############################################################################
+
+def pointKey(record):
+    return '%s n=%d c=%g d=%g' % (record['model'], record['numCells'], record['convergence'], record['duration'])
+
+
+def _changed(a, b, minimum=0.0):
+    return a is not None and b is not None and max(a, b) >= minimum and abs(b - a) > threshold * max(abs(a), 1e-12)
+
+
+def compare(results, baseline):
+    """(regressions, improvements, changes): lists of (point, item, baseline value, new value); failed points are regressions"""
+    old = {pointKey(record): record for record in baseline['results'] if 'phases' in record}
+    regressions, improvements, changes = [], [], []
+    for record in results['results']:
+        key = pointKey(record)
+        if key not in old:
+            continue
+        if 'phases' not in record:
+            regressions.append((key, 'failed', None, None))
+            continue
+        a, b = old[key], record
+        for name in phases:
+            for item, minimum in [('time', minTime), ('memPeak', minMem)]:
+                x, y = a['phases'][name][item], b['phases'][name][item]
+                if _changed(x, y, minimum):
+                    (regressions if y > x else improvements).append((key, '%s %s' % (name, item), x, y))
+        if _changed(a['peakRss'], b['peakRss'], minMem):
+            (regressions if b['peakRss'] > a['peakRss'] else improvements).append((key, 'peakRss', a['peakRss'], b['peakRss']))
+        for item in ['cells', 'conns', 'spikes', 'events']:
+            if _changed(a[item], b[item]):
+                changes.append((key, item, a[item], b[item]))
+    return regressions, improvements, changes
+
+
+def printReport(results, baseline=None):
+    print('\n%-18s %7s %3s %6s %9s %9s %9s %9s %9s %9s %9s %9s %10s %10s'
+          % (('model', 'cells', 'c', 'dur') + tuple(phases) + ('RSS (MB)', 'spikes/s', 'events/s')))
+    for record in results['results']:
+        head = '%-18s %7d %3g %6g' % (record['model'], record['numCells'], record['convergence'], record['duration'])
+        if 'error' in record:
+            print('%s failed: %s' % (head, record['error']))
+            continue
+        times = ' '.join('%9.2f' % record['phases'][name]['time'] for name in phases)
+        eventsPerSecond = '%10.3g' % record['eventsPerSecond'] if record['eventsPerSecond'] is not None else '%10s' % '-'
+        print('%s %s %9.0f %10.3g %s' % (head, times, record['peakRss'], record['spikesPerSecond'], eventsPerSecond))
+    if not baseline:
+        return True
+
+    regressions, improvements, changes = compare(results, baseline)
+    print('\nCompared with the baseline of %s (%s), threshold %.0f%%:' % (baseline['info']['date'],
+                                                                      baseline['info']['label'], threshold * 100))
+    for title, rows in [('Regressions', regressions), ('Improvements', improvements), ('Changed counts', changes)]:
+        print('%s: %d' % (title, len(rows)))
+        for key, item, a, b in rows:
+            if a is None:
+                print('  %-34s %s' % (key, item))
+                continue
+            ratio = ' (x%.2f)' % (b / a) if a else ''
+            print('  %-34s %-18s %12.4g -> %12.4g%s' % (key, item, a, b, ratio))
+    return not regressions
+
+
+###############################################################################
+#
+# MAIN
+#
+###############################################################################
+
+def run(modelNames=None, maxCells=maxCells, workers=1, overrides=None, cacheDir=None, label=None):
+    """Run the benchmark points of modelNames; returns the results ({'info', 'results'})"""
+    overrides = overrides or {}
+    unknown = set(modelNames or []) - set(models)
+    if unknown:
+        raise ValueError('Unknown models %s (models: %s)' % (', '.join(sorted(unknown)), ', '.join(models)))
+    directory = os.path.dirname(os.path.abspath(__file__))
+    tmp = None if cacheDir else tempfile.mkdtemp(prefix='scaling_benchmark_')  # never reuse timings of an older tree
+    records = []
+    try:
+        for name in modelNames or list(models):
+            scriptName, variables, modelOverrides = models[name]
+            script = os.path.join(directory, scriptName)
+            with open(script) as f:
+                source = f.read()
+            scriptVars = {}
+            for key, value in overrides.items():
+                if key.startswith(('netParams.', 'simConfig.', 'sweep.')):
+                    continue
+                try:
+                    sweep.overrideSource(source, {key: value}, script)
+                    scriptVars[key] = value
+                except ValueError:
+                    print('  %s: %s does not assign %s, left out' % (name, scriptName, key))
+            netParams, _ = modelParams(script, dict(variables, **scriptVars))
+            runner = {'sweep.runner': 'simtools'} if 'sim.createSimulateAnalyze(' in source else {}
+            fixed = dict(variables, **scriptVars)
+            fixed.update(modelOverrides)
+            fixed.update({key: value for key, value in overrides.items()
+                          if key.startswith(('netParams.', 'simConfig.', 'sweep.'))})
+            fixed.update({'simConfig.profile': True, 'simConfig.savePickle': True}, **runner)
+            points, keys = [], []
+            for numCells, convergence, duration in benchmarkPoints(maxCells):
+                point = dict(fixed, **scaledOverrides(netParams, numCells, convergence))
+                point['simConfig.duration'] = duration
+                points.append(point)
+                keys.append({'model': name, 'script': scriptName, 'numCells': numCells, 'convergence': convergence,
+                             'duration': duration})
+            outputs = sweep.run(script, points, cacheDir=cacheDir or tmp, workers=workers, analyze=True, collect=collect)
+            for key, output in zip(keys, outputs):
+                records.append(dict(key, **metrics(output)) if output else dict(key, error='run failed'))
+    finally:
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    import netpyne
+    import neuron
+    info = {'label': label or (', '.join('%s=%s' % item for item in sorted(overrides.items())) or 'default'),
+            'overrides': overrides, 'host': platform.node(), 'python': platform.python_version(),
+            'netpyne': netpyne.__version__, 'neuron': neuron.__version__, 'cpus': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'units': {'time': 's', 'mem': 'MB'}}
+    return {'info': info, 'results': records}
+
+
+def main(args):
+    global threshold
+    options = {'--models': None, '--max-cells': maxCells, '--workers': 1, '--baseline': 'scaling_baseline.json',
+               '--output': 'scaling_results.json', '--threshold': threshold, '--cache': None, '--label': None}
+    flags = set()
+    overrides = {}
+    i = 0
+    while i < len(args):
+        if args[i] == '--save-baseline':
+            flags.add(args[i])
+        elif args[i] in options:
+            options[args[i]] = args[i + 1]
+            i += 1
+        else:
+            key, value = args[i].split('=', 1)
+            overrides[key] = sweep._parseValue(value)
+        i += 1
+
+    threshold = float(options['--threshold'])
+    modelNames = options['--models'].split(',') if options['--models'] else None
+    results = run(modelNames, int(float(options['--max-cells'])), int(options['--workers']), overrides,
+                  options['--cache'], options['--label'])
+    with open(options['--output'], 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Results saved to %s' % options['--output'])
+
+    baseline = None
+    if '--save-baseline' in flags:
+        shutil.copy(options['--output'], options['--baseline'])
+        print('Baseline saved to %s' % options['--baseline'])
+    elif os.path.exists(options['--baseline']):
+        with open(options['--baseline']) as f:
+            baseline = json.load(f)
+    return printReport(results, baseline)
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(sys.argv[1:]) else 1)
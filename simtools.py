@@ -0,0 +1,375 @@
+"""
+simtools.py
+
+Wrappers around netpyne's sim.create/simulate/analyze used by the scripts in this repo
+
+Extra options are read from simConfig attributes that NetPyNE itself ignores:
+
+  simConfig.mechCache = 'mechcache'  # build the .mod files into this per-platform cache keyed by their hashes (see startup.py)
+  simConfig.localDt = False  # use CVODE with local variable time step, if every population supports it
+  simConfig.vectorConns = False  # generate connectivity rules in bulk with connbuild (see connbuild.py)
+  simConfig.netCache = None  # directory of the network cache, to reuse cells/conns/stims across runs (see netcache.py)
+  simConfig.netCacheMaxSize = 2**30  # bytes; least recently used entries are removed above this size
+  simConfig.netCacheMaxAge = 30  # days; entries unused for longer are removed
+  simConfig.loadBalance = None  # 'rule' or 'calibrate': distribute cells across MPI ranks by cost (see loadbalance.py)
+  simConfig.sharedBkg = False  # pre-generate NetStim background trains, one PatternStim per population (see bkgtrains.py)
+  simConfig.shareSynMechs = False  # one point process per sec/loc for linear synMechs (ExpSyn, Exp2Syn; see synshare.py)
+  simConfig.streamTraces = False  # write traces to a memory-mapped file every saveFileStep ms (see tracestore.py)
+  simConfig.eventDriven = False  # run IntFire1 populations in an event-driven engine coupled to NEURON (see intfirepop.py)
+  simConfig.planRecording = False  # only record trace specs that apply to each cell rule; needed for decimate/envelope traces (see recplan.py)
+  simConfig.monitors = []  # stop the run early when a population goes silent, runaway... (see monitors.py)
+  simConfig.monitorStep = 50  # ms between monitor checks
+  simConfig.checkpointTimes = []  # ms; save the state of the run at these times (see checkpoint.py)
+  simConfig.checkpointInterval = None  # ms; periodic checkpoints, a rerun of a killed run resumes from the latest
+  simConfig.checkpointDir = 'checkpoints'
+  simConfig.restoreCheckpoint = None  # checkpoint directory to start the run from (warm start)
+  simConfig.restoreData = True  # with restoreCheckpoint, keep the data recorded before it; False to fork
+  simConfig.spikeStats = False  # per-population rates, PSD, ISIs, CV and synchrony accumulated during the run (see spikestats.py)
+  simConfig.spikeStatsBinSize = 5  # ms
+  simConfig.keepSpikes = True  # False: drop spikes once counted by spikeStats, for long runs
+  simConfig.analysisWorkers = None  # run the analyses in this many processes, sharing spike indexes (0 = one per core; see plotpool.py)
+  simConfig.maxPlotPoints = 200000  # spikes above which plotpool draws rasters as density images
+  simConfig.saveColumnar = False  # also save spikes, traces, cells and conns as memory-mappable columns (see colstore.py)
+  simConfig.profile = False  # nested phase times, memory and counts saved to <filename>_profile.json (see profiling.py)
+
+Usage:
+  import simtools
+  simtools.createSimulateAnalyze(netParams, simConfig)  # instead of sim.createSimulateAnalyze
+
+"""
+
+import contextlib
+import os
+import sys
+
+import startup
+startup.deferAnalysis()  # before netpyne, so its analysis and plotting load only when an analysis runs
+
+from netpyne import sim
+
+startup.mark('startupImports')
+
+# mechanisms that are integrated correctly by CVODE (no dt-dependent updates in BREAKPOINT)
+cvodeMechs = ['hh', 'pas', 'ExpSyn', 'Exp2Syn', 'Izhi2007b', 'Izhi2007bArt',
+              'NetStim', 'VecStim', 'IntFire1', 'IntFire2', 'IntFire4']
+
+
+###############################################################################
+#
+# INTEGRATION METHOD
+#
+###############################################################################
+
+def popMechs(netParams, popLabel):
+    """
+    Return the set of NEURON mechanisms used by the cells of a population
+
+    Includes density mechanisms and point processes of the matching cell rules, the synaptic
+    mechanisms, and the cellModel itself for point cells (NetStim, IntFire1, Izhi2007bArt...).
+
+    """
+    import loadbalance
+
+    tags = dict(netParams.popParams[popLabel], pop=popLabel)
+    mechs = set(synMech['mod'] for synMech in netParams.synMechParams.values())
+    if tags.get('cellModel') in cvodeMechs:
+        mechs.add(tags['cellModel'])
+        return mechs
+
+    for ruleLabel, cellRule in netParams.cellParams.items():
+        conds = cellRule.get('conds', {})
+        if (conds and loadbalance.condsMet(conds, tags)) or (not conds and tags.get('cellType') == ruleLabel):
+            for sec in cellRule.get('secs', {}).values():
+                mechs.update(sec.get('mechs', {}).keys())
+                mechs.update(pointp['mod'] for pointp in sec.get('pointps', {}).values())
+    return mechs
+
+
+def setupIntegration(netParams, simConfig):
+    """
+    Apply simConfig.localDt: switch on CVODE with local variable time step
+
+    The local time step is only enabled if every population uses mechanisms in cvodeMechs;
+    otherwise the populations that do not support it are reported and the fixed dt is kept.
+
+    """
+    if not getattr(simConfig, 'localDt', False):
+        return
+
+    unsupported = {}
+    for popLabel in netParams.popParams:
+        mechs = popMechs(netParams, popLabel) - set(cvodeMechs)
+        if mechs:
+            unsupported[popLabel] = sorted(mechs)
+
+    if unsupported:
+        print('  Warning: local variable time step not enabled; not supported by:')
+        for popLabel, mechs in unsupported.items():
+            print('    %s: %s' % (popLabel, ', '.join(mechs)))
+        return
+
+    simConfig.cvode_active = True
+    simConfig.use_local_dt = True
+    if simConfig.verbose:
+        print('  Using CVODE with local variable time step')
+
+
+def _phase(name, simConfig=None):
+    """profiling.phase(name) if the run is profiled (simConfig.profile), a no-op otherwise (without importing profiling)"""
+    if not getattr(simConfig if simConfig is not None else sim.cfg, 'profile', False):
+        return contextlib.nullcontext()
+    import profiling
+    return profiling.phase(name)
+
+
+# ------------------------------------------------------------------------------
+# Wrapper to create network
+# ------------------------------------------------------------------------------
+def create(netParams, simConfig, output=False):
+    """
+    Wrapper around sim.create() that applies the extra simConfig options
+
+    The module of each option is imported only when the option is set.
+
+    """
+    profile = getattr(simConfig, 'profile', False)
+    if profile:
+        import profiling
+        profiling.start(simConfig)  # time the phases of create, simulate and analyze (see profiling.py)
+    elif 'profiling' in sys.modules:  # restore the functions wrapped by a profiled run before this one
+        sys.modules['profiling'].stop()
+    with _phase('create', simConfig):
+        mechCache = getattr(simConfig, 'mechCache', startup.cacheDir)
+        if mechCache:
+            startup.loadMechanisms(os.path.dirname(os.path.abspath(__file__)), mechCache)  # the .mod files of this repo
+        setupIntegration(netParams, simConfig)
+        cacheDir = getattr(simConfig, 'netCache', None)
+        if cacheDir:
+            import netcache
+        cacheKey = netcache.netKey(netParams, simConfig) if cacheDir else None  # before netpyne fills in defaults
+
+        with _phase('initialize', simConfig):
+            sim.initialize(netParams, simConfig)  # create network object and set cfg and net params
+        pops = sim.net.createPops()  # instantiate network populations
+        sim.loadBalance = None
+        balance = getattr(simConfig, 'loadBalance', None)
+        sharedBkg = getattr(simConfig, 'sharedBkg', False)
+        shareSynMechs = getattr(simConfig, 'shareSynMechs', False)
+        vectorConns = getattr(simConfig, 'vectorConns', False)
+        if balance in ('rule', 'calibrate'):
+            import loadbalance
+        if sharedBkg:
+            import bkgtrains
+        if shareSynMechs:
+            import synshare
+        if vectorConns:
+            import connbuild
+        with synshare.SharedSynapses(netParams, shareSynMechs) if shareSynMechs else contextlib.nullcontext():
+            with bkgtrains.SharedBackground(sharedBkg) if sharedBkg else contextlib.nullcontext():  # NetStims -> shared trains
+                if cacheKey and netcache.isCached(cacheDir, cacheKey):
+                    if sim.rank == 0:
+                        print('Loading network from cache %s...' % netcache.entryPath(cacheDir, cacheKey))
+                    cells, conns, stims = netcache.restore(cacheDir, cacheKey)  # cells, conns and stims without rule evaluation
+                else:
+                    with loadbalance.LoadBalance(balance) if balance in ('rule', 'calibrate') else contextlib.nullcontext():
+                        cells = sim.net.createCells()  # instantiate network cells based on defined populations
+                    if vectorConns:
+                        conns = connbuild.connectCells()  # create connections in bulk from compiled rules
+                    else:
+                        conns = sim.net.connectCells()  # create connections between cells based on params
+                    with netcache.StimRecorder() if cacheKey else contextlib.nullcontext() as stimRecorder:
+                        stims = sim.net.addStims()  # add external stimulation to cells (IClamps etc)
+                    if cacheKey and simConfig.createPyStruct:
+                        netcache.save(cacheDir, cacheKey, stimRecorder.stims)
+                        sim.pc.barrier()
+                        if sim.rank == 0:
+                            netcache.evict(cacheDir, getattr(simConfig, 'netCacheMaxSize', netcache.maxSize),
+                                           getattr(simConfig, 'netCacheMaxAge', netcache.maxAge), keep=cacheKey)
+        rxd = sim.net.addRxD()  # add reaction-diffusion (RxD)
+        sim.traceStore = None
+        sim.recordPlan = None
+        sim.eventEngine = None
+        if simConfig.recordTraces:
+            import recplan  # plans the recording, or rejects reduced traces without the plan
+        planRecording = getattr(simConfig, 'planRecording', False) and simConfig.recordTraces
+        if not planRecording and any(set(spec) & set(recplan.reduceKeys) for spec in simConfig.recordTraces.values()):
+            raise ValueError('Traces with %s need simConfig.planRecording = True' % ' or '.join(recplan.reduceKeys))
+        streamTraces = getattr(simConfig, 'streamTraces', False)
+        if streamTraces:
+            import tracestore
+        with recplan.RecordingPlan(netParams, simConfig) if planRecording else contextlib.nullcontext():
+            if streamTraces and tracestore.streamingEnabled(simConfig):
+                simData = tracestore.setupRecording()  # record traces in saveFileStep chunks, streamed to disk
+            else:
+                simData = sim.setupRecording()  # setup variables to record for each cell (spikes, V traces, etc)
+        if getattr(simConfig, 'eventDriven', False):
+            import intfirepop
+            intfirepop.setup()  # IntFire1 cells -> event-driven engine
+    if profile:
+        profiling.countObjects()  # cells, sections, conns... of each population
+
+    if output:
+        return (pops, cells, conns, rxd, stims, simData)
+
+
+# ------------------------------------------------------------------------------
+# Wrapper to simulate network
+# ------------------------------------------------------------------------------
+def simulate():
+    """
+    Wrapper around sim.simulate() that applies the extra simConfig options
+
+    """
+    profile = getattr(sim.cfg, 'profile', False)
+    if profile:
+        import profiling
+    with _phase('simulate'):
+        startup.markFirstStep()  # timeToFirstStep in sim.timingData
+        plan = getattr(sim, 'recordPlan', None)
+        traceStore = getattr(sim, 'traceStore', None)
+        sim.termination = None
+        checkpoints = any(getattr(sim.cfg, option, None) for option in ['checkpointTimes', 'checkpointInterval', 'restoreCheckpoint'])
+        useMonitors = bool(getattr(sim.cfg, 'monitors', None))
+        spikeStats = bool(getattr(sim.cfg, 'spikeStats', False))
+        tasks = []
+        if checkpoints:
+            import checkpoint
+            tasks = checkpoint.tasks()
+        if useMonitors:
+            import monitors
+            tasks.append(monitors.task())  # stop early when a monitor fires
+        if spikeStats:
+            import runloop
+            import spikestats
+            spikestats.start()  # after the monitors, which need the spikes before they are dropped
+            step = getattr(sim.cfg, 'monitorStep', monitors.monitorStep) if useMonitors else sim.cfg.saveFileStep
+            tasks.append(spikestats.task(runloop.every(step)))
+        restore = checkpoint.restoreFunc() if checkpoints else None  # warm start, or resume a killed run
+        engine = getattr(sim, 'eventEngine', None)
+        if engine:
+            if checkpoints:
+                raise ValueError('Checkpoints do not save the state of the event-driven IntFire1 engine')
+            tasks.insert(0, engine.task())  # before the tasks that read the spikes
+            restore = engine.start
+        if traceStore:
+            import tracestore
+        elif plan and plan.envelopes:
+            import recplan
+        if tasks or restore:
+            import runloop
+            if traceStore:
+                tasks.append((runloop.every(sim.cfg.saveFileStep), tracestore.flush, True))
+            elif plan and plan.envelopes:
+                tasks.append((runloop.every(sim.cfg.saveFileStep), recplan.collect, True))
+            reason = runloop.runSim(tasks, restore)
+            if reason:
+                monitors.terminate(reason)  # only the monitors stop a run early
+            runloop.finish()
+            if traceStore:
+                tracestore.finishRun()
+            elif plan and plan.envelopes:
+                recplan.finish()
+            if checkpoints:
+                checkpoint.finish()
+            if spikeStats:
+                spikestats.finish()
+        elif traceStore:
+            tracestore.runSim()
+        elif plan and plan.envelopes:
+            sim.runSimWithIntervalFunc(sim.cfg.saveFileStep, recplan.collect)  # reduce envelopes every saveFileStep
+            recplan.finish()
+        else:
+            sim.runSim()
+        if profile:
+            profiling.countEvents()  # spikes and events delivered of each population, before gathering
+        sim.gatherData()  # gather spiking data and cell info from each node
+        if sim.termination:
+            monitors.markTermination()  # reason and time the run stopped early, saved with the data
+        if spikeStats:
+            spikestats.markSummary()
+    if getattr(sim.cfg, 'loadBalance', None):
+        import loadbalance
+        loadbalance.report()  # computation time per rank and imbalance
+    if profile:
+        profiling.save()
+
+
+# ------------------------------------------------------------------------------
+# Wrapper to analyze network
+# ------------------------------------------------------------------------------
+def analyze():
+    """
+    Wrapper around sim.analyze() that applies the extra simConfig options
+
+    With streamed traces, the saved data leaves the traces out (they are in the trace file)
+    and the analysis functions read them lazily from the file. Decimated and envelope traces
+    are saved as recorded, and plotted through recplan.Resampled views. With spike statistics,
+    plotRatePSD is plotted from them (see spikestats.py).
+
+    """
+    summary = getattr(sim, 'spikeStatsSummary', None)
+    if summary:
+        import spikestats
+    with _phase('analyze'):
+        with spikestats.SummaryAnalysis() if summary else contextlib.nullcontext():
+            _analyze()
+    if getattr(sim.cfg, 'profile', False):
+        import profiling
+        profiling.save()  # profile with the analysis phases
+        profiling.stop()
+
+
+def _saveColumnar():
+    if getattr(sim.cfg, 'saveColumnar', False):
+        import colstore
+        colstore.save()
+
+
+def _plotData():
+    if not any(kwargs is not False for kwargs in sim.cfg.analysis.values()):  # without loading netpyne's analysis
+        if sim.rank == 0 and sim.cfg.timing:
+            sim.timing('stop', 'totalTime')  # as sim.analysis.plotData() does
+        return None
+    workers = getattr(sim.cfg, 'analysisWorkers', None)
+    if workers is None:
+        return sim.analysis.plotData()
+    import plotpool
+    plotpool.plotData(workers or None)
+
+
+def _analyze():
+    plan = getattr(sim, 'recordPlan', None)
+    if not getattr(sim, 'traceStore', None):
+        if not plan or not any(mode for mode, _ in plan.reduction.values()):
+            sim.saveData()
+            _saveColumnar()
+            return _plotData()
+        sim.saveData()
+        _saveColumnar()  # decimated and envelope traces as recorded
+        if sim.rank == 0:
+            import recplan
+            recplan.resampleSimData(sim.allSimData, plan.reduction)
+        return _plotData()
+
+    if sim.rank == 0:
+        for trace in sim.traceStore['traces']:
+            sim.allSimData.pop(trace, None)
+    sim.saveData()
+    if sim.rank == 0:
+        import tracestore
+        tracestore.load(sim.traceStore['file']).toSimData(sim.allSimData)
+    _saveColumnar()  # copied block by block from the trace file
+    _plotData()
+
+
+# ------------------------------------------------------------------------------
+# Wrapper to create, simulate, and analyse network
+# ------------------------------------------------------------------------------
+def createSimulateAnalyze(netParams, simConfig):
+    """
+    Wrapper around sim.createSimulateAnalyze() that applies the extra simConfig options
+
+    """
+    create(netParams, simConfig)
+    simulate()
+    analyze()
@@ -0,0 +1,373 @@
+"""
+spikestats.py
+
+Spike statistics accumulated during the run, so long runs need not keep every spike
+
+Every saveFileStep ms (every monitorStep with monitors, right after their check) the
+spikes recorded since the last update are added to accumulators of each population and
+of all cells:
+  - population rate (Hz) in bins of binSize ms (rateBinSize in the summary, once coarsened)
+  - power spectral density of that rate, by Welch's method as plotRatePSD with
+    transformMethod 'fft' (Hanning windows of NFFT bins overlapping by noverlap)
+  - histogram of interspike intervals (isiBinSize ms bins up to maxISI, then one overflow bin)
+  - mean coefficient of variation of the ISIs of each cell (cells with 2 or more ISIs)
+  - synchrony: chi^2 of the spike counts in bins (as monitors.synchronyIndex)
+Memory depends on the number of cells, not on the number of spikes or the duration: the
+rate signal kept for the summary is coarsened (adjacent bins averaged in pairs) whenever
+it exceeds maxRateBins bins, and the PSD is accumulated at the full resolution. Spikes in a bin not yet complete are kept for the next update, and the
+last incomplete bin of the run is left out (as plotRatePSD does).
+
+With simConfig.keepSpikes = False the recorded spikes are dropped once counted: the
+saved data have no spike times, 'popRates' and 'avgRate' come from the statistics, and
+the analysis functions that need spike times (plotRaster...) are skipped. The summary is
+saved as sim.allSimData['spikeStats'], and analyze() plots plotRatePSD from it (its
+binSize, NFFT and noverlap are those of the run).
+
+Usage:
+  simConfig.spikeStats = True  # used by simtools
+  simConfig.spikeStatsBinSize = 5  # ms
+  simConfig.keepSpikes = False  # drop spikes once counted
+
+"""
+
+import numpy as np
+from netpyne import sim
+
+import runloop
+
+binSize = 5  # ms
+NFFT = 256
+noverlap = 128
+isiBinSize = 1  # ms
+maxISI = 1000  # ms
+maxRateBins = 100000  # bins of the rate signal kept for the summary (500 s at binSize 5 ms) before halving its resolution
+
+# analysis functions that need the spike times
+spikeAnalyses = ['plotRaster', 'plotSpikeHist', 'plotSpikeStats', 'plotRates', 'plotSyncs', 'plotRateSpectrogram',
+                 'granger', 'plotSpikeFreq']
+
+
+###############################################################################
+#
+# ACCUMULATORS
+#
+###############################################################################
+
+class Welch(object):
+    """Running average of the periodograms of the Hanning-windowed segments of a signal"""
+
+    def __init__(self, fs, nfft=NFFT, overlap=noverlap):
+        self.fs = fs
+        self.nfft = nfft
+        self.step = nfft - overlap
+        self.window = np.hanning(nfft)
+        self.carry = np.zeros(0)
+        self.power = np.zeros(nfft // 2 + 1)
+        self.numSegments = 0
+
+    def _periodogram(self, segment):
+        power = np.abs(np.fft.rfft(segment * self.window)) ** 2 / (self.fs * (self.window ** 2).sum())
+        power[1:-1 if self.nfft % 2 == 0 else None] *= 2  # one-sided
+        return power
+
+    def add(self, values):
+        self.carry = np.concatenate([self.carry, values])
+        numSegments = (len(self.carry) - self.nfft) // self.step + 1 if len(self.carry) >= self.nfft else 0
+        for i in range(numSegments):
+            self.power += self._periodogram(self.carry[i * self.step:i * self.step + self.nfft])
+        self.numSegments += numSegments
+        self.carry = self.carry[numSegments * self.step:]
+
+    def result(self):
+        """(freqs, power density); a signal shorter than nfft is zero-padded, as matplotlib's psd does"""
+        freqs = np.fft.rfftfreq(self.nfft, 1.0 / self.fs)
+        if self.numSegments:
+            return freqs, self.power / self.numSegments
+        if len(self.carry):
+            return freqs, self._periodogram(np.concatenate([self.carry, np.zeros(self.nfft - len(self.carry))]))
+        return freqs, np.zeros(len(freqs))
+
+
+class SpikeStats(object):
+    """Accumulators of the spikes of this node (per cell) and of the population signals (on rank 0)"""
+
+    def __init__(self, binSize=binSize, start=0.0):
+        self.binSize = float(binSize)
+        self.start = start
+        self.pops = list(sim.net.pops)
+        self.gids = np.array(sorted(cell.gid for cell in sim.net.cells), dtype=np.int64)
+        gidPops = {cell.gid: self.pops.index(cell.tags['pop']) for cell in sim.net.cells}
+        self.cellPops = np.array([gidPops[gid] for gid in self.gids], dtype=np.int64)
+        localCounts = np.bincount(self.cellPops, minlength=len(self.pops))
+        self.numCells = np.sum(sim.pc.py_allgather(localCounts), axis=0)
+        self.numBins = 0
+        self.numRead = 0  # spikes read from the recorded vectors, with those dropped
+        self.pendingT = np.zeros(0)
+        self.pendingId = np.zeros(0, dtype=np.int64)
+
+        numCells = len(self.gids)
+        self.lastSpike = np.full(numCells, np.nan)
+        self.isiCount = np.zeros(numCells)
+        self.isiSum = np.zeros(numCells)
+        self.isiSum2 = np.zeros(numCells)
+        self.countSum = np.zeros(numCells)  # spike counts in bins, summed over bins
+        self.countSum2 = np.zeros(numCells)  # ... squared
+        self.isiHist = np.zeros((len(self.pops), int(np.ceil(maxISI / float(isiBinSize))) + 1))
+
+        labels = self.pops + ['allCells']
+        self.labels = labels
+        self.rates = []  # rank 0: (labels x bins) chunks of rates, each bin the mean of rateFactor bins of binSize
+        self.rateFactor = 1
+        self.rateCarry = np.zeros((len(labels), 0))  # bins of binSize not yet making a full rate bin
+        self.psd = {label: Welch(1000.0 / self.binSize) for label in labels}
+        self.meanSum = np.zeros(len(labels))  # sum over bins of the population mean count per cell
+        self.meanSum2 = np.zeros(len(labels))
+
+    def update(self, t):
+        """Add the spikes recorded up to t (all nodes); drops them if sim.cfg.keepSpikes is False"""
+        spktVec, spkidVec = sim.simData['spkt'], sim.simData['spkid']
+        dropped = getattr(sim, 'numSpikesDropped', 0)
+        first = max(self.numRead - dropped, 0)
+        spkt = np.concatenate([self.pendingT, spktVec.as_numpy()[first:]])
+        spkid = np.concatenate([self.pendingId, spkidVec.as_numpy()[first:].astype(np.int64)])
+        self.numRead = dropped + len(spktVec)
+        if not getattr(sim.cfg, 'keepSpikes', True):
+            sim.numSpikesDropped = self.numRead
+            spktVec.resize(0)
+            spkidVec.resize(0)
+
+        numBins = int((round(t, 6) - self.start) // self.binSize) - self.numBins  # bins completed since the last update
+        end = self.start + (self.numBins + numBins) * self.binSize
+        done = spkt < end
+        self.pendingT, self.pendingId = spkt[~done], spkid[~done]
+        spkt, spkid = spkt[done], spkid[done]
+        cells = np.searchsorted(self.gids, spkid)
+        bins = ((spkt - self.start) // self.binSize).astype(np.int64) - self.numBins
+
+        # ISIs: spikes by cell, in time order, after the last spike of each cell
+        order = np.lexsort((spkt, cells))
+        sortedCells, times = cells[order], spkt[order]
+        firstOfCell = np.ones(len(order), dtype=bool)
+        firstOfCell[1:] = sortedCells[1:] != sortedCells[:-1]
+        previous = np.empty(len(order))
+        previous[1:] = times[:-1]
+        previous[firstOfCell] = self.lastSpike[sortedCells[firstOfCell]]
+        isi = times - previous
+        valid = ~np.isnan(isi)
+        isiCells, isi = sortedCells[valid], isi[valid]
+        np.add.at(self.isiCount, isiCells, 1)
+        np.add.at(self.isiSum, isiCells, isi)
+        np.add.at(self.isiSum2, isiCells, isi ** 2)
+        isiBins = np.minimum((isi // isiBinSize).astype(np.int64), self.isiHist.shape[1] - 1)
+        np.add.at(self.isiHist, (self.cellPops[isiCells], isiBins), 1)
+        lastOfCell = np.append(firstOfCell[1:], True)[:len(order)]
+        self.lastSpike[sortedCells[lastOfCell]] = times[lastOfCell]
+
+        # counts per cell and bin, and per population and bin
+        keys, counts = np.unique(cells * max(numBins, 1) + bins, return_counts=True)
+        np.add.at(self.countSum, keys // max(numBins, 1), counts)
+        np.add.at(self.countSum2, keys // max(numBins, 1), counts.astype(float) ** 2)
+        popCounts = np.zeros((len(self.pops), numBins))
+        if numBins:
+            np.add.at(popCounts, (self.cellPops[cells], bins), 1)
+        self.numBins += numBins
+
+        allCounts = sim.pc.py_gather(popCounts, 0)
+        if sim.rank == 0 and numBins:
+            popCounts = np.sum(allCounts, axis=0)
+            popCounts = np.vstack([popCounts, popCounts.sum(axis=0)])
+            numCells = np.append(self.numCells, self.numCells.sum()).astype(float).reshape(-1, 1)
+            means = popCounts / np.maximum(numCells, 1)
+            self.meanSum += means.sum(axis=1)
+            self.meanSum2 += (means ** 2).sum(axis=1)
+            rates = means * 1000.0 / self.binSize
+            for label, rate in zip(self.labels, rates):
+                self.psd[label].add(rate)
+            self._addRates(rates)
+
+    def _addRates(self, rates):
+        """Append (labels x bins) rates to the rate signal, halving its resolution while it is longer than maxRateBins"""
+        rates = np.hstack([self.rateCarry, rates])
+        numFull = rates.shape[1] // self.rateFactor * self.rateFactor
+        self.rates.append(rates[:, :numFull].reshape(len(self.labels), -1, self.rateFactor).mean(axis=2))
+        self.rateCarry = rates[:, numFull:]
+        if sum(chunk.shape[1] for chunk in self.rates) <= maxRateBins:
+            return
+        rates = np.hstack(self.rates)
+        if rates.shape[1] % 2:  # the odd last bin goes back to the carry, as rateFactor bins of its mean
+            self.rateCarry = np.hstack([np.repeat(rates[:, -1:], self.rateFactor, axis=1), self.rateCarry])
+            rates = rates[:, :-1]
+        self.rates = [rates.reshape(len(self.labels), -1, 2).mean(axis=2)]
+        self.rateFactor *= 2
+
+    def summary(self):
+        """Statistics of each population and of all cells (all nodes; the result is on rank 0)"""
+        numBins = max(self.numBins, 1)
+        cellVar = self.countSum2 / numBins - (self.countSum / numBins) ** 2
+        hasCV = (self.isiCount >= 2) & (self.isiSum > 0)
+        isiMean = self.isiSum[hasCV] / self.isiCount[hasCV]
+        cellCV = np.sqrt(np.maximum(self.isiSum2[hasCV] / self.isiCount[hasCV] - isiMean ** 2, 0)) / isiMean
+        local = []
+        for i in range(len(self.pops)):
+            inPop = self.cellPops == i
+            local.append((self.countSum[inPop].sum(), cellVar[inPop].sum(), cellCV[inPop[hasCV]].sum(),
+                          np.count_nonzero(inPop[hasCV]), self.isiHist[i]))
+        nodes = sim.pc.py_gather(local, 0)
+        if sim.rank != 0:
+            return None
+
+        totals = [[sum(node[i][j] for node in nodes) for j in range(5)] for i in range(len(self.pops))]
+        totals.append([sum(total[j] for total in totals) for j in range(5)])
+        numCells = list(self.numCells) + [self.numCells.sum()]
+        duration = self.numBins * self.binSize / 1000.0
+        rates = np.hstack(self.rates) if self.rates else np.zeros((len(self.labels), 0))
+        stats = {'binSize': self.binSize, 'rateBinSize': self.binSize * self.rateFactor, 'start': self.start,
+                 'numBins': self.numBins, 'pops': {}}
+        for i, label in enumerate(self.labels):
+            numSpikes, varSum, cvSum, numCV, isiHist = totals[i]
+            meanVar = varSum / numCells[i] if numCells[i] else 0.0
+            popVar = self.meanSum2[i] / numBins - (self.meanSum[i] / numBins) ** 2
+            freqs, power = self.psd[label].result()
+            stats['pops'][label] = {
+                'numCells': int(numCells[i]), 'numSpikes': int(numSpikes),
+                'rate': numSpikes / float(numCells[i]) / duration if numCells[i] and duration else 0.0,
+                'rates': rates[i],
+                'psdFreqs': freqs, 'psd': power,
+                'isiEdges': np.arange(0, maxISI + isiBinSize, isiBinSize)[:len(isiHist)], 'isiHist': isiHist,
+                'cv': cvSum / numCV if numCV else float('nan'),
+                'synchrony': float(popVar / meanVar) if meanVar > 0 else 0.0}
+        return stats
+
+
+###############################################################################
+#
+# RUN
+#
+###############################################################################
+
+def enabled(simConfig):
+    return bool(getattr(simConfig, 'spikeStats', False))
+
+
+def start():
+    """Create the accumulators of the run in sim.spikeStats (all nodes)"""
+    sim.numSpikesDropped = 0
+    sim.spikeStats = SpikeStats(getattr(sim.cfg, 'spikeStatsBinSize', binSize))
+
+
+def update(simTime):
+    """Add the spikes recorded since the last update to sim.spikeStats (all nodes)"""
+    sim.spikeStats.update(simTime)
+
+
+def task(times=None):
+    """(times, func, final) task that updates sim.spikeStats for runloop.runSim(); times default to every saveFileStep"""
+    return times or runloop.every(sim.cfg.saveFileStep), update, True
+
+
+def finish():
+    """Summarize sim.spikeStats into sim.spikeStatsSummary (all nodes; on rank 0)"""
+    sim.spikeStatsSummary = sim.spikeStats.summary()
+
+
+def markSummary():
+    """Add the summary to sim.allSimData, and rates from it if spikes were dropped (after gatherData)"""
+    if sim.rank != 0 or not getattr(sim, 'spikeStatsSummary', None):
+        return
+    stats = sim.spikeStatsSummary
+    sim.allSimData['spikeStats'] = stats
+    if not getattr(sim.cfg, 'keepSpikes', True):
+        sim.allSimData['popRates'] = {label: pop['rate'] for label, pop in stats['pops'].items() if label != 'allCells'}
+        sim.allSimData['avgRate'] = stats['pops']['allCells']['rate']
+        sim.totalSpikes = stats['pops']['allCells']['numSpikes']
+        sim.firingRate = sim.allSimData['avgRate']
+        print('  Spikes (from spike statistics): %i (%0.2f Hz)' % (sim.totalSpikes, sim.firingRate))
+
+
+###############################################################################
+#
+# ANALYSIS
+#
+###############################################################################
+
+class SummaryAnalysis(object):
+    """
+    Context manager around the analysis that plots from the spike statistics
+
+    plotRatePSD is replaced by the one below; without spikes (keepSpikes False), the
+    analysis functions in spikeAnalyses are skipped.
+
+    """
+
+    def __enter__(self):
+        self.saved = [(owner, 'plotRatePSD', getattr(owner, 'plotRatePSD')) for owner in (sim.plotting, sim.analysis)
+                      if hasattr(owner, 'plotRatePSD')]
+        for owner, name, _ in self.saved:
+            setattr(owner, name, plotRatePSD)
+        self.analysis = sim.cfg.analysis
+        if not getattr(sim.cfg, 'keepSpikes', True):
+            skipped = [name for name in self.analysis if name in spikeAnalyses]
+            if skipped:
+                print('  Skipping %s: spikes were dropped (keepSpikes = False)' % ', '.join(skipped))
+            sim.cfg.analysis = {name: value for name, value in self.analysis.items() if name not in spikeAnalyses}
+        return self
+
+    def __exit__(self, *args):
+        for owner, name, func in self.saved:
+            setattr(owner, name, func)
+        sim.cfg.analysis = self.analysis
+
+
+def plotRatePSD(include=['eachPop', 'allCells'], minFreq=1, maxFreq=100, norm=False, overlay=True, popColors={},
+                yLogScale=True, ylim=None, figSize=(10, 8), fontSize=12, lineWidth=1.5, saveFig=None, showFig=True,
+                **kwargs):
+    """
+    plotRatePSD() from the spike statistics of the run (sim.allSimData['spikeStats'])
+
+    Populations and 'allCells' only; binSize, NFFT and noverlap are those of the run, and the
+    transform is always Welch's (transformMethod 'fft').
+
+    """
+    import matplotlib.pyplot as plt
+
+    stats = sim.allSimData['spikeStats']
+    labels = []
+    for subset in include:
+        labels += list(sim.net.pops) if subset == 'eachPop' else [subset]
+    missing = [label for label in labels if label not in stats['pops']]
+    if missing:
+        print('  plotRatePSD from spike statistics: skipping %s (only populations and allCells)' % missing)
+    labels = [label for label in labels if label in stats['pops']]
+    print('Plotting firing rate power spectral density (PSD) from spike statistics ...')
+
+    signals = []
+    for label in labels:
+        power = stats['pops'][label]['psd']
+        signals.append(10 * np.log10(np.maximum(power, 1e-30)) if yLogScale else power)
+    if norm and signals:
+        vmax = np.max(signals)
+        signals = [signal / vmax for signal in signals]
+
+    fig = plt.figure(figsize=figSize)
+    plt.rcParams.update({'font.size': fontSize})
+    colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    for i, (label, signal) in enumerate(zip(labels, signals)):
+        freqs = stats['pops'][label]['psdFreqs']
+        show = (freqs > minFreq) & (freqs < maxFreq)
+        if not overlay:
+            plt.subplot(len(labels), 1, i + 1)
+            plt.title(str(label), fontsize=fontSize)
+        plt.plot(freqs[show], signal[show], linewidth=lineWidth, color=popColors.get(label, colors[i % len(colors)]),
+                 label=str(label))
+        plt.xlabel('Frequency (Hz)', fontsize=fontSize)
+        plt.ylabel('Power (dB/Hz)' if yLogScale else 'Power (a. u.)', fontsize=fontSize)
+        plt.xlim([0, maxFreq])
+        if ylim:
+            plt.ylim(ylim)
+    if overlay and labels:
+        plt.legend(fontsize=fontSize, loc=1)
+    if saveFig:
+        plt.savefig(saveFig if isinstance(saveFig, str) else sim.cfg.filename + '_plot_spikePSD.png')
+    if showFig:
+        plt.show()
+    return fig, {'allSignal': signals, 'allFreqs': [stats['pops'][label]['psdFreqs'] for label in labels]}
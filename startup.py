@@ -0,0 +1,244 @@
+"""
+startup.py
+
+Fast startup of a run: cached mechanism builds, deferred analysis imports and time to first step
+
+Mechanisms: the .mod files of a directory are built with nrnivmodl into
+<cacheDir>/<platform>/<key>, with the platform the OS, machine and NEURON version and
+the key a hash of the .mod files, and loaded with nrn_load_dll(). A fresh checkout, a
+sweep worker or a container sharing the cache reuses the build instead of running
+nrnivmodl; editing a .mod file changes the key, so stale builds are never loaded.
+Builds go to a temporary directory renamed into place, so concurrent processes can
+build the same key safely. Mechanisms already loaded (e.g. from ./x86_64 by
+nrnivmodl run by hand) are not loaded again, and on Windows the shipped nrnmech.dll is
+used.
+
+Imports: netpyne imports its analysis and plotting packages (matplotlib, scipy.signal,
+bokeh...) on import, even for headless runs. deferAnalysis(), called before netpyne is
+imported, replaces them by modules that import the real ones on first use (e.g. when
+sim.analysis.plotData() runs an analysis), and keeps matplotlib out of the import.
+
+Time to first step: the time from the start of the process to the end of
+finitialize(), when the run takes its first fadvance, is saved with the timing data
+(timeToFirstStep, with startupImports and startupMechanisms as they complete), so
+startup_benchmark.py can check it against a target.
+
+Usage:
+  import startup
+  startup.deferAnalysis()  # before netpyne is imported (simtools does this)
+  startup.loadMechanisms('.')  # simtools.create() does this with simConfig.mechCache
+
+"""
+
+import glob
+import hashlib
+import importlib
+import importlib.util
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+cacheDir = 'mechcache'  # relative to the directory of the .mod files
+deferred = ['netpyne.analysis', 'netpyne.plotting']
+marks = {}  # s from the start of the process: startupImports, startupMechanisms, timeToFirstStep; and mechanismsTime
+_loaded = set()  # directories whose mechanisms are loaded in this process
+_imported = time.time()
+_handler = None  # FInitializeHandler of markFirstStep()
+
+
+def processStart():
+    """Wall-clock time this process started (from /proc on Linux; otherwise when startup was imported)"""
+    try:
+        with open('/proc/self/stat') as f:
+            startTicks = float(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/stat') as f:
+            bootTime = float(next(line.split()[1] for line in f if line.startswith('btime')))
+        return bootTime + startTicks / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, StopIteration, ValueError):
+        return _imported
+
+
+def mark(name):
+    """Record the time since the start of the process as marks[name] (s)"""
+    marks[name] = time.time() - processStart()
+    return marks[name]
+
+
+###############################################################################
+#
+# MECHANISM CACHE
+#
+###############################################################################
+
+def modFiles(directory='.'):
+    return sorted(glob.glob(os.path.join(directory, '*.mod')))
+
+
+def mechanismNames(files):
+    """Names of the mechanisms (SUFFIX, POINT_PROCESS, ARTIFICIAL_CELL) defined by .mod files"""
+    names = []
+    for fileName in files:
+        with open(fileName) as f:
+            names += re.findall(r'^\s*(?:SUFFIX|POINT_PROCESS|ARTIFICIAL_CELL)\s+(\w+)', f.read(), re.MULTILINE)
+    return names
+
+
+def platformTag():
+    import neuron
+    return '%s-%s-nrn%s' % (sys.platform, platform.machine(), neuron.__version__)
+
+
+def buildKey(files):
+    """Hash of the names and contents of the .mod files"""
+    digest = hashlib.sha256()
+    for fileName in files:
+        digest.update(os.path.basename(fileName).encode())
+        with open(fileName, 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()[:16]
+
+
+def _library(buildDir):
+    for pattern in ['*/libnrnmech.so', '*/.libs/libnrnmech.so', '*/libnrnmech.dylib', '*/.libs/libnrnmech.dylib']:
+        found = glob.glob(os.path.join(buildDir, pattern))
+        if found:
+            return found[0]
+    return None
+
+
+def build(files, entry):
+    """Run nrnivmodl on files into the cache entry (a directory); returns the path of the library"""
+    parent = os.path.dirname(entry)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.build-', dir=parent)
+    try:
+        for fileName in files:
+            shutil.copy(fileName, tmp)
+        result = subprocess.run(['nrnivmodl'], cwd=tmp, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if result.returncode or not _library(tmp):
+            raise RuntimeError('nrnivmodl failed in %s:\n%s' % (tmp, result.stdout.decode(errors='replace')[-2000:]))
+        try:
+            os.rename(tmp, entry)
+        except OSError:  # built by another process meanwhile
+            if not _library(entry):
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return _library(entry)
+
+
+def loadMechanisms(directory='.', cache=cacheDir):
+    """
+    Load the mechanisms of the .mod files in directory, building them into the cache if needed
+
+    cache: cache directory (relative to directory). Returns the library loaded, or None if
+    there was nothing to load (no .mod files, or their mechanisms are already loaded).
+
+    """
+    from neuron import h
+
+    start = time.time()
+    directory = os.path.abspath(directory)
+    files = modFiles(directory)
+    if directory in _loaded or not files:
+        return None
+    _loaded.add(directory)
+    loaded = set()
+    for mechType in (0, 1):  # density mechanisms and point processes
+        mechs, name = h.MechanismType(mechType), h.ref('')
+        for i in range(int(mechs.count())):
+            mechs.select(i)
+            mechs.selected(name)
+            loaded.add(name[0])
+    names = set(mechanismNames(files))
+    if names <= loaded:
+        return None
+
+    if sys.platform == 'win32':
+        if names & loaded:  # nrnmech.dll, loaded by NEURON from the working directory
+            return None
+        library = os.path.join(directory, 'nrnmech.dll')  # built with mknrndll
+    else:
+        entry = os.path.join(directory, cache, platformTag(), buildKey(files))
+        library = _library(entry)
+        if not library:
+            print('Building mechanisms of %s into %s...' % (directory, entry))
+            library = build(files, entry)
+    h.nrn_load_dll(library)
+    mark('startupMechanisms')
+    marks['mechanismsTime'] = time.time() - start
+    return library
+
+
+###############################################################################
+#
+# DEFERRED IMPORTS
+#
+###############################################################################
+
+class _Deferred(types.ModuleType):
+    """Stands in for a package until one of its attributes is used, then imports it"""
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') or self.__dict__.get('_imported'):
+            raise AttributeError(attr)
+        name = self.__name__
+        del sys.modules[name]
+        module = importlib.import_module(name)
+        self.__dict__.update(module.__dict__)  # code holding this placeholder (sim.analysis...) sees the real one
+        self._imported = True
+        return getattr(module, attr)
+
+
+def deferAnalysis():
+    """Import netpyne's analysis and plotting on first use (call before netpyne is imported); returns whether deferred"""
+    if 'netpyne' in sys.modules:
+        return False
+    location = importlib.util.find_spec('netpyne').submodule_search_locations[0]
+    for name in deferred:
+        path = os.path.join(location, name.split('.')[-1])
+        module = _Deferred(name)
+        module.__path__ = [path]
+        module.__spec__ = importlib.util.spec_from_file_location(name, os.path.join(path, '__init__.py'),
+                                                                 submodule_search_locations=[path])
+        sys.modules[name] = module
+    if not os.getenv('DISPLAY'):
+        os.environ.setdefault('MPLBACKEND', 'Agg')  # what netpyne's matplotlib.use('Agg') did
+    headless = '-nogui' in sys.argv  # asked for by the user: kept, and netpyne does not plot
+    if not headless:
+        sys.argv.append('-nogui')  # netpyne then leaves matplotlib alone...
+    try:
+        import netpyne
+        import netpyne.sim
+    finally:
+        if not headless:
+            del sys.argv[len(sys.argv) - 1 - sys.argv[::-1].index('-nogui')]  # the one added here
+    if not headless:
+        netpyne.__gui__ = True  # ...but the deferred modules still plot when loaded
+    return True
+
+
+###############################################################################
+#
+# TIME TO FIRST STEP
+#
+###############################################################################
+
+def markFirstStep():
+    """Save timeToFirstStep (and the other marks) in sim.timingData at the end of the next finitialize()"""
+    from netpyne import sim
+    from neuron import h
+
+    def record():
+        if 'timeToFirstStep' not in marks:
+            mark('timeToFirstStep')
+        sim.timingData.update(marks)
+
+    global _handler
+    _handler = h.FInitializeHandler(2, record)  # after the initial states are set
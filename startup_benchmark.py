@@ -0,0 +1,68 @@
+"""
+startup_benchmark.py
+
+Time to first fadvance of sweep workers, checked against a target
+
+Runs short points of cellmodels2.py in fresh sweep.py workers (one at a time) with
+an empty mechanism cache: the first worker builds the .mod files (cold), the others
+load the cached build (warm). For each worker, reports the time from the start of the
+process to the end of the imports, of the mechanism loading and of finitialize()
+(timeToFirstStep, see startup.py), and for reference the time to import netpyne with
+and without deferred analysis. Exits with status 1 if the median warm timeToFirstStep
+is above the target.
+
+Usage: python startup_benchmark.py [numWorkers] [target (s)]
+"""
+
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+import sweep
+
+target = 3.0  # s, median timeToFirstStep of warm workers
+
+importCode = {'eager': 'from netpyne import specs, sim',
+              'deferred': 'import startup; startup.deferAnalysis(); from netpyne import specs, sim'}
+
+
+def importTime(code):
+    """Seconds to run code (and start Python) in a fresh process"""
+    wrapped = 'import time; start = time.time(); %s; print(time.time() - start)' % code
+    result = subprocess.run([sys.executable, '-c', wrapped], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(result.stdout.decode().strip().split('\n')[-1])
+
+
+def main(numWorkers=4, target=target):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cellmodels2.py')
+    tmp = tempfile.mkdtemp(prefix='startup_benchmark_')  # empty sweep and mechanism caches
+    points = [{'which': 'izhi', 'simConfig.duration': 10, 'simConfig.mechCache': os.path.join(tmp, 'mechcache'),
+               'simConfig.seeds.stim': seed} for seed in range(1, numWorkers + 1)]
+    try:
+        results = sweep.run(script, points, cacheDir=os.path.join(tmp, 'sweep'), workers=1)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    if any(result is None for result in results):
+        raise RuntimeError('benchmark run failed')
+
+    print('\n%-8s %12s %12s %14s %10s' % ('worker', 'imports (s)', 'mechs (s)', 'first step (s)', 'build (s)'))
+    for i, result in enumerate(results):
+        timing = result['timing']
+        print('%-8s %12.2f %12.2f %14.2f %10.2f' % ('cold' if i == 0 else 'warm', timing['startupImports'],
+                                                  timing.get('startupMechanisms', float('nan')),
+                                                  timing['timeToFirstStep'], timing.get('mechanismsTime', 0)))
+    for name, code in importCode.items():
+        print('import netpyne (%s): %.2f s' % (name, importTime(code)))
+
+    warm = statistics.median(result['timing']['timeToFirstStep'] for result in results[1:] or results)
+    print('median warm time to first step: %.2f s (target %.2f s): %s' % (warm, target, 'ok' if warm <= target else 'FAILED'))
+    return warm <= target
+
+
+if __name__ == '__main__':
+    ok = main(*[float(arg) if i else int(arg) for i, arg in enumerate(sys.argv[1:3])])
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,322 @@
+"""
+sweep.py
+
+Parallel parameter sweeps and seed replicates of a model script, with a result cache
+
+Each point of a sweep is a dict of overrides applied to a model script such as
+cellmodels2.py:
+  'which': 'izhi'                                # top-level variable of the script
+  'netParams.popParams.PYR.numCells': 200        # path into netParams or simConfig
+  'simConfig.seeds.stim': 3
+Script variables replace the value of their top-level assignment before the script
+runs (so "which = 'h-h'" can be swept without editing the file); netParams/simConfig
+paths are set when the script calls createSimulateAnalyze() (of simtools, izhipop or
+sim), before the network is created. 'sweep.runner': 'simtools' runs the network with
+that module's createSimulateAnalyze() whichever one the script calls (e.g. so the
+simtools options, such as simConfig.profile, apply to scripts that call sim's).
+
+Every point runs in a fresh worker process (NEURON cannot be reset between runs), up
+to one per core, and its result (spikes, rates per population, timing, and why it
+stopped early if simConfig.monitors fired, see monitors.py) is stored under
+<cacheDir>/<key>, with the key a hash of the overrides and of what the run depends on:
+the script, the local modules it imports (directly, through each other or as
+runFuncs), the .mod files next to it, this module and the one of the collect function
+(which make the results), and the netpyne and NEURON versions. Points
+already in the cache are not run again, so an interrupted sweep resumes where it
+stopped; failed points are not cached and are retried on the next run.
+
+Usage:
+  import sweep
+  points = sweep.replicates(sweep.grid({'which': ['h-h', 'izhi'], 'netParams.popParams.PYR.numCells': [100, 200]}), [1, 2, 3])
+  results = sweep.run('cellmodels2.py', points)  # list of result dicts, in the order of points
+
+  python sweep.py cellmodels2.py which=h-h,izhi netParams.popParams.PYR.numCells=100,200 --seeds 1,2,3 [--workers 4]
+
+"""
+
+import ast
+import glob
+import hashlib
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import sys
+import time
+import traceback
+
+cacheDir = 'sweepcache'
+seedKeys = ['conn', 'stim', 'loc']
+
+# functions that run a model script's network; the overrides are applied when they are called
+runFuncs = [('simtools', 'createSimulateAnalyze'), ('izhipop', 'createSimulateAnalyze'),
+            ('netpyne.sim', 'createSimulateAnalyze')]
+
+# simConfig options that write files, switched off in workers unless analyze=True
+saveKeys = ['savePickle', 'saveJson', 'saveMat', 'saveTxt', 'saveDpk', 'saveDat', 'saveCSV', 'saveHDF5']
+
+
+###############################################################################
+#
+# POINTS
+#
+###############################################################################
+
+def grid(axes):
+    """All combinations of the values of each override: {key: [values]} -> list of points"""
+    keys = list(axes)
+    return [dict(zip(keys, values)) for values in itertools.product(*[axes[key] for key in keys])]
+
+
+def replicates(points, seeds, keys=seedKeys):
+    """Each point once per seed, with simConfig.seeds[key] = seed for each of keys"""
+    return [dict(point, **{'simConfig.seeds.%s' % key: seed for key in keys}) for point in points for seed in seeds]
+
+
+def localModules(script):
+    """Paths of the .py files next to script that it imports, directly, through each other or as runFuncs"""
+    directory = os.path.dirname(os.path.abspath(script))
+    pending = [os.path.abspath(script)] + [os.path.join(directory, moduleName + '.py') for moduleName, _ in runFuncs]
+    found = set()
+    while pending:
+        path = pending.pop()
+        if path in found or not os.path.exists(path):
+            continue
+        found.add(path)
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                names = [node.module]
+            else:
+                continue
+            pending += [os.path.join(directory, name.split('.')[0] + '.py') for name in names]
+    return sorted(found)
+
+
+def dependencyKey(script, collect=None):
+    """Hash of what the results of script depend on besides the overrides (see the module docstring)"""
+    import inspect
+    from importlib import metadata
+
+    directory = os.path.dirname(os.path.abspath(script))
+    files = localModules(script) + sorted(glob.glob(os.path.join(directory, '*.mod')))
+    files += [os.path.abspath(__file__)] + ([inspect.getsourcefile(collect)] if collect else [])
+    content = {'versions': [metadata.version(package) for package in ['netpyne', 'NEURON']]}
+    for path in files:
+        with open(path, 'rb') as f:
+            content[os.path.relpath(path, directory)] = hashlib.sha1(f.read()).hexdigest()
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def pointKey(script, point, dependencies=None):
+    """Cache key of a point: hash of the overrides and of dependencyKey(script) (given, or computed)"""
+    content = {'dependencies': dependencies or dependencyKey(script), 'point': point}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+def _scriptVars(point):
+    return {key: value for key, value in point.items() if not key.startswith(('netParams.', 'simConfig.', 'sweep.'))}
+
+
+def overrideSource(source, variables, filename='<script>'):
+    """Script source with the top-level assignments of variables replaced by their values"""
+    tree = ast.parse(source, filename)
+    assigned = set()
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name in variables:
+                node.value = ast.parse(repr(variables[name]), mode='eval').body
+                assigned.add(name)
+    missing = set(variables) - assigned
+    if missing:
+        raise ValueError('%s has no top-level assignment of %s' % (filename, ', '.join(sorted(missing))))
+    return compile(ast.fix_missing_locations(tree), filename, 'exec')
+
+
+def setPath(netParams, simConfig, path, value):
+    """Set a dotted path ('netParams.popParams.PYR.numCells') to value"""
+    parts = path.split('.')
+    obj = {'netParams': netParams, 'simConfig': simConfig}[parts[0]]
+    for part in parts[1:-1]:
+        obj = obj[part] if isinstance(obj, dict) else getattr(obj, part)
+    if isinstance(obj, dict):
+        obj[parts[-1]] = value
+    else:
+        setattr(obj, parts[-1], value)
+
+
+###############################################################################
+#
+# WORKER
+#
+###############################################################################
+
+def summary(sim):
+    """Default result of a run: spikes, cells and rate (Hz) of each population, and timing"""
+    import numpy as np
+
+    spkt = np.array(sim.allSimData.get('spkt', []), dtype=float)
+    spkid = np.array(sim.allSimData.get('spkid', []), dtype=np.int64)
+    pops = {}
+    for cell in sim.net.allCells:
+        tags = cell['tags'] if isinstance(cell, dict) else cell.tags
+        pops.setdefault(tags['pop'], []).append(cell['gid'] if isinstance(cell, dict) else cell.gid)
+    duration = sim.cfg.duration / 1000.0
+    numCells = {pop: len(gids) for pop, gids in pops.items()}
+    rates = {pop: float(np.isin(spkid, gids).sum()) / len(gids) / duration for pop, gids in pops.items()}
+    return {'spkt': spkt, 'spkid': spkid, 'numCells': numCells, 'popRates': rates,
+            'timing': {key: float(value) for key, value in sim.timingData.items()},
+            'termination': getattr(sim, 'termination', None)}  # see monitors.py
+
+
+def _runPoint(args):
+    """Run one point in this (fresh) process and store its result; returns (key, error or None)"""
+    script, point, key, entry, analyze, collect = args
+    os.makedirs(entry, exist_ok=True)
+    log = os.open(os.path.join(entry, 'log.txt'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(log, 1)  # NEURON prints from C, so redirect the file descriptors
+    os.dup2(log, 2)
+    try:
+        os.chdir(os.path.dirname(script))  # relative paths (mod files, caches) as when run by hand
+        sys.path.insert(0, os.path.dirname(script))
+        with open(script) as f:
+            code = overrideSource(f.read(), _scriptVars(point), script)
+        results = []
+        runners = {moduleName: getattr(importlib.import_module(moduleName), funcName) for moduleName, funcName in runFuncs}
+
+        def wrap(func):
+            def createSimulateAnalyze(netParams, simConfig):
+                for path, value in point.items():
+                    if path.startswith(('netParams.', 'simConfig.')):
+                        setPath(netParams, simConfig, path, value)
+                simConfig.filename = os.path.join(entry, 'run')  # outputs (traces, profile...) go to the entry
+                simConfig.saveFolder = None
+                if not analyze:
+                    simConfig.analysis = {}
+                    for saveKey in saveKeys:
+                        setattr(simConfig, saveKey, False)
+                runner = runners[point['sweep.runner']] if 'sweep.runner' in point else func
+                runner(netParams=netParams, simConfig=simConfig)
+                from netpyne import sim
+                if sim.rank == 0:
+                    results.append(summary(sim) if collect is None else collect(sim))
+            return createSimulateAnalyze
+
+        for moduleName, funcName in runFuncs:
+            setattr(importlib.import_module(moduleName), funcName, wrap(runners[moduleName]))
+        exec(code, {'__name__': '__main__', '__file__': script})
+        if not results:
+            raise RuntimeError('%s did not call createSimulateAnalyze()' % script)
+
+        result = dict(results[-1], point=point)
+        fileName = os.path.join(entry, 'result.pkl')
+        with open(fileName + '.tmp', 'wb') as f:  # written whole or not at all, so interrupted runs are retried
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fileName + '.tmp', fileName)
+        return key, None
+    except Exception:
+        traceback.print_exc()
+        return key, traceback.format_exc().strip().split('\n')[-1]
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+###############################################################################
+#
+# SWEEP
+#
+###############################################################################
+
+def resultFile(cacheDir, key):
+    return os.path.join(cacheDir, key, 'result.pkl')
+
+
+def load(cacheDir, key):
+    with open(resultFile(cacheDir, key), 'rb') as f:
+        return pickle.load(f)
+
+
+def run(script, points, cacheDir=cacheDir, workers=None, analyze=False, collect=None):
+    """
+    Run every point not in the cache, in parallel, and return the results of all points
+
+    workers: number of processes (default: number of cores). analyze: also plot and save as
+    the script asks (off by default). collect: function(sim) -> result, instead of summary();
+    must be importable by the workers (defined at module level).
+    Points that fail are reported and returned as None.
+
+    """
+    script = os.path.abspath(script)
+    cacheDir = os.path.abspath(cacheDir)
+    workers = workers or os.cpu_count()
+    with open(script) as f:
+        source = f.read()
+    for point in points:
+        overrideSource(source, _scriptVars(point), script)  # fail before running anything
+
+    dependencies = dependencyKey(script, collect)
+    keys = [pointKey(script, point, dependencies) for point in points]
+    pending = {}
+    for key, point in zip(keys, points):
+        if not os.path.exists(resultFile(cacheDir, key)):
+            pending[key] = (script, point, key, os.path.join(cacheDir, key), analyze, collect)
+    print('Sweep of %s: %d points, %d in cache, running %d on %d workers'
+          % (os.path.basename(script), len(points), len(points) - len(pending), len(pending), min(workers, len(pending) or 1)))
+
+    failed = {}
+    if pending:
+        for name in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+            os.environ.setdefault(name, '1')  # one core per run
+        start = time.time()
+        context = multiprocessing.get_context('spawn')  # workers do not inherit NEURON state
+        with context.Pool(min(workers, len(pending)), maxtasksperchild=1) as pool:
+            for i, (key, error) in enumerate(pool.imap_unordered(_runPoint, list(pending.values())), 1):
+                if error:
+                    failed[key] = error
+                    print('  [%d/%d] %s failed: %s (see %s)' % (i, len(pending), pending[key][1], error,
+                                                                os.path.join(cacheDir, key, 'log.txt')))
+                else:
+                    print('  [%d/%d] %s done' % (i, len(pending), pending[key][1]))
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+        print('  %d runs in %.1f s: %.1f runs/hour' % (len(pending), elapsed, len(pending) * 3600.0 / elapsed))
+
+    return [None if key in failed else load(cacheDir, key) for key in keys]
+
+
+def _parseValue(text):
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    options = {}
+    for option in ['--seeds', '--workers', '--cache']:
+        if option in args:
+            i = args.index(option)
+            options[option] = args[i + 1]
+            del args[i:i + 2]
+    axes = {}
+    for arg in args[1:]:
+        key, values = arg.split('=', 1)
+        axes[key] = [_parseValue(value) for value in values.split(',')]
+    points = grid(axes)
+    if '--seeds' in options:
+        points = replicates(points, [int(seed) for seed in options['--seeds'].split(',')])
+    results = run(args[0], points, options.get('--cache', cacheDir), int(options.get('--workers', 0)) or None)
+    for point, result in zip(points, results):
+        rates = ', '.join('%s %.2f Hz' % item for item in result['popRates'].items()) if result else 'failed'
+        if result and result.get('termination'):
+            rates += ' (terminated: %s)' % result['termination']['reason']
+        print('%s: %s' % (point, rates))
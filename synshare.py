@@ -0,0 +1,83 @@
+"""
+synshare.py
+
+One synapse per location for linear synaptic mechanisms
+
+NetPyNE creates a point process for every connection (simConfig.oneSynPerNetcon, True by
+default), so a PYR cell of cellmodels.py with 5 incoming PYR->PYR conns and its bkg stim
+has 6 ExpSyns, all integrated every time step. When a mechanism is linear in its inputs
+(each event adds weight x the same kernel to g, and i = g * (v - e)) one point process
+receiving all the NetCons gives the same total conductance and current. Here conns and
+stims onto the same (cell, sec, loc) with the same synMech label share one point process;
+each NetCon keeps its own weight and delay.
+
+Shared by default: synMechs whose mod is one of linearMods, with no string-function
+params (these can differ per conn) and no selfNetcon. Other mechanisms (e.g. NMDA with
+Mg block, saturating or plastic synapses) keep one point process per conn.
+
+Recorded synMech traces of a shared synMech (e.g. 'AMPA_g') are the total over all its
+NetCons, instead of the first conn's.
+
+Usage:
+  simConfig.shareSynMechs = True  # used by simtools; or a list of synMech labels to share
+
+"""
+
+from netpyne import sim
+
+linearMods = ['ExpSyn', 'Exp2Syn']
+
+
+def sharedLabels(netParams, labels=True):
+    """synMech labels whose point processes can be shared: the linear ones, or labels"""
+    if labels is not True:
+        return set(labels)
+    shared = set()
+    for label, params in netParams.synMechParams.items():
+        if params.get('mod') not in linearMods or 'selfNetcon' in params:
+            continue
+        if any(isinstance(value, str) for key, value in params.items() if key != 'mod'):
+            continue
+        shared.add(label)
+    return shared
+
+
+class SharedSynapses(object):
+    """
+    Context manager around cell, conn and stim creation that shares the synMechs of sharedLabels()
+
+    While active, CompartCell.addSynMech() reuses the synMech of the same label and loc in the
+    section (as NetPyNE does with oneSynPerNetcon = False) for the shared labels only.
+
+    """
+
+    def __init__(self, netParams, labels=True):
+        self.labels = sharedLabels(netParams, labels)
+        self.numRequested = 0
+
+    def __enter__(self):
+        self.addSynMech = sim.CompartCell.addSynMech
+        shared = self
+
+        def addSynMech(cell, synLabel, secLabel, loc, preLoc=None):
+            if synLabel not in shared.labels:
+                return shared.addSynMech(cell, synLabel, secLabel, loc, preLoc)
+            shared.numRequested += 1
+            oneSynPerNetcon = sim.cfg.oneSynPerNetcon
+            sim.cfg.oneSynPerNetcon = False
+            try:
+                return shared.addSynMech(cell, synLabel, secLabel, loc, preLoc)
+            finally:
+                sim.cfg.oneSynPerNetcon = oneSynPerNetcon
+
+        sim.CompartCell.addSynMech = addSynMech
+        return self
+
+    def __exit__(self, *args):
+        sim.CompartCell.addSynMech = self.addSynMech
+        if args[0] is None and self.labels:
+            numShared = sum(1 for cell in sim.net.cells if isinstance(getattr(cell, 'secs', None), dict)
+                            for sec in cell.secs.values()
+                            for synMech in sec.get('synMechs', []) if synMech.get('label') in self.labels)
+            print('  Number of shared synMechs (%s) on node %i: %i for %i conns and stims'
+                  % (', '.join(sorted(self.labels)), sim.rank, numShared, self.numRequested))
@@ -0,0 +1,247 @@
+"""
+tracestore.py
+
+Streaming recording of traces to memory-mapped files
+
+NetPyNE records every trace of every recorded cell into an h.Vector that grows for
+the whole simulation, and then copies all of them into Python lists when gathering
+and saving. In streaming mode the trace vectors only ever hold saveFileStep ms of
+data: the simulation runs in intervals of saveFileStep, and after each interval the
+vectors are written into a preallocated float32 array on disk and emptied, so memory
+use does not grow with the duration.
+
+The array is a .npy file (<filename>_traces.npy, shape trace x cell x time) with a
+JSON header next to it (<filename>_traces.json: trace labels, cell gids, recordStep,
+and which cells recorded each trace; rows of traces a cell does not have, e.g. u on
+an HH cell, are left as zeros). Traces recorded from several synapses of a cell
+(synMech traces without a single match) are summed. Decimated and envelope traces
+(see recplan.py) use the first samples of their rows.
+After the run, sim.allSimData[trace]['cell_<gid>'] are memory-mapped views into the
+file, so plotTraces (which slices by timeRange first) only reads what it plots.
+
+Usage:
+  simConfig.streamTraces = True  # used by simtools
+  simConfig.saveFileStep = 1000  # ms
+
+  import tracestore
+  store = tracestore.load('networkgeom')
+  v = store.trace('V', gid=1)  # lazy np.memmap view
+
+"""
+
+import json
+import os
+
+import numpy as np
+from netpyne import sim
+
+import recplan
+
+dtype = np.float32
+
+
+###############################################################################
+#
+# RECORDING
+#
+###############################################################################
+
+def streamingEnabled(simConfig):
+    """Whether simConfig requests streaming and it can be used (fixed recordStep, no local dt, LFP or dipoles)"""
+    if not getattr(simConfig, 'streamTraces', False):
+        return False
+    unsupported = [name for name, off in [('recordStep adaptive', simConfig.recordStep != 'adaptive'),
+                                           ('use_local_dt', not getattr(simConfig, 'use_local_dt', False)),
+                                           ('recordLFP', not simConfig.recordLFP),
+                                           ('recordDipole', not simConfig.recordDipole)] if not off]
+    if unsupported:
+        print('  Warning: streaming of traces not enabled; not supported with %s' % ', '.join(unsupported))
+        return False
+    return True
+
+
+def fileNames(simConfig=None):
+    """(data, header) file names for the traces of the current simulation"""
+    cfg = simConfig or sim.cfg
+    base = cfg.filename
+    if getattr(cfg, 'saveFolder', None):
+        base = os.path.join(cfg.saveFolder, os.path.basename(base))
+    return base + '_traces.npy', base + '_traces.json'
+
+
+def numSamples():
+    return int(round(sim.cfg.duration / sim.cfg.recordStep)) + 1
+
+
+def traceSamples(trace):
+    """Number of samples stored for a trace (fewer for decimated and envelope traces)"""
+    mode, n = sim.recordPlan.reduction[trace] if getattr(sim, 'recordPlan', None) else (None, 1)
+    if mode == 'decimate':
+        return -(-numSamples() // n)
+    if mode == 'envelope':
+        return 2 * -(-numSamples() // n)
+    return numSamples()
+
+
+def setupRecording():
+    """
+    sim.setupRecording() with trace vectors sized for saveFileStep instead of the whole duration
+
+    Also creates the trace file, with one row per trace and recorded cell across all nodes.
+
+    """
+    duration = sim.cfg.duration
+    sim.cfg.duration = min(duration, sim.cfg.saveFileStep)  # NetPyNE preallocates duration/recordStep samples
+    try:
+        simData = sim.setupRecording()
+    finally:
+        sim.cfg.duration = duration
+
+    traces = list(sim.cfg.recordTraces.keys())
+    localRecorded = [(trace, int(key[len('cell_'):])) for trace in traces for key in sim.simData.get(trace, {})
+                     if key.startswith('cell_') and not key.startswith('cell_time_')]
+    recorded = sorted(set(item for nodeRecorded in sim.pc.py_allgather(localRecorded) for item in nodeRecorded))
+    gids = sorted(set(gid for _, gid in recorded))
+
+    dataFile, headerFile = fileNames()
+    if sim.rank == 0:
+        if os.path.dirname(dataFile):
+            os.makedirs(os.path.dirname(dataFile), exist_ok=True)
+        shape = (len(traces), len(gids), max([traceSamples(trace) for trace in traces] or [numSamples()]))
+        data = np.lib.format.open_memmap(dataFile, mode='w+', dtype=dtype, shape=shape)
+        del data
+        plan = getattr(sim, 'recordPlan', None)
+        with open(headerFile, 'w') as f:
+            json.dump({'traces': traces, 'gids': gids, 'recordStep': sim.cfg.recordStep, 'duration': sim.cfg.duration,
+                       'recorded': {trace: [gid for tr, gid in recorded if tr == trace] for trace in traces},
+                       'reduction': {trace: plan.reduction[trace] for trace in traces if plan and plan.reduction[trace][0]}}, f)
+    sim.pc.barrier()
+
+    sim.traceStore = {'traces': traces, 'gids': gids, 'row': {gid: i for i, gid in enumerate(gids)},
+                      'offset': {}, 'file': dataFile}
+    return simData
+
+
+def flush(simTime=None, final=False):
+    """
+    Append the samples recorded since the last flush to the trace file and empty the trace vectors
+
+    Envelope traces are reduced before writing; final also reduces their last incomplete bin.
+
+    """
+    store = sim.traceStore
+    envelopes = sim.recordPlan.envelopes if getattr(sim, 'recordPlan', None) else []
+    data = np.load(store['file'], mmap_mode='r+')  # mapped only while writing, so written pages are not kept
+    for itrace, trace in enumerate(store['traces']):
+        for key, vec in sim.simData.get(trace, {}).items():
+            if not key.startswith('cell_') or key.startswith('cell_time_'):
+                continue
+            if isinstance(vec, dict):  # several synapses: sum of their traces
+                values = np.sum([v.as_numpy() for v in vec.values()], axis=0) if vec else np.zeros(0)
+                vecs = list(vec.values())
+            else:
+                values = vec.as_numpy()
+                vecs = [vec]
+            gid = int(key[len('cell_'):])
+            if trace in envelopes:
+                values = recplan.reduce(trace, (key, None), values, final)
+            start = store['offset'].get((trace, gid), 0)
+            stop = min(start + len(values), data.shape[2])
+            data[itrace, store['row'][gid], start:stop] = values[:stop - start]
+            store['offset'][(trace, gid)] = stop
+            for v in vecs:
+                v.resize(0)
+    data.flush()
+    del data
+    if hasattr(sim.simData.get('t'), 'resize'):
+        sim.simData['t'].resize(0)  # time is implicit: t = i*recordStep
+
+
+def runSim():
+    """Run the simulation in intervals of saveFileStep, flushing the traces after each one"""
+    sim.runSimWithIntervalFunc(sim.cfg.saveFileStep, flush)
+    finishRun()
+
+
+def finishRun():
+    """Flush the last envelope bins and store the number of samples of each trace in the header"""
+    if getattr(sim, 'recordPlan', None) and sim.recordPlan.envelopes:
+        flush(final=True)
+
+    # number of samples actually recorded of each trace (the file has room for one at t = duration too)
+    offsets = sim.traceStore['offset']
+    numRecorded = {trace: max(sim.pc.py_allgather(max([n for (tr, _), n in offsets.items() if tr == trace], default=0)))
+                   for trace in sim.traceStore['traces']}
+    if sim.rank == 0:
+        headerFile = fileNames()[1]
+        with open(headerFile) as f:
+            header = json.load(f)
+        header['numSamples'] = numRecorded
+        with open(headerFile, 'w') as f:
+            json.dump(header, f)
+
+
+###############################################################################
+#
+# READING
+#
+###############################################################################
+
+class TraceStore(object):
+    """
+    Traces of a simulation stored by streaming recording, read lazily from disk
+
+    Attributes
+    ----------
+    data : np.memmap
+        Array of shape trace x cell x time.
+
+    traces, gids : list
+        Trace labels and cell gids of the first two dimensions.
+
+    reduction : dict
+        (mode, n) of each trace: ('decimate', n), ('envelope', n) or (None, 1) (see recplan.py).
+
+    t : np.ndarray
+        Time of each sample of the traces that are not decimated (ms).
+
+    """
+
+    def __init__(self, filename):
+        base = filename[:-len('_traces.npy')] if filename.endswith('_traces.npy') else filename
+        with open(base + '_traces.json') as f:
+            header = json.load(f)
+        self.traces = header['traces']
+        self.gids = header['gids']
+        self.recordStep = header['recordStep']
+        self.recorded = {trace: set(gids) for trace, gids in header['recorded'].items()}
+        self.reduction = {trace: tuple(header.get('reduction', {}).get(trace, (None, 1))) for trace in self.traces}
+        self.data = np.load(base + '_traces.npy', mmap_mode='r')
+        self.numSamples = header.get('numSamples', {})
+        if not isinstance(self.numSamples, dict):  # files from before per-trace sample counts
+            self.numSamples = {trace: self.numSamples for trace in self.traces}
+        fullTraces = [trace for trace in self.traces if not self.reduction[trace][0]]
+        numFull = max([self.numSamples.get(trace, self.data.shape[2]) for trace in fullTraces]
+                      or [int(round(header['duration'] / self.recordStep))])
+        self.t = np.arange(numFull) * self.recordStep
+        self._row = {gid: i for i, gid in enumerate(self.gids)}
+
+    def trace(self, trace, gid):
+        """Memory-mapped view of one trace of one cell (as stored: decimated and envelope traces have fewer samples)"""
+        return self.data[self.traces.index(trace), self._row[gid], :self.numSamples.get(trace, self.data.shape[2])]
+
+    def hasTrace(self, trace, gid):
+        """Whether the cell recorded this trace (rows of traces it does not have are left as zeros)"""
+        return gid in self.recorded.get(trace, ())
+
+    def toSimData(self, simData):
+        """Set simData[trace]['cell_<gid>'] to memory-mapped views of the traces (as NetPyNE's allSimData)"""
+        for trace in self.traces:
+            simData[trace] = {'cell_%d' % gid: self.trace(trace, gid) for gid in self.gids if self.hasTrace(trace, gid)}
+        recplan.resampleSimData(simData, self.reduction)
+        simData['t'] = self.t
+
+
+def load(filename):
+    """Open the traces saved by streaming recording (simConfig.filename or the .npy file name)"""
+    return TraceStore(filename)
@@ -28,7 +28,7 @@ cellRule = {'conds': {'cellType': 'PYR', 'cellModel': 'HH'},  'secs': {}}
 
 cellRule['secs']['soma'] = {'geom': {}, 'mechs': {}}                                                 # soma params dict
 cellRule['secs']['soma']['geom'] = {'diam': 18.8, 'L': 18.8, 'Ra': 123.0}                            # soma geometry
-cellRule['secs']['soma']['mechs']['LIF1'] = {'gnabar': 0.12, 'gkbar': 0.036, 'gl': 0.003, 'el': -70} # soma hh mechanism
+cellRule['secs']['soma']['mechs']['hh'] = {'gnabar': 0.12, 'gkbar': 0.036, 'gl': 0.003, 'el': -70}   # soma hh mechanism
 
 ## for the dend section we included the topol dict defining how it connects to its parent soma section
 cellRule['secs']['dend'] = {'geom': {}, 'topol': {}, 'mechs': {}}                       # dend params dict
@@ -59,6 +59,15 @@ netParams.stimSourceParams['bkg'] = {'type': 'NetStim', 'rate': 10, 'noise': 0.5
 ## specify cells targeted by this stimulation - conds requirement
 ## Netstims connected with a weight and delay parameters to target the exc synaptic mechanism
 netParams.stimTargetParams['bkg->PYR'] = {'source': 'bkg', 'conds': {'cellType': 'PYR'}, 'weight': 0.01, 'delay': 5, 'synMech': 'exc'}
+## NetPyNE does not add stims to point cells, so the IntFire1 cells of S get the same background from a NetStim pop,
+## one 10 Hz NetStim per cell as above. Its inputs are 100 ms apart on average and m decays with tau = 10 ms in between,
+## so below a weight of 1 (IntFire1 fires when m > 1) S would only fire on the few inputs that follow another closely;
+## above 1 it fires once per input, as the HH cells of S in tut3.py do with a background strong enough to fire them
+## (weight 0.05: 10.2 Hz for 10 Hz of input; at 0.01 they never fire)
+numS = netParams.popParams['S']['numCells']
+netParams.popParams['bkg_S'] = {'cellModel': 'NetStim', 'numCells': numS, 'rate': 10, 'noise': 0.5}
+netParams.connParams['bkg->S'] = {'preConds': {'pop': 'bkg_S'}, 'postConds': {'pop': 'S'},
+                                  'connList': [[i, i] for i in range(numS)], 'weight': 1.5, 'delay': 5}
 
 ## Cell connectivity rules
 netParams.connParams['S->M'] = {    # S -> M label